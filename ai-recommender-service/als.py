@@ -0,0 +1,257 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ann import ANN_NPROBE, IVFIndex, build_ivf_index
+from item_similarity import build_interaction_matrix
+from scoring import ActiveMaskMixin
+
+
+ALS_FACTORS = int(os.getenv('ALS_FACTORS', 64))
+ALS_ITERATIONS = int(os.getenv('ALS_ITERATIONS', 15))
+ALS_REGULARIZATION = float(os.getenv('ALS_REGULARIZATION', 0.1))
+# 信心值 c = 1 + alpha·r (r 為互動評分，未互動的商品 c = 1、偏好 p = 0)
+ALS_ALPHA = float(os.getenv('ALS_ALPHA', 10.0))
+# 每個半輪以上一輪的解為起點的共軛梯度步數
+ALS_CG_STEPS = int(os.getenv('ALS_CG_STEPS', 3))
+# 每個求解區塊的最大列數；區塊內依互動數填補成 B×L×F 的張量，以批次矩陣乘法完成
+ALS_BLOCK_ROWS = int(os.getenv('ALS_BLOCK_ROWS', 1024))
+ALS_BLOCK_ELEMENTS = 1 << 22
+ALS_NUM_THREADS = int(os.getenv('ALS_NUM_THREADS', 0)) or os.cpu_count() or 1
+
+
+class ALSModel:
+    """
+    隱式回饋矩陣分解模型 (Hu, Koren & Volinsky 2008)：
+    - product_ids / item_factors: 商品 ID (int64，排序) 與 N×F 的商品向量 (float32)
+    - user_ids / user_factors: 訓練資料中的用戶 ID (int64，排序) 與 U×F 的用戶向量 (float32)
+    - index: 商品向量的 IVF 索引 (訓練時建立，與模型一起保存)；商品數少時為 None
+    用戶對商品的分數為兩向量的內積；記憶體用量為 O((U+N)·F)，與共現矩陣不同，不隨商品數平方成長。
+    """
+
+    def __init__(self, user_ids, user_factors, product_ids, item_factors, regularization=ALS_REGULARIZATION, alpha=ALS_ALPHA,
+                 index=None):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.user_factors = np.asarray(user_factors, dtype=np.float32)
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)
+        self.item_factors = np.asarray(item_factors, dtype=np.float32)
+        self.regularization = regularization
+        self.alpha = alpha
+        self.index = index
+        self._gram = None
+
+    @classmethod
+    def empty(cls, factors=ALS_FACTORS):
+        return cls(np.empty(0, dtype=np.int64), np.empty((0, factors), dtype=np.float32),
+                   np.empty(0, dtype=np.int64), np.empty((0, factors), dtype=np.float32))
+
+    @property
+    def is_empty(self):
+        return len(self.product_ids) == 0
+
+    @property
+    def factors(self):
+        return self.item_factors.shape[1]
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def gram(self):
+        """YᵀY + λI，fold-in 新用戶時使用，首次使用時計算 (產品同步重建引擎時沿用)。"""
+        if self._gram is None:
+            self._gram = _regularized_gram(self.item_factors, self.regularization)
+        return self._gram
+
+    def to_arrays(self):
+        """返回 (可寫入 ModelStore 的陣列, header metadata)，與 NeighborIndex 相同，商品 ID (已排序) 以陣列保存。"""
+        arrays = {'user_ids': self.user_ids, 'user_factors': self.user_factors,
+                  'product_ids': self.product_ids, 'item_factors': self.item_factors}
+        if self.index is not None:
+            arrays.update(self.index.to_arrays())
+        metadata = {'factors': self.factors, 'regularization': self.regularization, 'alpha': self.alpha}
+        return arrays, metadata
+
+    @classmethod
+    def from_arrays(cls, arrays, metadata):
+        """由 ModelStore 載入的 (memmap) 陣列重建模型，陣列不會被複製 (舊版本的商品 ID 在 header 中)。"""
+        product_ids = arrays['product_ids'] if 'product_ids' in arrays else np.asarray(metadata['product_ids'], dtype=np.int64)
+        return cls(arrays['user_ids'], arrays['user_factors'], product_ids,
+                   arrays['item_factors'], metadata['regularization'], metadata['alpha'], IVFIndex.from_arrays(arrays))
+
+
+def _regularized_gram(factors, regularization):
+    """YᵀY + λI (所有未互動商品的共同項，每個半輪只計算一次)。"""
+    gram = factors.T.astype(np.float64) @ factors.astype(np.float64)
+    gram[np.diag_indices_from(gram)] += regularization
+    return gram.astype(np.float32)
+
+
+class _RowBlock:
+    """
+    一個區塊的列 (用戶或商品) 與其互動，依互動數填補成 B×L (L 為區塊內最多的互動數)。
+    互動結構在各輪之間不變，只在訓練開始時建立一次。
+    """
+
+    def __init__(self, matrix, rows, alpha):
+        starts = matrix.indptr[rows]
+        counts = matrix.indptr[rows + 1] - starts
+        width = max(int(counts.max()), 1)
+        self.rows = rows
+        self.valid = np.arange(width)[None, :] < counts[:, None]
+        positions = np.where(self.valid, starts[:, None] + np.arange(width)[None, :], 0)
+        self.columns = matrix.indices[positions]
+        self.confidence = np.where(self.valid, alpha * matrix.data[positions], 0).astype(np.float32)  # c − 1
+
+
+def _row_blocks(matrix, alpha, factors, block_rows=ALS_BLOCK_ROWS):
+    """依互動數排序後切成區塊 (填補量小)，每個區塊的 B×L×F 不超過 ALS_BLOCK_ELEMENTS。"""
+    counts = np.diff(matrix.indptr)
+    order = np.argsort(counts, kind='stable')
+    sorted_counts = counts[order]
+    blocks = []
+    start = 0
+    while start < len(order):
+        end = min(start + block_rows, len(order))
+        width = max(int(sorted_counts[end - 1]), 1)
+        end = min(end, start + max(1, ALS_BLOCK_ELEMENTS // (width * factors)))
+        blocks.append(_RowBlock(matrix, order[start:end], alpha))
+        start = end
+    return blocks
+
+
+def _solve_block(block, other_factors, gram, out, cg_steps):
+    """
+    對一個區塊的列求解 (YᵀY + Yᵤᵀ(Cᵤ−I)Yᵤ + λI)·xᵤ = YᵤᵀCᵤpᵤ：
+    以上一輪的解為起點做 cg_steps 步共軛梯度 (Takács et al. 2011)，每步只需兩次 B×L×F 的批次矩陣-向量乘積，
+    不需要建立 B×F×F 的方程，成本為 O(B·(L·F + F²)) 而非 O(B·(L·F² + F³))。
+    """
+    factors = other_factors[block.columns] * block.valid[:, :, None]  # B×L×F
+    confidence = block.confidence
+
+    def apply(vectors):
+        projected = np.matmul(factors, vectors[:, :, None])[:, :, 0] * confidence  # B×L
+        return vectors @ gram + np.matmul(projected[:, None, :], factors)[:, 0, :]
+
+    x = out[block.rows]
+    rhs = np.matmul((1 + confidence)[:, None, :], factors)[:, 0, :]  # Σ cᵢ·yᵢ (p = 1 的商品)
+    residual = rhs - apply(x)
+    direction = residual.copy()
+    residual_norm = (residual * residual).sum(axis=1)
+    for _ in range(cg_steps):
+        if residual_norm.max() < 1e-12:
+            break
+        applied = apply(direction)
+        step = residual_norm / np.maximum((direction * applied).sum(axis=1), 1e-12)
+        x += step[:, None] * direction
+        residual -= step[:, None] * applied
+        new_norm = (residual * residual).sum(axis=1)
+        direction = residual + (new_norm / np.maximum(residual_norm, 1e-12))[:, None] * direction
+        residual_norm = new_norm
+    out[block.rows] = x
+
+
+def _solve_all(blocks, other_factors, regularization, executor, out, cg_steps):
+    gram = _regularized_gram(other_factors, regularization)
+    # NumPy 的批次矩陣乘法會釋放 GIL，區塊在多個執行緒中並行
+    list(executor.map(lambda block: _solve_block(block, other_factors, gram, out, cg_steps), blocks))
+
+
+def train_als(user_ids, product_ids, ratings, factors=ALS_FACTORS, iterations=ALS_ITERATIONS,
+              regularization=ALS_REGULARIZATION, alpha=ALS_ALPHA, cg_steps=ALS_CG_STEPS, num_threads=ALS_NUM_THREADS,
+              seed=0, build_index=True) -> ALSModel:
+    """
+    以交替最小平方法訓練隱式回饋模型：每個半輪固定一側的向量，所有用戶 (或商品) 的方程彼此獨立，
+    以分塊的批次共軛梯度在 num_threads 個執行緒中並行求解。訓練完成後為商品向量建立 IVF 索引。
+    """
+    matrix, unique_users, unique_products = build_interaction_matrix(user_ids, product_ids, ratings)
+    user_blocks = _row_blocks(matrix, alpha, factors)
+    item_blocks = _row_blocks(matrix.T.tocsr(), alpha, factors)
+    rng = np.random.default_rng(seed)
+    user_factors = (rng.standard_normal((len(unique_users), factors)) * 0.01).astype(np.float32)
+    item_factors = (rng.standard_normal((len(unique_products), factors)) * 0.01).astype(np.float32)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for _ in range(iterations):
+            _solve_all(user_blocks, item_factors, regularization, executor, user_factors, cg_steps)
+            _solve_all(item_blocks, user_factors, regularization, executor, item_factors, cg_steps)
+    index = build_ivf_index(item_factors, seed=seed) if build_index else None
+    return ALSModel(unique_users, user_factors, unique_products, item_factors, regularization, alpha, index)
+
+
+class ALSEngine(ActiveMaskMixin):
+    """
+    v3 策略的評分引擎：用戶向量與商品向量的內積加上部分排序 (argpartition)。
+    - 模型有 IVF 索引時只對 nprobe 個清單中的候選商品 (數百個) 評分，否則對全目錄做一次矩陣-向量乘積
+    - 訓練資料中的用戶使用訓練好的用戶向量
+    - 新用戶 (或模型訓練後才出現的用戶) 由最近瀏覽即時 fold-in：以固定的商品向量求解一次 F×F 方程
+    active_mask 與 ScoringEngine 相同，完整產品同步時重建，增量同步時由 with_active_changes 產生新引擎。
+    """
+
+    def __init__(self, model, catalog, model_version=None, trained_at=None, nprobe=ANN_NPROBE):
+        self.model = model
+        self.nprobe = nprobe
+        self.model_version = model_version
+        self.trained_at = trained_at
+        self.product_ids = model.product_ids
+        self.active_mask = catalog.is_active(self.product_ids)
+
+    @property
+    def is_empty(self):
+        return self.model.is_empty
+
+    def rows_for(self, product_ids):
+        """將商品 ID 轉為模型列索引，不在模型中的商品會被略過。返回 (rows, 對應的原始位置)。"""
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        if not len(self.product_ids) or not len(product_ids):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.product_ids, product_ids), len(self.product_ids) - 1)
+        positions = np.flatnonzero(self.product_ids[rows] == product_ids)
+        return rows[positions], positions
+
+    def user_vector(self, user_id, viewed_product_ids, weights=None):
+        """返回用戶向量；不在訓練資料中的用戶以最近瀏覽 fold-in，沒有可用的瀏覽時返回 None。"""
+        user_ids = self.model.user_ids
+        row = np.searchsorted(user_ids, user_id)
+        if row < len(user_ids) and user_ids[row] == user_id:
+            return self.model.user_factors[row]
+
+        rows, positions = self.rows_for(viewed_product_ids)
+        if not len(rows):
+            return None
+        ratings = np.ones(len(rows), dtype=np.float32) if weights is None else np.asarray(weights, dtype=np.float32)[positions]
+        factors = self.model.item_factors[rows]
+        weighted = factors * (self.model.alpha * ratings)[:, None]
+        lhs = self.model.gram() + weighted.T @ factors
+        return np.linalg.solve(lhs, (factors + weighted).sum(axis=0)).astype(np.float32)
+
+    def recommend(self, user_id, viewed_product_ids, k, weights=None):
+        """返回 top-k 推薦商品 ID (已排除已看與非活躍商品)，依分數遞減排序。"""
+        if self.is_empty or k <= 0:
+            return []
+        vector = self.user_vector(user_id, viewed_product_ids, weights)
+        if vector is None:
+            return []
+        viewed_rows, _ = self.rows_for(viewed_product_ids)
+
+        if self.model.index is not None:
+            # 先以 IVF 索引取回候選商品，過濾非活躍與已看過的商品後只對候選評分
+            candidates = self.model.index.candidates(vector, self.nprobe)
+            candidates = candidates[self.active_mask[candidates] & ~np.isin(candidates, viewed_rows)]
+            if len(candidates) >= k:
+                return self.product_ids[self._top_k(candidates, self.model.item_factors[candidates] @ vector, k)].tolist()
+            # 候選不足 (例如探訪的清單大多已下架) 時退回全目錄評分
+
+        scores = self.model.item_factors @ vector
+        scores[~self.active_mask] = -np.inf
+        scores[viewed_rows] = -np.inf
+        candidates = np.arange(len(scores))
+        top = self._top_k(candidates, scores, k)
+        return self.product_ids[top[np.isfinite(scores[top])]].tolist()
+
+    @staticmethod
+    def _top_k(candidates, scores, k):
+        """返回分數最高的 k 個候選 (依分數遞減)。"""
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return candidates[top[np.argsort(-scores[top], kind='stable')]]
@@ -0,0 +1,123 @@
+import os
+
+import numpy as np
+import scipy.sparse as sp
+
+
+# 倒排清單數；0 表示依商品數自動決定 (每個清單平均約 ANN_LIST_SIZE 個商品)
+ANN_NLIST = int(os.getenv('ANN_NLIST', 0))
+ANN_LIST_SIZE = int(os.getenv('ANN_LIST_SIZE', 64))
+# 商品數少於此值時不建立索引 (全目錄評分已足夠快)
+ANN_MIN_ITEMS = int(os.getenv('ANN_MIN_ITEMS', 20000))
+# 查詢時至少探訪的清單數 (召回率/延遲的取捨)；探訪的清單合計不足 ANN_MIN_CANDIDATES 個商品時
+# 依距離繼續探訪，最多 4·ANN_NPROBE 個清單 (熱門商品的清單通常較小)
+ANN_NPROBE = int(os.getenv('ANN_NPROBE', 16))
+ANN_MIN_CANDIDATES = int(os.getenv('ANN_MIN_CANDIDATES', 256))
+ANN_KMEANS_ITERATIONS = int(os.getenv('ANN_KMEANS_ITERATIONS', 15))
+# k-means 只在抽樣的點上訓練 (每個清單最多這麼多個點)，再將所有商品分配到最近的中心
+ANN_KMEANS_SAMPLES_PER_LIST = 64
+ANN_KMEANS_MAX_SAMPLES = 262144
+ANN_ASSIGN_CHUNK_ROWS = 65536
+
+
+class IVFIndex:
+    """
+    商品向量的倒排檔 (IVF) 索引，只使用 NumPy，無額外依賴：
+    - centroids: nlist×(F+1) 的 k-means 中心 (float32)，在擴增後的空間中訓練 (見 augment_items)
+    - list_offsets / list_rows: 依清單串接的商品列索引 (int32)，第 c 個清單為 list_rows[list_offsets[c]:list_offsets[c+1]]
+    最大內積搜尋以擴增維度轉為歐氏最近鄰 (Bachrach et al. 2014)，k-means 的分群因此與推薦的排序一致。
+    查詢時挑出最近的 nprobe 個中心，只對這些清單中的商品評分，
+    每次查詢的成本約為 O(nlist·F + nprobe·(N/nlist)·F)，而非全目錄的 O(N·F)。
+    """
+
+    def __init__(self, centroids, list_offsets, list_rows):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+        self.list_rows = np.asarray(list_rows, dtype=np.int32)
+        self._centroid_norms = (self.centroids * self.centroids).sum(axis=1)
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    def to_arrays(self):
+        return {'ivf_centroids': self.centroids, 'ivf_list_offsets': self.list_offsets, 'ivf_list_rows': self.list_rows}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """由 ModelStore 載入的 (memmap) 陣列重建索引；模型沒有索引時返回 None。"""
+        if 'ivf_centroids' not in arrays:
+            return None
+        return cls(arrays['ivf_centroids'], arrays['ivf_list_offsets'], arrays['ivf_list_rows'])
+
+    def candidates(self, vector, nprobe=ANN_NPROBE, min_candidates=ANN_MIN_CANDIDATES):
+        """返回最接近查詢向量的清單 (至少 nprobe 個，直到累積 min_candidates 個商品) 中的所有商品列索引。"""
+        nprobe = min(max(nprobe, 1), self.nlist)
+        max_probes = min(4 * nprobe, self.nlist)
+        # 查詢向量正規化並在擴增維度補 0：‖q−c‖² = ‖c‖² − 2·q·c[:F] + 1
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        distances = self._centroid_norms - 2 * (self.centroids[:, :-1] @ query)
+        probes = np.argpartition(distances, max_probes - 1)[:max_probes]
+        probes = probes[np.argsort(distances[probes])]
+        cumulative = np.cumsum(self.list_offsets[probes + 1] - self.list_offsets[probes])
+        probes = probes[:max(nprobe, int(np.searchsorted(cumulative, min_candidates)) + 1)]
+        starts = self.list_offsets[probes]
+        sizes = self.list_offsets[probes + 1] - starts
+        # 一次向量運算取出所有清單的內容 (不走訪 Python 迴圈)
+        positions = np.repeat(starts - np.cumsum(sizes) + sizes, sizes) + np.arange(int(sizes.sum()))
+        return self.list_rows[positions]
+
+
+def augment_items(item_factors):
+    """
+    將商品向量縮放到最大範數為 1，並補上一維 √(1−‖y‖²)，所有點因此落在單位球面上：
+    對單位查詢向量 q (擴增維度為 0)，‖q−y′‖² = 2 − 2·q·y/M，歐氏距離越近即內積越大。
+    """
+    item_factors = np.asarray(item_factors, dtype=np.float32)
+    norms = np.linalg.norm(item_factors, axis=1)
+    scaled = item_factors / max(float(norms.max()), 1e-12)
+    extra = np.sqrt(np.maximum(1 - (scaled * scaled).sum(axis=1), 0))
+    return np.hstack([scaled, extra[:, None]]).astype(np.float32)
+
+
+def _assign(points, centroids):
+    """分塊計算每個點最近的中心 (‖x−c‖² = ‖c‖² − 2x·c + 常數)。"""
+    centroid_norms = (centroids * centroids).sum(axis=1)
+    assignments = np.empty(len(points), dtype=np.int64)
+    for start in range(0, len(points), ANN_ASSIGN_CHUNK_ROWS):
+        chunk = points[start:start + ANN_ASSIGN_CHUNK_ROWS]
+        assignments[start:start + len(chunk)] = np.argmin(centroid_norms[None, :] - 2 * (chunk @ centroids.T), axis=1)
+    return assignments
+
+
+def build_ivf_index(item_factors, nlist=ANN_NLIST, iterations=ANN_KMEANS_ITERATIONS, seed=0):
+    """
+    以 k-means 將商品向量分成 nlist 個清單 (訓練時呼叫，與模型一起寫入 ModelStore)。
+    商品數少於 ANN_MIN_ITEMS 時返回 None。
+    """
+    n_items = len(item_factors)
+    if n_items < ANN_MIN_ITEMS:
+        return None
+    points = augment_items(item_factors)
+    nlist = nlist or max(1, n_items // ANN_LIST_SIZE)
+    rng = np.random.default_rng(seed)
+
+    sample_size = min(n_items, nlist * ANN_KMEANS_SAMPLES_PER_LIST, max(ANN_KMEANS_MAX_SAMPLES, nlist))
+    sample = points[rng.choice(n_items, size=sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _assign(sample, centroids)
+        # 以稀疏的 one-hot 矩陣乘法一次算出各中心的新位置
+        membership = sp.csr_matrix((np.ones(sample_size, dtype=np.float32), (assignments, np.arange(sample_size))), shape=(nlist, sample_size))
+        counts = np.asarray(membership.sum(axis=1)).ravel()
+        updated = np.asarray(membership @ sample) / np.maximum(counts, 1)[:, None]
+        # 空的中心重新以隨機的抽樣點初始化
+        empty = counts == 0
+        updated[empty] = sample[rng.choice(sample_size, size=int(empty.sum()))]
+        centroids = updated.astype(np.float32)
+
+    assignments = _assign(points, centroids)
+    list_rows = np.argsort(assignments, kind='stable').astype(np.int32)
+    list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=nlist))])
+    return IVFIndex(centroids, list_offsets, list_rows)
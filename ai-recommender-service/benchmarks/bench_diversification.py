@@ -0,0 +1,28 @@
+import itertools
+
+
+NUM_RECOMMENDATIONS = 10
+
+
+def bench_v2_diversification(benchmark, recommender, histories):
+    """v2 的 MMR 重排與補充步驟 (_finalize_recommendations)，相似度候選預先算好，只量測多樣化本身。"""
+    engine = recommender.scoring_engine
+    candidate_count = recommender._mmr_candidate_count(NUM_RECOMMENDATIONS)
+    inputs = []
+    for viewed, weights in histories:
+        rows, scores = engine.top_candidates(viewed, candidate_count, weights)
+        inputs.append((engine.product_ids[rows].tolist(), scores, viewed))
+    inputs = itertools.cycle(inputs)
+
+    def diversify():
+        base_recommendations, base_scores, viewed = next(inputs)
+        return recommender._finalize_recommendations('v2', base_recommendations, viewed, NUM_RECOMMENDATIONS, base_scores)
+
+    benchmark(diversify)
+    benchmark.extra_info['categories'] = len(recommender.catalog.category_names)
+
+
+def bench_single_user_recommendation_v2(benchmark, recommender, sample_users):
+    """完整的 v2 推薦路徑 (最近瀏覽 → 評分 → 多樣化 → 補充)，不經過結果快取。"""
+    users = itertools.cycle(sample_users)
+    benchmark(lambda: recommender.get_recommendations(next(users), 'v2', NUM_RECOMMENDATIONS))
@@ -0,0 +1,47 @@
+import itertools
+
+import numpy as np
+
+from metrics_recorder import encode_product_ids, decode_product_ids
+from recommendation_metrics import category_stats
+
+
+NUM_RECOMMENDATIONS = 10
+
+
+def _recommendation_lists(recommender, users, strategy_version='v2'):
+    return [recommender.get_recommendations(user_id, strategy_version, NUM_RECOMMENDATIONS) for user_id in users]
+
+
+def bench_single_request_category_metrics(benchmark, recommender, sample_users):
+    """/recommend/{user_id} 每個請求的類別多樣性與熵值 (category_codes_for + category_stats)。"""
+    lists = itertools.cycle(_recommendation_lists(recommender, sample_users[:256]))
+
+    def bookkeeping():
+        recommended_product_ids = next(lists)
+        return category_stats(recommender.category_codes_for([recommended_product_ids], len(recommended_product_ids)))
+
+    benchmark(bookkeeping)
+
+
+def bench_batch_category_metrics(benchmark, recommender, sample_users):
+    """批次端點每個區塊的類別指標 (一次向量運算處理整個區塊)。"""
+    lists = _recommendation_lists(recommender, sample_users)
+    benchmark(lambda: category_stats(recommender.category_codes_for(lists, NUM_RECOMMENDATIONS)))
+    benchmark.extra_info['batch_size'] = len(lists)
+
+
+def bench_repetition_ratio(benchmark, recommender, sample_users):
+    """背景指標消費者對每筆推薦的處理：編碼新清單、解碼上一次的清單 (SET ... GET 的結果) 並計算重複率。"""
+    pairs = itertools.cycle(list(zip(
+        _recommendation_lists(recommender, sample_users[:256]),
+        [encode_product_ids(ids) for ids in _recommendation_lists(recommender, sample_users[:256])],
+    )))
+
+    def bookkeeping():
+        recommended_product_ids, previous_raw = next(pairs)
+        encode_product_ids(recommended_product_ids)
+        previous = decode_product_ids(previous_raw)
+        return np.isin(recommended_product_ids, previous).sum() / len(recommended_product_ids)
+
+    benchmark(bookkeeping)
@@ -0,0 +1,52 @@
+import itertools
+
+
+NUM_RECOMMENDATIONS = 10
+BATCH_SIZE = 256
+
+
+def _non_empty(histories):
+    return [(viewed, weights) for viewed, weights in histories if viewed]
+
+
+def bench_single_user_scoring(benchmark, recommender, histories):
+    """單一用戶的向量化評分 (ScoringEngine.recommend)，依序輪流使用抽樣用戶的最近瀏覽。"""
+    engine = recommender.scoring_engine
+    users = itertools.cycle(_non_empty(histories))
+
+    def score():
+        viewed, weights = next(users)
+        return engine.recommend(viewed, NUM_RECOMMENDATIONS, weights)
+
+    benchmark(score)
+    benchmark.extra_info['model_products'] = len(engine.index)
+
+
+def bench_single_user_scoring_v3(benchmark, recommender, sample_users, histories):
+    """v3 的評分 (ALSEngine.recommend)：一次矩陣-向量乘積 + top-k。"""
+    engine = recommender.als_engine
+    users = itertools.cycle(list(zip(sample_users, histories)))
+
+    def score():
+        user_id, (viewed, weights) = next(users)
+        return engine.recommend(user_id, viewed, NUM_RECOMMENDATIONS, weights)
+
+    benchmark(score)
+    benchmark.extra_info.update(model_products=len(engine.model), factors=engine.model.factors)
+
+
+def bench_single_user_recommendation_v1(benchmark, recommender, sample_users):
+    """完整的 v1 推薦路徑 (最近瀏覽 → 評分 → 隨機補充)，不經過結果快取。"""
+    users = itertools.cycle(sample_users)
+    benchmark(lambda: recommender.get_recommendations(next(users), 'v1', NUM_RECOMMENDATIONS))
+
+
+def bench_batch_scoring(benchmark, recommender, histories):
+    """BATCH_SIZE 個用戶以一次稀疏矩陣乘法評分 (ScoringEngine.recommend_batch)。"""
+    engine = recommender.scoring_engine
+    batch = histories[:BATCH_SIZE]
+    viewed_lists = [viewed for viewed, _ in batch]
+    weights = [weights for _, weights in batch]
+
+    benchmark(engine.recommend_batch, viewed_lists, NUM_RECOMMENDATIONS, weights)
+    benchmark.extra_info['batch_size'] = len(batch)
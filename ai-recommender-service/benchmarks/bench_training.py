@@ -0,0 +1,43 @@
+from als import train_als
+from item_similarity import CooccurrenceState, NeighborIndex, DEFAULT_TOP_K, build_neighbor_index, update_neighbor_index
+
+
+# 增量更新基準：最新 0.1% 的事件作為一批新事件 (約為每 5 分鐘一次的增量)，其餘作為既有模型
+INCREMENTAL_FRACTION = 0.001
+
+
+def bench_full_training(benchmark, dataset):
+    """完整重建：互動矩陣 → 共現累加器 → 每個商品的 top-K 鄰居 (ModelTrainer.train 的計算部分)。"""
+    def train():
+        state = CooccurrenceState.from_interactions(dataset.user_ids, dataset.product_ids, dataset.ratings)
+        return build_neighbor_index(state, top_k=DEFAULT_TOP_K)
+
+    neighbor_index = benchmark.pedantic(train, rounds=3, iterations=1, warmup_rounds=0)
+    benchmark.extra_info.update(dataset.describe(), model_products=len(neighbor_index))
+
+
+def bench_incremental_update(benchmark, dataset):
+    """增量更新：將最新一批事件併入累加器，重算被觸及商品並合併其他商品的列表 (ModelTrainer.update_incremental 的計算部分)。"""
+    split = int(dataset.num_events * (1 - INCREMENTAL_FRACTION))
+    base_state = CooccurrenceState.from_interactions(dataset.user_ids[:split], dataset.product_ids[:split], dataset.ratings[:split])
+    base_arrays, base_metadata = build_neighbor_index(base_state, top_k=DEFAULT_TOP_K).to_arrays()
+    state_arrays = base_state.to_arrays()
+    new_events = (dataset.user_ids[split:], dataset.product_ids[split:], dataset.ratings[split:])
+
+    def setup():
+        # 每一輪都從持久化格式還原，與訓練程序的實際流程相同
+        return (CooccurrenceState.from_arrays(state_arrays), NeighborIndex.from_arrays(base_arrays, base_metadata)), {}
+
+    def update(state, previous_index):
+        touched_rows = state.apply_events(*new_events)
+        neighbor_index, updated = update_neighbor_index(previous_index, state, touched_rows, top_k=DEFAULT_TOP_K)
+        return neighbor_index, len(touched_rows), updated
+
+    _, touched, updated = benchmark.pedantic(update, setup=setup, rounds=3, iterations=1)
+    benchmark.extra_info.update(dataset.describe(), new_events=len(new_events[2]), touched_rows=touched, updated_rows=updated)
+
+
+def bench_als_training(benchmark, dataset):
+    """v3 策略的 ALS 模型完整訓練 (分塊共軛梯度，多執行緒)。"""
+    model = benchmark.pedantic(train_als, args=(dataset.user_ids, dataset.product_ids, dataset.ratings), rounds=3, iterations=1)
+    benchmark.extra_info.update(dataset.describe(), model_products=len(model), factors=model.factors)
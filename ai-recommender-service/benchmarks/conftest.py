@@ -0,0 +1,44 @@
+import os
+
+import numpy as np
+import pytest
+
+from benchmarks.harness import train_model, prepare_recommender
+from benchmarks.synthetic import SCALES, generate_scale
+from item_similarity import DEFAULT_TOP_K
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('recommender benchmarks')
+    group.addoption('--bench-scale', default=os.getenv('BENCH_SCALE', 'small'), choices=sorted(SCALES),
+                    help="合成資料規模 (預設 small，亦可用 BENCH_SCALE 設定)")
+    group.addoption('--bench-seed', type=int, default=int(os.getenv('BENCH_SEED', 42)), help="合成資料的亂數種子")
+
+
+@pytest.fixture(scope='session')
+def dataset(request):
+    return generate_scale(request.config.getoption('--bench-scale'), seed=request.config.getoption('--bench-seed'))
+
+
+@pytest.fixture(scope='session')
+def sample_users(dataset):
+    """依事件分佈抽樣的用戶 (固定種子)，單一用戶與批次評分共用。"""
+    return dataset.sample_users(2048).tolist()
+
+
+@pytest.fixture(scope='session')
+def recommender(dataset, sample_users, tmp_path_factory):
+    from recommender import Recommender
+
+    model_dir = str(tmp_path_factory.mktemp('model'))
+    train_model(dataset, model_dir, DEFAULT_TOP_K)
+    instance = Recommender(model_dir=model_dir, top_k=DEFAULT_TOP_K)
+    # 固定亂數種子，使補充與多樣化取樣的成本在每次執行間可比較
+    instance._rng = np.random.default_rng(dataset.seed + 1)
+    return prepare_recommender(instance, dataset, sample_users)
+
+
+@pytest.fixture(scope='session')
+def histories(recommender, sample_users):
+    """sample_users 的 (最近瀏覽商品 ID, 時間衰減權重)。"""
+    return recommender.recent_views.get_many(sample_users)
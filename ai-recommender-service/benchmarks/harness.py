@@ -0,0 +1,70 @@
+import json
+import math
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+
+from als import train_als
+from item_similarity import CooccurrenceState, build_neighbor_index
+from model_store import ModelStore
+
+
+def train_model(dataset, model_dir, top_k):
+    """
+    以與 ModelTrainer.train 相同的步驟訓練合成資料 (相似度模型與 v3 的 ALS 模型) 並寫入 ModelStore，
+    不經過 MySQL 與訓練程序。返回 (模型版本, 訓練秒數)。
+    """
+    start = time.perf_counter()
+    state = CooccurrenceState.from_interactions(dataset.user_ids, dataset.product_ids, dataset.ratings)
+    neighbor_index = build_neighbor_index(state, top_k=top_k)
+    als_model = train_als(dataset.user_ids, dataset.product_ids, dataset.ratings)
+    elapsed = time.perf_counter() - start
+
+    als_arrays, als_metadata = als_model.to_arrays()
+    arrays, metadata = neighbor_index.to_arrays()
+    metadata['high_water_mark'] = 0
+    metadata['als_version'] = ModelStore(model_dir, 'als').save(als_arrays, als_metadata)
+    return ModelStore(model_dir, 'item_similarity').save(arrays, metadata), elapsed
+
+
+def prepare_recommender(recommender, dataset, user_ids=None):
+    """
+    將合成資料載入 Recommender：產品目錄、磁碟上的模型 (memmap)、熱門商品計數與 user_ids 的最近瀏覽 (預先放入本機快取)。
+    模型需先以 train_model 寫入 recommender.model_dir。
+    """
+    recommender._apply_products(dataset.products)
+    recommender.refresh_model()
+    recommender.popularity.counts.add(dataset.product_ids, dataset.ratings, dataset.timestamps)
+    recommender.popularity.rebuild(recommender.catalog)
+    if user_ids is not None:
+        # 壓測時沒有 Redis，預先載入的最近瀏覽不能過期或被擠出本機快取
+        recent_views = dataset.recent_views(user_ids, recommender.recent_views.size)
+        recommender.recent_views.cache_ttl_seconds = math.inf
+        recommender.recent_views.cache_size = max(recommender.recent_views.cache_size, len(recent_views))
+        recommender.recent_views.preload(recent_views)
+    return recommender
+
+
+def environment_info() -> dict:
+    """結果 JSON 中的環境資訊，比較不同 commit 的結果時用來確認是同一台機器。"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=5,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def write_json(path, payload):
+    with open(path, 'w') as f:
+        json.dump(payload, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,172 @@
+"""
+/recommend/{user_id} 的程序內壓測 (httpx ASGITransport，不需要啟動 uvicorn、MySQL 或 Redis)：
+
+    cd ai-recommender-service
+    python -m benchmarks.load_test --scale small --requests 20000 --concurrency 32 --output benchmarks/results/load.json
+    python -m benchmarks.load_test --scale small --compare benchmarks/results/load.json   # 與先前的結果比較
+
+量測的是單一 worker 的處理能力 (事件迴圈 + 推薦計算)，不包含網路與序列化到 socket 的成本。
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.harness import train_model, prepare_recommender, environment_info, write_json
+from benchmarks.synthetic import SCALES, generate_scale
+
+
+def percentile_ms(latencies, q):
+    return float(np.percentile(latencies, q) * 1000) if len(latencies) else None
+
+
+async def drive(app, user_ids, strategy_version, concurrency):
+    """以 concurrency 個並行的客戶端依序送出 user_ids 的請求，返回 (每個請求的延遲秒數, 狀態碼, 總耗時)。"""
+    import httpx
+
+    latencies = np.zeros(len(user_ids), dtype=np.float64)
+    statuses = np.zeros(len(user_ids), dtype=np.int32)
+    next_request = iter(range(len(user_ids)))
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://load-test") as client:
+        async def worker():
+            for i in next_request:
+                start = time.perf_counter()
+                response = await client.get(f"/recommend/{user_ids[i]}", params={'strategy_version': strategy_version})
+                latencies[i] = time.perf_counter() - start
+                statuses[i] = response.status_code
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return latencies, statuses, elapsed
+
+
+@contextlib.contextmanager
+def silenced_service_output():
+    """
+    推薦路徑的 print (stdout) 與抽樣的請求日誌 ('recommendation' logger，寫到 stderr) 都導向 /dev/null，
+    避免淹沒結果；日誌仍會被抽樣與格式化，成本照常計入。
+    """
+    from instrumentation import logger
+
+    handlers = [handler for handler in logger.handlers if isinstance(handler, logging.StreamHandler)]
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        streams = [handler.setStream(devnull) for handler in handlers]
+        try:
+            yield
+        finally:
+            for handler, stream in zip(handlers, streams):
+                if stream is not None:
+                    handler.setStream(stream)
+
+
+def summarize(latencies, statuses, elapsed):
+    ok = statuses == 200
+    return {
+        'requests': int(len(latencies)),
+        'errors': int((~ok).sum()),
+        'rps': len(latencies) / elapsed if elapsed else None,
+        'p50_ms': percentile_ms(latencies[ok], 50),
+        'p90_ms': percentile_ms(latencies[ok], 90),
+        'p99_ms': percentile_ms(latencies[ok], 99),
+        'max_ms': percentile_ms(latencies[ok], 100),
+        'elapsed_seconds': elapsed,
+    }
+
+
+def compare(current, baseline_path):
+    """印出與先前結果 JSON 的差異 (延遲與 RPS 的相對變化)。"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"Compared with {baseline_path} (commit {baseline['environment'].get('commit')}):")
+    for strategy_version, result in current['results'].items():
+        previous = baseline['results'].get(strategy_version)
+        if previous is None:
+            continue
+        for metric in ('rps', 'p50_ms', 'p99_ms'):
+            if result[metric] and previous[metric]:
+                change = (result[metric] - previous[metric]) / previous[metric] * 100
+                print(f"  {strategy_version} {metric}: {previous[metric]:.3f} -> {result[metric]:.3f} ({change:+.1f}%)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="In-process load test for /recommend/{user_id}")
+    parser.add_argument('--scale', default=os.getenv('BENCH_SCALE', 'small'), choices=sorted(SCALES))
+    parser.add_argument('--seed', type=int, default=int(os.getenv('BENCH_SEED', 42)))
+    parser.add_argument('--requests', type=int, default=10000, help="每個策略送出的請求數")
+    parser.add_argument('--warmup', type=int, default=500, help="不計入結果的暖機請求數")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--strategies', default='v1,v2,v3', help="以逗號分隔的策略版本")
+    parser.add_argument('--no-result-cache', action='store_true', help="停用推薦結果快取，量測每個請求的完整計算")
+    parser.add_argument('--output', help="結果 JSON 的輸出路徑")
+    parser.add_argument('--compare', help="要比較的先前結果 JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    model_dir = tempfile.mkdtemp(prefix='recommender-load-test-')
+    try:
+        return run(args, model_dir)
+    finally:
+        shutil.rmtree(model_dir, ignore_errors=True)
+
+
+def run(args, model_dir):
+    # main 在匯入時建立 Recommender，模型目錄需在匯入前指定
+    os.environ['MODEL_DIR'] = model_dir
+    import main as service
+
+    print(f"Generating '{args.scale}' synthetic dataset (seed {args.seed})...")
+    dataset = generate_scale(args.scale, seed=args.seed)
+    version, training_seconds = train_model(dataset, model_dir, service.recommender_instance.top_k)
+    print(f"Trained model {version} in {training_seconds:.2f}s: {dataset.describe()}")
+
+    rng = np.random.default_rng(args.seed)
+    user_ids = dataset.sample_users(args.requests + args.warmup, seed=args.seed).tolist()
+    prepare_recommender(service.recommender_instance, dataset, user_ids)
+    service.recommender_instance._rng = rng
+    if args.no_result_cache:
+        service.recommender_instance.result_cache.ttl_seconds = 0  # 寫入即過期
+
+    results = {}
+    for strategy_version in args.strategies.split(','):
+        with silenced_service_output():
+            asyncio.run(drive(service.app, user_ids[:args.warmup], strategy_version, args.concurrency))
+            latencies, statuses, elapsed = asyncio.run(drive(service.app, user_ids[args.warmup:], strategy_version, args.concurrency))
+        results[strategy_version] = summarize(latencies, statuses, elapsed)
+        result = results[strategy_version]
+        print(f"{strategy_version}: {result['rps']:.0f} req/s, p50 {result['p50_ms']:.2f} ms, "
+              f"p99 {result['p99_ms']:.2f} ms, errors {result['errors']}")
+
+    payload = {
+        'benchmark': 'load_test',
+        'environment': environment_info(),
+        'parameters': {
+            'scale': args.scale, 'requests': args.requests, 'warmup': args.warmup,
+            'concurrency': args.concurrency, 'result_cache': not args.no_result_cache,
+        },
+        'dataset': dataset.describe(),
+        'training_seconds': training_seconds,
+        'results': results,
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        write_json(args.output, payload)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        compare(payload, args.compare)
+    return payload
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
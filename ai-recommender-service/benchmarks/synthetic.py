@@ -0,0 +1,143 @@
+import time
+
+import numpy as np
+
+from trainer import ACTION_RATINGS
+
+
+# 預設的資料規模 (用戶數, 商品數, 事件數)，以 BENCH_SCALE 或 --bench-scale 選擇
+SCALES = {
+    'tiny': (1_000, 1_000, 10_000),
+    'small': (10_000, 10_000, 100_000),
+    'medium': (100_000, 100_000, 1_000_000),
+    'large': (1_000_000, 1_000_000, 10_000_000),
+}
+
+
+def zipf_probabilities(n: int, exponent: float) -> np.ndarray:
+    """排名 r (0 起算) 的機率 ∝ 1 / (r + 1)^exponent。"""
+    weights = 1.0 / np.arange(1, n + 1, dtype=np.float64) ** exponent
+    return weights / weights.sum()
+
+
+def sample_ranks(rng, probabilities, size: int) -> np.ndarray:
+    """依給定的排名機率抽樣 (反 CDF 以 searchsorted 完成，10^7 筆也只需一次向量運算)。"""
+    cdf = np.cumsum(probabilities)
+    return np.minimum(np.searchsorted(cdf, rng.random(size) * cdf[-1], side='right'), len(probabilities) - 1)
+
+
+class SyntheticDataset:
+    """
+    可重現的合成資料，供基準測試與壓測使用 (不需要 MySQL / Redis)：
+    - products: 與 Recommender._load_products_from_mysql 相同格式的 {product_id: info}
+    - user_ids / product_ids / ratings: 與 ModelTrainer._load_user_interactions_from_mysql 相同的平行陣列
+    - timestamps: 每筆事件的 unix 秒 (遞增)，用於產生最近瀏覽
+    用戶活躍度與商品熱門度都服從冪律 (Zipf)；每個用戶偏好少數類別，共現結構才接近真實資料。
+    """
+
+    def __init__(self, products, user_ids, product_ids, ratings, timestamps, seed):
+        self.products = products
+        self.user_ids = user_ids
+        self.product_ids = product_ids
+        self.ratings = ratings
+        self.timestamps = timestamps
+        self.seed = seed
+
+    @property
+    def num_events(self):
+        return len(self.ratings)
+
+    def describe(self) -> dict:
+        return {
+            'seed': self.seed,
+            'num_products': len(self.products),
+            'num_users': int(len(np.unique(self.user_ids))),
+            'num_events': self.num_events,
+        }
+
+    def sample_users(self, size: int, seed=None) -> np.ndarray:
+        """依事件分佈抽樣用戶 (活躍用戶被抽到的機率較高，與線上流量一致)。"""
+        rng = np.random.default_rng(self.seed if seed is None else seed)
+        return self.user_ids[rng.integers(0, self.num_events, size=size)].astype(np.int64)
+
+    def recent_views(self, user_ids, size: int = 20) -> dict:
+        """
+        每個用戶最近 size 筆事件，格式與 Redis 環形緩衝區相同：
+        {user_id: [b"<product_id>:<unix 秒>", ...] (最新在前)}，可直接交給 RecentViewsStore.preload。
+        """
+        user_ids = np.unique(np.asarray(user_ids, dtype=np.int64))
+        selected = np.flatnonzero(np.isin(self.user_ids, user_ids))
+        # 依用戶分組 (stable 保持時間順序)，每組取最後 size 筆並反轉為最新在前
+        selected = selected[np.argsort(self.user_ids[selected], kind='stable')]
+        grouped_users = self.user_ids[selected]
+        boundaries = np.flatnonzero(np.diff(grouped_users)) + 1
+        starts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [len(selected)]])
+        histories = {}
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            events = selected[max(start, end - size):end][::-1]
+            histories[int(grouped_users[start])] = [
+                f"{pid}:{ts}".encode() for pid, ts in zip(self.product_ids[events].tolist(), self.timestamps[events].tolist())
+            ]
+        return histories
+
+
+def generate_dataset(num_users: int, num_products: int, num_events: int, num_categories=None, seed: int = 42,
+                     user_exponent: float = 1.0, product_exponent: float = 1.1, category_affinity: float = 0.7,
+                     max_events_per_user: int = 1000, inactive_ratio: float = 0.05, purchase_ratio: float = 0.1,
+                     span_seconds: int = 30 * 86400, now=None) -> SyntheticDataset:
+    """
+    產生 num_users × num_products × num_events 的合成資料 (10^3 … 10^7 皆可在數秒到數分鐘內完成)。
+    - 用戶活躍度 ~ Zipf(user_exponent)，單一用戶的期望事件數以 max_events_per_user 封頂 (避免共現矩陣爆炸)
+    - 商品熱門度 ~ Zipf(product_exponent)；category_affinity 比例的事件落在用戶偏好的類別內
+    - purchase_ratio 比例的事件為購買 (5 分)，其餘為點擊 (1 分)
+    同一個 seed 產生完全相同的資料。
+    """
+    rng = np.random.default_rng(seed)
+    num_categories = num_categories or max(8, int(np.sqrt(num_products)))
+    # 事件時間相對於產生當下 (最近瀏覽的時間衰減以查詢當下計算)，同一個 seed 的相對時間相同
+    now = int(now if now is not None else time.time())
+
+    # 商品：熱門度排名與 ID 無關 (隨機排列)，類別本身也有熱門度差異
+    product_ids = np.arange(1, num_products + 1, dtype=np.int64)
+    popularity = zipf_probabilities(num_products, product_exponent)[rng.permutation(num_products)]
+    categories = sample_ranks(rng, zipf_probabilities(num_categories, 0.8), num_products)
+    statuses = np.where(rng.random(num_products) < inactive_ratio, 'inactive', 'active')
+    prices = np.round(rng.lognormal(7.0, 1.0, size=num_products), 0)
+    products = {
+        pid: {'name': f"商品 {pid}", 'category_id': f"category-{category}", 'price': price,
+              'image_url': f"https://example.com/products/{pid}.jpg", 'status': status}
+        for pid, category, price, status in zip(product_ids.tolist(), categories.tolist(), prices.tolist(), statuses.tolist())
+    }
+
+    # 用戶：截斷的 Zipf 活躍度 (封頂後重新正規化)
+    user_probabilities = zipf_probabilities(num_users, user_exponent)
+    for _ in range(3):
+        user_probabilities = np.minimum(user_probabilities, max_events_per_user / num_events)
+        user_probabilities /= user_probabilities.sum()
+    user_ids = (rng.permutation(num_users) + 1)[sample_ranks(rng, user_probabilities, num_events)].astype(np.int64)
+
+    # 商品：一部分事件依全站熱門度抽樣，其餘在用戶偏好類別內依熱門度抽樣
+    event_products = sample_ranks(rng, popularity, num_events)
+    preferred_category = rng.integers(0, num_categories, size=num_users + 1)[user_ids]
+    in_category = rng.random(num_events) < category_affinity
+    by_category = np.lexsort((-popularity, categories))
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(categories, minlength=num_categories))])
+    category_of_event = preferred_category[in_category]
+    sizes = offsets[category_of_event + 1] - offsets[category_of_event]
+    has_products = sizes > 0
+    # 類別內以 u^3 偏向熱門商品 (近似冪律)，不需要為每個類別建立 CDF
+    picks = offsets[category_of_event] + (rng.random(len(sizes)) ** 3 * sizes).astype(np.int64)
+    in_category_events = np.flatnonzero(in_category)[has_products]
+    event_products[in_category_events] = by_category[picks[has_products]]
+    event_product_ids = product_ids[event_products]
+
+    ratings = np.where(rng.random(num_events) < purchase_ratio, ACTION_RATINGS['purchase'], ACTION_RATINGS['click']).astype(np.float32)
+    timestamps = np.sort(rng.integers(now - span_seconds, now, size=num_events))
+    return SyntheticDataset(products, user_ids, event_product_ids, ratings, timestamps, seed)
+
+
+def generate_scale(scale: str, seed: int = 42, **kwargs) -> SyntheticDataset:
+    """以 SCALES 中的預設規模產生資料。"""
+    num_users, num_products, num_events = SCALES[scale]
+    return generate_dataset(num_users, num_products, num_events, seed=seed, **kwargs)
@@ -0,0 +1,203 @@
+import copy
+import zlib
+
+import numpy as np
+import pandas as pd
+
+
+# 已下架但仍留在取樣陣列中的商品超過此比例時，重建取樣陣列
+TOMBSTONE_COMPACTION_RATIO = 0.25
+
+
+class CatalogIndex:
+    """
+    產品目錄的緊湊索引，建立後不再修改 (完整同步時重建，增量同步時產生套用變更後的新索引)，請求路徑上只讀取：
+    - product_ids: 所有商品 ID (排序，int64)，category_codes 為對應的類別代碼 (-1 表示沒有類別)
+    - active_mask: 每個商品是否為活躍商品，active_count 為活躍商品數
+    - active_ids: 取樣用的活躍商品 ID；每個類別的活躍商品桶 (bucket_ids 依類別串接，bucket_offsets 為各桶的起點)
+    - fingerprint: 快照內容的指紋
+    商品下架只翻轉新索引 active_mask 中的項目，取樣陣列中的舊項目成為墓碑，取樣時拒絕；
+    墓碑過多或有商品上架時，才由 active_mask 向量化重建取樣陣列。
+    補充與多樣化取樣以拒絕取樣完成，每次請求的成本為 O(k)，與目錄大小無關。
+    """
+
+    def __init__(self, products: dict):
+        product_ids = np.fromiter(products.keys(), dtype=np.int64, count=len(products))
+        category_codes, category_names = pd.factorize(
+            pd.Series([info.get('category_id') for info in products.values()], dtype=object)
+        )
+        active = np.fromiter((info.get('status') == 'active' for info in products.values()), dtype=bool, count=len(products))
+
+        order = np.argsort(product_ids)
+        self.product_ids = product_ids[order]
+        self.category_codes = category_codes[order].astype(np.int64)
+        self.category_names = list(category_names)
+        self._category_code_by_name = {name: code for code, name in enumerate(self.category_names)}
+        self.active_mask = active[order]
+        self._rebuild_sampling_arrays()
+        self._update_fingerprint()
+
+    def _rebuild_sampling_arrays(self):
+        """由 active_mask 重建取樣陣列 (向量化，不走訪 dict)，並清除墓碑。"""
+        self.active_ids = self.product_ids[self.active_mask]
+        self.active_count = len(self.active_ids)
+        self._tombstones = 0
+
+        # 依類別分桶 (沒有類別的商品不進入任何桶，與多樣化只挑有類別的商品一致)
+        active_codes = self.category_codes[self.active_mask]
+        has_category = active_codes >= 0
+        bucket_order = np.argsort(active_codes[has_category], kind='stable')
+        self.bucket_ids = self.active_ids[has_category][bucket_order]
+        counts = np.bincount(active_codes[has_category], minlength=len(self.category_names))
+        self.bucket_offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.non_empty_categories = np.flatnonzero(counts)
+
+    def _update_fingerprint(self):
+        # 產品快照指紋：內容相同的快照 (例如不同 worker 各自同步) 得到相同指紋，供結果快取使用
+        checksum = zlib.crc32(self.product_ids.tobytes())
+        checksum = zlib.crc32(self.active_mask.tobytes(), checksum)
+        self.fingerprint = f"{zlib.crc32(self.category_codes.tobytes(), checksum):08x}"
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def with_changes(self, changed_products: dict):
+        """
+        返回套用增量同步商品變更 (新增、下架、售罄、重新上架、換類別) 後的新索引，原索引不變，
+        仍在使用它的請求與背景工作不受影響。
+        返回 (新索引, 變更的商品 ID, 變更後是否為活躍商品)，供評分引擎更新其活躍遮罩。
+        """
+        catalog = copy.copy(self)
+        catalog.product_ids = self.product_ids.copy()
+        catalog.category_codes = self.category_codes.copy()
+        catalog.active_mask = self.active_mask.copy()
+        catalog.category_names = list(self.category_names)
+        catalog._category_code_by_name = dict(self._category_code_by_name)
+        ids, active = catalog._apply_changes(changed_products)
+        return catalog, ids, active
+
+    def _apply_changes(self, changed_products: dict):
+        """在尚未發佈的新索引上原地套用變更 (只由 with_changes 調用)。"""
+        ids = np.fromiter(changed_products.keys(), dtype=np.int64, count=len(changed_products))
+        active = np.fromiter((info.get('status') == 'active' for info in changed_products.values()), dtype=bool, count=len(ids))
+        codes = np.fromiter((self._category_code(info.get('category_id')) for info in changed_products.values()), dtype=np.int64, count=len(ids))
+        if not len(ids):
+            return ids, active
+
+        positions, known = self._positions(ids)
+        if not known.all():
+            # 新商品先以非活躍狀態插入排序陣列 (一次向量化合併)，再與其他變更一起套用
+            new_ids = np.unique(ids[~known])
+            merged_ids = np.concatenate([self.product_ids, new_ids])
+            order = np.argsort(merged_ids, kind='stable')
+            self.product_ids = merged_ids[order]
+            self.category_codes = np.concatenate([self.category_codes, np.full(len(new_ids), -1, dtype=np.int64)])[order]
+            self.active_mask = np.concatenate([self.active_mask, np.zeros(len(new_ids), dtype=bool)])[order]
+            positions, _ = self._positions(ids)
+
+        was_active = self.active_mask[positions]
+        category_changed = self.category_codes[positions] != codes
+        self.category_codes[positions] = codes
+        self.active_mask[positions] = active
+        self.active_count += int(active.sum()) - int(was_active.sum())
+
+        if (active & (~was_active | category_changed)).any():
+            # 有商品上架或換類別時，取樣陣列需要新增項目
+            self._rebuild_sampling_arrays()
+        else:
+            self._tombstones += int((was_active & ~active).sum())
+            if self._tombstones > TOMBSTONE_COMPACTION_RATIO * len(self.active_ids):
+                self._rebuild_sampling_arrays()
+        self._update_fingerprint()
+        return ids, active
+
+    def _category_code(self, category_name):
+        if category_name is None:
+            return -1
+        code = self._category_code_by_name.get(category_name)
+        if code is None:
+            code = len(self.category_names)
+            self.category_names.append(category_name)
+            self._category_code_by_name[category_name] = code
+        return code
+
+    def _positions(self, product_ids):
+        """返回 (在 product_ids 中的位置, 是否存在於目錄)。"""
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        if not len(self.product_ids):
+            return np.zeros(len(product_ids), dtype=np.int64), np.zeros(len(product_ids), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.product_ids, product_ids), len(self.product_ids) - 1)
+        return positions, self.product_ids[positions] == product_ids
+
+    def is_active(self, product_ids):
+        """向量化查詢一組商品是否為活躍商品，不在目錄中的商品視為非活躍。"""
+        positions, known = self._positions(product_ids)
+        return known & self.active_mask[positions] if len(self.product_ids) else known
+
+    def _live(self, product_ids):
+        """過濾掉取樣陣列中的墓碑 (已下架商品)。"""
+        return product_ids[self.is_active(product_ids)] if self._tombstones else product_ids
+
+    def category_codes_for(self, recommendation_lists, width: int):
+        """將多份推薦清單轉為 U×width 的類別代碼矩陣，未知商品與填補位置為 -1。"""
+        codes = np.full((len(recommendation_lists), width), -1, dtype=np.int64)
+        lengths = np.fromiter((min(len(ids), width) for ids in recommendation_lists), dtype=np.int64, count=len(recommendation_lists))
+        if not len(self.product_ids) or not lengths.sum():
+            return codes
+        product_ids = np.fromiter((pid for ids in recommendation_lists for pid in ids[:width]), dtype=np.int64, count=int(lengths.sum()))
+        positions, known = self._positions(product_ids)
+        rows = np.repeat(np.arange(len(recommendation_lists)), lengths)
+        cols = np.arange(len(product_ids)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        codes[rows, cols] = np.where(known, self.category_codes[positions], -1)
+        return codes
+
+    def sample_active(self, k: int, exclude, rng) -> list:
+        """
+        隨機取 k 個不在 exclude 中的活躍商品 (不重複)。
+        排除的商品只佔目錄一小部分時以拒絕取樣完成 (期望 O(k))；否則退回一次集合差運算。
+        """
+        exclude = set(exclude)
+        if k <= 0 or not self.active_count:
+            return []
+        if 2 * (k + len(exclude)) > self.active_count:
+            candidates = np.setdiff1d(self._live(self.active_ids), np.fromiter(exclude, dtype=np.int64, count=len(exclude)), assume_unique=True)
+            return rng.permutation(candidates)[:k].tolist()
+
+        selected = []
+        seen = set(exclude)
+        while len(selected) < k:
+            # 每輪多抽一些，補償被拒絕的樣本 (已排除的商品與墓碑)
+            draws = self._live(self.active_ids[rng.integers(0, len(self.active_ids), size=2 * (k - len(selected)))])
+            for pid in draws.tolist():
+                if pid not in seen:
+                    seen.add(pid)
+                    selected.append(pid)
+                    if len(selected) == k:
+                        break
+        return selected
+
+    def sample_diverse(self, k: int, exclude, rng, max_attempts: int = 8) -> list:
+        """
+        從 k 個不同的隨機類別中各取一個不在 exclude 中的活躍商品，成本為 O(k)。
+        某個類別的商品都被排除 (或都已下架) 時略過該類別。
+        """
+        exclude = set(exclude)
+        selected = []
+        if k <= 0 or not len(self.non_empty_categories):
+            return selected
+        # 有放回地抽類別再去重，避免對全部類別做無放回抽樣
+        draws = self.non_empty_categories[rng.integers(0, len(self.non_empty_categories), size=4 * k)]
+        categories = list(dict.fromkeys(draws.tolist()))
+        starts = self.bucket_offsets[categories]
+        sizes = self.bucket_offsets[np.asarray(categories) + 1] - starts
+        # 每個類別一次抽 max_attempts 個候選，全部在一次向量運算中完成
+        candidates = self.bucket_ids[starts[:, None] + (rng.random((len(categories), max_attempts)) * sizes[:, None]).astype(np.int64)]
+        live = self.is_active(candidates.ravel()).reshape(candidates.shape) if self._tombstones else np.ones(candidates.shape, dtype=bool)
+        for row, row_live in zip(candidates.tolist(), live.tolist()):
+            for pid, is_live in zip(row, row_live):
+                if is_live and pid not in exclude:
+                    selected.append(pid)
+                    break
+            if len(selected) == k:
+                break
+        return selected
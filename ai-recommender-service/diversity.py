@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+
+
+# MMR 的相關性權重 λ：1 為只看相關性 (等同 v1)，0 為只看多樣性
+MMR_LAMBDA = float(os.getenv('MMR_LAMBDA', 0.7))
+# 同類別商品之間的冗餘度 (商品相似度之外的下限)
+MMR_CATEGORY_SIMILARITY = float(os.getenv('MMR_CATEGORY_SIMILARITY', 0.5))
+# 參與重排的相似度候選數 (至少為推薦數的兩倍)
+MMR_CANDIDATES = int(os.getenv('MMR_CANDIDATES', 50))
+
+
+def neighbor_similarity_lookup(neighbor_indices, neighbor_scores, candidate_rows):
+    """
+    返回 similarity(j)：候選 j 與其他候選的預先計算相似度 (候選位置, 相似度)，
+    只查 j 的 K 個鄰居 (以 searchsorted 對應到候選位置)，成本 O(K·log C)。
+    candidate_rows 中的 -1 表示不在模型中的商品 (沒有鄰居)。
+    """
+    candidate_rows = np.asarray(candidate_rows, dtype=np.int64)
+    order = np.argsort(candidate_rows, kind='stable')
+    sorted_rows = candidate_rows[order]
+
+    def similarity(position):
+        row = candidate_rows[position]
+        if row < 0 or not len(sorted_rows):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        neighbors = np.asarray(neighbor_indices[row])
+        scores = np.asarray(neighbor_scores[row])
+        found = np.minimum(np.searchsorted(sorted_rows, neighbors), len(sorted_rows) - 1)
+        match = (sorted_rows[found] == neighbors) & (neighbors >= 0)
+        return order[found[match]], scores[match]
+
+    return similarity
+
+
+def maximal_marginal_relevance(relevance, category_codes, k, lam=MMR_LAMBDA, similarity=None,
+                               category_similarity=MMR_CATEGORY_SIMILARITY):
+    """
+    Maximal Marginal Relevance (Carbonell & Goldstein 1998)：依序選出 k 個候選，每一步選
+        argmax_i  λ·relevance_i − (1−λ)·max_{j∈已選} redundancy(i, j)
+    redundancy 為預先計算的商品相似度 (similarity，見 neighbor_similarity_lookup) 與同類別的冗餘度 (category_similarity) 取大者。
+    每選一個候選只以 O(C) 的向量運算更新各候選的最大冗餘度，總成本 O(C·k)，不建立 C×C 矩陣。
+    同分時選位置較前 (相關性較高) 的候選，結果是確定的。
+    返回選中的候選位置 (依選擇順序)；category_codes[選中位置] 可直接交給 category_stats 計算多樣性與熵值。
+    """
+    relevance = np.asarray(relevance, dtype=np.float64)
+    category_codes = np.asarray(category_codes, dtype=np.int64)
+    k = min(k, len(relevance))
+    selected = np.empty(k, dtype=np.int64)
+    if k <= 0:
+        return selected
+    # 相關性正規化到 [0, 1]，λ 的意義才與分數尺度無關
+    top = relevance.max()
+    relevance = relevance / top if top > 0 else np.zeros_like(relevance)
+
+    marginal = lam * relevance
+    max_redundancy = np.zeros(len(relevance), dtype=np.float64)
+    available = np.ones(len(relevance), dtype=bool)
+    for step in range(k):
+        choice = int(np.argmax(np.where(available, marginal - (1 - lam) * max_redundancy, -np.inf)))
+        selected[step] = choice
+        available[choice] = False
+        code = category_codes[choice]
+        if code >= 0:
+            np.maximum(max_redundancy, np.where(category_codes == code, category_similarity, 0.0), out=max_redundancy)
+        if similarity is not None:
+            positions, scores = similarity(choice)
+            max_redundancy[positions] = np.maximum(max_redundancy[positions], scores)
+    return selected
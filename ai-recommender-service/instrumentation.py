@@ -0,0 +1,132 @@
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from prometheus_client import Gauge, Histogram
+
+
+# 每個請求的結構化日誌只記錄這個比例 (0 關閉、1 全部)；INFO 以上的非請求日誌不受影響
+REQUEST_LOG_SAMPLE_RATE = float(os.getenv('REQUEST_LOG_SAMPLE_RATE', 0.01))
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# /debug/profile 預設關閉 (會暴露程式碼結構並短暫增加負載)
+DEBUG_PROFILE_ENABLED = os.getenv('DEBUG_PROFILE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+DEBUG_PROFILE_MAX_SECONDS = float(os.getenv('DEBUG_PROFILE_MAX_SECONDS', 30))
+STRATEGY_LABELS = ('v1', 'v2', 'v3')
+
+# 熱路徑的階段多在數十微秒到數毫秒之間，預設的 bucket (5ms 起) 太粗
+STAGE_LATENCY = Histogram(
+    'recommendation_stage_duration_seconds', 'Latency of each recommendation pipeline stage', ['stage', 'strategy_version'],
+    buckets=[0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0],
+)
+MODEL_SIZE_BYTES = Gauge('model_size_bytes', 'Size of the loaded model arrays', ['model'])
+MODEL_TRAINING_DURATION = Gauge('model_training_duration_seconds', 'Wall time of the last completed training job', ['job'])
+MODEL_LAST_SWAP_AGE = Gauge('model_last_swap_age_seconds', 'Seconds since a model version was last swapped in', ['model'])
+
+logger = logging.getLogger('recommendation')
+_stage_children = {}
+
+
+def configure_logging():
+    """
+    服務入口呼叫一次：只為 'recommendation' logger 設定輸出與 LOG_LEVEL，不改動 root logger，
+    第三方套件 (httpx 等) 的日誌維持其預設等級。
+    """
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+
+def log_sampled(level, event, **fields):
+    """
+    每個請求都會呼叫的結構化日誌：先以 REQUEST_LOG_SAMPLE_RATE 抽樣，再檢查等級，
+    未被抽中或等級不足時不做任何字串格式化。欄位以單行 JSON 輸出。
+    """
+    if random.random() >= REQUEST_LOG_SAMPLE_RATE or not logger.isEnabledFor(level):
+        return
+    logger.log(level, json.dumps({'event': event, **fields}, ensure_ascii=False, default=str))
+
+
+def _stage_histogram(stage, strategy_version):
+    # 快取帶標籤的子指標 (labels() 每次都要查表並上鎖)；未知的策略合併為 other，避免標籤爆炸
+    key = (stage, strategy_version)
+    child = _stage_children.get(key)
+    if child is None:
+        label = strategy_version if strategy_version in STRATEGY_LABELS or strategy_version == 'all' else 'other'
+        child = _stage_children[key] = STAGE_LATENCY.labels(stage=stage, strategy_version=label)
+    return child
+
+
+def observe_stage(stage, strategy_version, seconds):
+    _stage_histogram(stage, strategy_version).observe(seconds)
+
+
+@contextmanager
+def timed_stage(stage, strategy_version='all'):
+    """記錄區塊的執行時間到 recommendation_stage_duration_seconds。"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _stage_histogram(stage, strategy_version).observe(time.perf_counter() - start)
+
+
+def record_model_swap(model, arrays):
+    """換上新模型時更新該模型 (item_similarity、als、materialized) 的大小與最後替換時間。"""
+    MODEL_SIZE_BYTES.labels(model=model).set(sum(int(array.nbytes) for array in arrays.values()))
+    swapped_at = time.time()
+    MODEL_LAST_SWAP_AGE.labels(model=model).set_function(lambda: time.time() - swapped_at)
+
+
+def _collapse_stack(frame, thread_name):
+    """將一個執行緒的堆疊轉為 collapsed 格式 (由外而內以分號分隔，可直接交給 flamegraph.pl / speedscope)。"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    names.append(thread_name)
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    不需額外依賴的取樣分析器：每 interval 秒以 sys._current_frames 取得所有執行緒的堆疊並計數，
+    持續 seconds 秒。分析在呼叫端的執行緒中進行，被分析的 worker 照常處理請求；同一時間只允許一次分析。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def profile(self, seconds, interval):
+        """返回 (取樣次數, {collapsed 堆疊: 次數})；已有分析在進行時返回 None。"""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            own_thread = threading.get_ident()
+            stacks = Counter()
+            samples = 0
+            deadline = time.perf_counter() + min(seconds, DEBUG_PROFILE_MAX_SECONDS)
+            while time.perf_counter() < deadline:
+                thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != own_thread:
+                        stacks[_collapse_stack(frame, thread_names.get(thread_id, f"thread-{thread_id}"))] += 1
+                samples += 1
+                time.sleep(interval)
+            return samples, stacks
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def format_collapsed(stacks):
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
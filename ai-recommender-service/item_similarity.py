@@ -0,0 +1,312 @@
+import numpy as np
+import scipy.sparse as sp
+
+
+# 每個商品保留的最相似鄰居數
+DEFAULT_TOP_K = 50
+
+
+class NeighborIndex:
+    """
+    商品相似度模型：每個商品只保留 top-K 鄰居。
+    - product_ids: 第 i 列對應的商品 ID (int64)
+    - neighbor_indices: N×K 的鄰居列索引 (int32)，不足 K 個時以 -1 填補
+    - neighbor_scores: N×K 的 cosine 相似度 (float32)，依分數遞減排序，填補處為 0
+    - product_order: 依商品 ID 排序的列索引 (增量更新把新商品附加在尾端，列不一定依 ID 排序)，
+      商品 ID → 列以 searchsorted 查詢，所有陣列都可直接 memmap，各 worker 不需另建對照表
+    記憶體用量為 O(N·K)，而非稠密矩陣的 O(N²)。
+    """
+
+    def __init__(self, product_ids, neighbor_indices, neighbor_scores, product_order=None):
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)
+        self.neighbor_indices = np.asarray(neighbor_indices, dtype=np.int32)
+        self.neighbor_scores = np.asarray(neighbor_scores, dtype=np.float32)
+        if product_order is None:
+            product_order = np.argsort(self.product_ids, kind='stable')
+        self.product_order = np.asarray(product_order, dtype=np.int64)
+
+    @classmethod
+    def empty(cls, top_k=DEFAULT_TOP_K):
+        return cls(np.empty(0, dtype=np.int64),
+                   np.empty((0, top_k), dtype=np.int32),
+                   np.empty((0, top_k), dtype=np.float32))
+
+    @property
+    def is_empty(self):
+        return len(self.product_ids) == 0
+
+    @property
+    def top_k(self):
+        return self.neighbor_indices.shape[1]
+
+    def to_arrays(self):
+        """返回 (可寫入 ModelStore 的陣列, header metadata)。商品 ID 與排序也以陣列保存，載入時直接 memmap。"""
+        arrays = {'product_ids': self.product_ids, 'product_order': self.product_order,
+                  'neighbor_indices': self.neighbor_indices, 'neighbor_scores': self.neighbor_scores}
+        return arrays, {'top_k': self.top_k}
+
+    @classmethod
+    def from_arrays(cls, arrays, metadata):
+        """由 ModelStore 載入的 (memmap) 陣列重建索引，陣列不會被複製 (舊版本的商品 ID 在 header 中)。"""
+        if 'product_ids' not in arrays:
+            return cls(np.asarray(metadata['product_ids'], dtype=np.int64), arrays['neighbor_indices'], arrays['neighbor_scores'])
+        return cls(arrays['product_ids'], arrays['neighbor_indices'], arrays['neighbor_scores'], arrays['product_order'])
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def rows_for(self, product_ids):
+        """將商品 ID 轉為模型列索引，不在模型中的商品會被略過。返回 (rows, 對應的原始位置)。"""
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        if not len(self.product_ids) or not len(product_ids):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        sorted_positions = np.searchsorted(self.product_ids, product_ids, sorter=self.product_order)
+        rows = self.product_order[np.minimum(sorted_positions, len(self.product_ids) - 1)]
+        positions = np.flatnonzero(self.product_ids[rows] == product_ids)
+        return rows[positions], positions
+
+    def neighbors_of(self, product_id):
+        """返回某商品的 (鄰居商品 ID, 相似度)，商品不在模型中時返回空陣列。"""
+        rows, _ = self.rows_for([product_id])
+        if not len(rows):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        row = rows[0]
+        valid = self.neighbor_indices[row] >= 0
+        return self.product_ids[self.neighbor_indices[row][valid]], self.neighbor_scores[row][valid]
+
+
+def build_interaction_matrix(user_ids, product_ids, ratings):
+    """
+    將平行的 (user_id, product_id, rating) 陣列直接以 COO→CSR 轉成 user×product 的稀疏矩陣，
+    同一用戶對同一商品的多筆評分會相加。返回 (matrix, 排序後的 user_ids, 排序後的 product_ids)。
+    """
+    unique_users, user_codes = np.unique(user_ids, return_inverse=True)
+    unique_products, product_codes = np.unique(product_ids, return_inverse=True)
+    matrix = sp.coo_matrix(
+        (np.asarray(ratings, dtype=np.float32), (user_codes, product_codes)),
+        shape=(len(unique_users), len(unique_products))
+    ).tocsr()
+    matrix.sum_duplicates()
+    return matrix, unique_users.astype(np.int64), unique_products.astype(np.int64)
+
+
+def top_k_per_row(matrix, k):
+    """
+    對 CSR 矩陣的每一列取分數最高的 k 個欄位 (同分時欄位索引小者優先)。
+    返回 (依列串接的欄位索引, 對應分數, 每列取得的數量)。
+    """
+    counts = np.diff(matrix.indptr)
+    row_ids = np.repeat(np.arange(matrix.shape[0]), counts)
+    order = np.lexsort((matrix.indices, -matrix.data, row_ids))
+    rank = np.arange(len(order)) - matrix.indptr[row_ids[order]]
+    keep = order[rank < k]
+    return matrix.indices[keep], matrix.data[keep], np.minimum(counts, k)
+
+
+class CooccurrenceState:
+    """
+    增量訓練用的累加器：
+    - 基底 B：完整重建時的 user×item 評分矩陣 (CSR, float32)，同時保存轉置 Bᵀ (item×user) 與各商品向量長度的平方。
+      基底只在完整重建時寫入一次，增量訓練以 memmap 唯讀映射，不複製也不重寫
+    - 增量 D：之後各批新事件的累加 (稀疏，通常遠小於 B)
+    目前的評分矩陣為 X = B + D。共現矩陣 C = XᵀX 不落地，計算鄰居時才分塊求出所需的列
+    C[rows] = X[:, rows]ᵀ·X = (Bᵀ[rows] + Dᵀ[rows])·(B + D)，只會讀到與這些商品有互動的用戶的列。
+    新用戶與新商品附加在尾端，基底的矩陣以補零的 indptr 擴展形狀，既有列索引不變。
+    """
+
+    def __init__(self, user_ids, product_ids, interactions, item_interactions, squared_norms):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)
+        self.interactions = interactions
+        self.item_interactions = item_interactions
+        self.base_squared_norms = np.asarray(squared_norms, dtype=np.float64)
+        self.base_users, self.base_items = interactions.shape
+        self.delta = sp.csr_matrix((len(self.user_ids), len(self.product_ids)), dtype=np.float32)
+        self._squared_norms = None
+
+    @classmethod
+    def from_interactions(cls, user_ids, product_ids, ratings):
+        """完整重建：由全部互動資料建立基底。"""
+        matrix, user_ids, product_ids = build_interaction_matrix(user_ids, product_ids, ratings)
+        squared_norms = np.asarray(matrix.multiply(matrix).sum(axis=0), dtype=np.float64).ravel()
+        return cls(user_ids, product_ids, matrix, matrix.T.tocsr(), squared_norms)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """由 ModelStore 載入的 (memmap) 陣列還原基底，陣列不會被複製。"""
+        shape = (len(arrays['user_ids']), len(arrays['product_ids']))
+        interactions = sp.csr_matrix(
+            (arrays['interactions_data'], arrays['interactions_indices'], arrays['interactions_indptr']), shape=shape
+        )
+        item_interactions = sp.csr_matrix(
+            (arrays['item_interactions_data'], arrays['item_interactions_indices'], arrays['item_interactions_indptr']), shape=shape[::-1]
+        )
+        return cls(arrays['user_ids'], arrays['product_ids'], interactions, item_interactions, arrays['squared_norms'])
+
+    def to_arrays(self):
+        """基底的陣列 (只在完整重建後寫入；之後的增量由呼叫端另外以事件保存)。"""
+        return {
+            'user_ids': self.user_ids[:self.base_users],
+            'product_ids': self.product_ids[:self.base_items],
+            'interactions_data': self.interactions.data,
+            'interactions_indices': self.interactions.indices,
+            'interactions_indptr': self.interactions.indptr,
+            'item_interactions_data': self.item_interactions.data,
+            'item_interactions_indices': self.item_interactions.indices,
+            'item_interactions_indptr': self.item_interactions.indptr,
+            'squared_norms': self.base_squared_norms,
+        }
+
+    def apply_events(self, user_ids, product_ids, ratings):
+        """
+        將新的 (user_id, product_id, rating) 互動併入增量 D。新用戶與新商品會附加在尾端，既有列索引不變。
+        返回被觸及 (向量改變) 的商品列。
+        """
+        user_rows = self._extend_ids('user_ids', np.asarray(user_ids, dtype=np.int64))
+        item_rows = self._extend_ids('product_ids', np.asarray(product_ids, dtype=np.int64))
+        shape = (len(self.user_ids), len(self.product_ids))
+        self.delta.resize(shape)
+        batch = sp.coo_matrix((np.asarray(ratings, dtype=np.float32), (user_rows, item_rows)), shape=shape).tocsr()
+        self.delta = (self.delta + batch).tocsr()
+        self._squared_norms = None
+        return np.unique(item_rows).astype(np.int64)
+
+    def _extend_ids(self, attribute, ids):
+        """將 ids 對應到列索引，不存在的 ID 附加到尾端。"""
+        known = getattr(self, attribute)
+        unique_ids = np.unique(ids)
+        new_ids = np.setdiff1d(unique_ids, known, assume_unique=True)
+        extended = np.concatenate([known, new_ids])
+        setattr(self, attribute, extended)
+        order = np.argsort(extended, kind='stable')
+        return order[np.searchsorted(extended, ids, sorter=order)]
+
+    @staticmethod
+    def _padded(matrix, shape):
+        """將基底矩陣擴展為 shape (尾端補空列、欄數放寬)，共用原本的 data/indices，只配置新的 indptr。"""
+        indptr = matrix.indptr
+        if shape[0] > matrix.shape[0]:
+            indptr = np.concatenate([indptr, np.full(shape[0] - matrix.shape[0], indptr[-1], dtype=indptr.dtype)])
+        return sp.csr_matrix((matrix.data, matrix.indices, indptr), shape=shape)
+
+    def _item_vectors(self, rows, base_t, delta_t):
+        """X[:, rows]ᵀ：指定商品的用戶向量 (len(rows)×U)。"""
+        vectors = base_t[rows]
+        if delta_t.nnz:
+            vectors = vectors + delta_t[rows]
+        return vectors.tocsr()
+
+    def squared_norms(self, base_t=None, delta_t=None):
+        """目前各商品向量長度的平方 (C 的對角線)；只有增量中出現的商品需要重新計算。"""
+        if self._squared_norms is None:
+            n_users, n_items = len(self.user_ids), len(self.product_ids)
+            squared_norms = np.zeros(n_items, dtype=np.float64)
+            squared_norms[:self.base_items] = self.base_squared_norms
+            changed = np.unique(self.delta.indices)
+            if len(changed):
+                base_t = self._padded(self.item_interactions, (n_items, n_users)) if base_t is None else base_t
+                delta_t = self.delta.T.tocsr() if delta_t is None else delta_t
+                vectors = self._item_vectors(changed, base_t, delta_t)
+                squared_norms[changed] = np.asarray(vectors.multiply(vectors).sum(axis=1), dtype=np.float64).ravel()
+            self._squared_norms = squared_norms
+        return self._squared_norms
+
+    def similarity_blocks(self, rows, block_rows=4096):
+        """
+        分塊產生指定商品列的 cosine 相似度 (C_ij / (‖i‖·‖j‖))：每次 yield (區塊的商品列, len(區塊)×N 的 CSR)，
+        已排除自身與相似度為 0 的商品。峰值記憶體與區塊大小成正比，而非整個 C。
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        n_users, n_items = len(self.user_ids), len(self.product_ids)
+        base = self._padded(self.interactions, (n_users, n_items))
+        base_t = self._padded(self.item_interactions, (n_items, n_users))
+        delta_t = self.delta.T.tocsr()
+        norms = np.sqrt(self.squared_norms(base_t, delta_t))
+        norms[norms == 0] = 1
+
+        for start in range(0, len(rows), block_rows):
+            block = rows[start:start + block_rows]
+            vectors = self._item_vectors(block, base_t, delta_t)
+            sub = vectors @ base
+            if self.delta.nnz:
+                sub = sub + vectors @ self.delta
+            sub = sub.tocsr()
+            row_ids = np.repeat(np.arange(len(block)), np.diff(sub.indptr))
+            data = sub.data.astype(np.float64) / (norms[block][row_ids] * norms[sub.indices])
+            data[sub.indices == block[row_ids]] = 0
+            sub = sp.csr_matrix((data, sub.indices, sub.indptr), shape=sub.shape)
+            sub.eliminate_zeros()
+            yield block, sub
+
+    def compute_neighbors(self, rows, top_k=DEFAULT_TOP_K, block_rows=4096):
+        """計算指定商品列的 top-K cosine 鄰居，返回 (len(rows)×K 的鄰居索引, len(rows)×K 的分數)。"""
+        rows = np.asarray(rows, dtype=np.int64)
+        neighbor_indices = np.full((len(rows), top_k), -1, dtype=np.int32)
+        neighbor_scores = np.zeros((len(rows), top_k), dtype=np.float32)
+        start = 0
+        for block, sub in self.similarity_blocks(rows, block_rows):
+            _write_top_k(neighbor_indices, neighbor_scores, np.arange(start, start + len(block)), sub, top_k)
+            start += len(block)
+        return neighbor_indices, neighbor_scores
+
+
+def _write_top_k(neighbor_indices, neighbor_scores, rows, matrix, top_k):
+    """將 matrix 每一列的 top-K 寫入鄰居陣列的 rows 列 (先清空這些列)。"""
+    neighbor_indices[rows] = -1
+    neighbor_scores[rows] = 0
+    top, top_scores, counts = top_k_per_row(matrix, top_k)
+    out_rows = np.repeat(rows, counts)
+    out_cols = np.arange(len(top)) - np.repeat(np.cumsum(counts) - counts, counts)
+    neighbor_indices[out_rows, out_cols] = top
+    neighbor_scores[out_rows, out_cols] = top_scores
+
+
+def build_neighbor_index(state: CooccurrenceState, top_k=DEFAULT_TOP_K):
+    """完整重建：計算每個商品的 top-K 鄰居。"""
+    all_rows = np.arange(len(state.product_ids))
+    neighbor_indices, neighbor_scores = state.compute_neighbors(all_rows, top_k=top_k)
+    return NeighborIndex(state.product_ids, neighbor_indices, neighbor_scores)
+
+
+def update_neighbor_index(previous: NeighborIndex, state: CooccurrenceState, touched_rows, top_k=DEFAULT_TOP_K):
+    """
+    增量更新：只有被觸及商品 T 的向量改變，因此
+    - T 的鄰居列表以 C[T] 完整重算
+    - 其他商品 i 只有與 T 的相似度改變：從原列表移除 T，併入新的 sim(i, T) 後重取 top-K
+      (sim(i, T) 即 C[T] 的轉置，不需另外計算)；原本排在 K 名之外的候選不會遞補，下次完整重建時校正
+    沒有與 T 共現的商品列表原樣沿用。返回 (新索引, 更新了列表的商品數)。
+    """
+    touched_rows = np.asarray(touched_rows, dtype=np.int64)
+    n_items = len(state.product_ids)
+    neighbor_indices = np.full((n_items, top_k), -1, dtype=np.int32)
+    neighbor_scores = np.zeros((n_items, top_k), dtype=np.float32)
+    width = min(top_k, previous.top_k)
+    neighbor_indices[:len(previous), :width] = previous.neighbor_indices[:, :width]
+    neighbor_scores[:len(previous), :width] = previous.neighbor_scores[:, :width]
+    if not len(touched_rows):
+        return NeighborIndex(state.product_ids, neighbor_indices, neighbor_scores), 0
+
+    touched = np.zeros(n_items, dtype=bool)
+    touched[touched_rows] = True
+    other_rows, other_cols, other_scores = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.float64)]
+    for block, sub in state.similarity_blocks(touched_rows):
+        _write_top_k(neighbor_indices, neighbor_scores, block, sub, top_k)
+        entries = sub.tocoo()
+        keep = ~touched[entries.col]
+        other_rows.append(entries.col[keep].astype(np.int64))
+        other_cols.append(block[entries.row[keep]])
+        other_scores.append(entries.data[keep])
+    other_rows, other_cols, other_scores = np.concatenate(other_rows), np.concatenate(other_cols), np.concatenate(other_scores)
+
+    affected = np.unique(other_rows)
+    if len(affected):
+        kept_indices = neighbor_indices[affected]
+        kept = (kept_indices >= 0) & ~touched[np.maximum(kept_indices, 0)]
+        merged = sp.csr_matrix(
+            (np.concatenate([neighbor_scores[affected][kept].astype(np.float64), other_scores]),
+             (np.concatenate([np.nonzero(kept)[0], np.searchsorted(affected, other_rows)]),
+              np.concatenate([kept_indices[kept].astype(np.int64), other_cols]))),
+            shape=(len(affected), n_items)
+        )
+        _write_top_k(neighbor_indices, neighbor_scores, affected, merged, top_k)
+    return NeighborIndex(state.product_ids, neighbor_indices, neighbor_scores), len(touched_rows) + len(affected)
@@ -1,25 +1,31 @@
 import os
+from typing import Optional
 import uvicorn
 from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from recommender import Recommender
+from recommendation_metrics import category_stats
+from metrics_recorder import RecommendationMetricsRecorder
+from instrumentation import DEBUG_PROFILE_ENABLED, SamplingProfiler, configure_logging
 from prometheus_client import make_wsgi_app, Counter, Histogram, Gauge
 from starlette.middleware.wsgi import WSGIMiddleware
 import time
 import json
-import redis
-from collections import Counter as PyCounter
-from math import log2
+import numpy as np
 from apscheduler.schedulers.asyncio import AsyncIOScheduler # 新增
 import asyncio # 新增
 
+configure_logging()
+
 # 初始化 FastAPI 應用 
 app = FastAPI(title="AI Recommendation Service", version="1.0.0")
 
 # 將 Prometheus 指標暴露在 /metrics 路徑 
 app.mount("/metrics", WSGIMiddleware(make_wsgi_app()))
 
-# 初始化推薦器實例 (這會在應用啟動時載入模型或訓練啞模型)
+# 初始化推薦器實例 (產品資料與模型在 startup_event 中載入，訓練在背景程序中進行)
 recommender_instance = Recommender()
 
 # 初始化 Prometheus 指標
@@ -32,44 +38,87 @@ RECOMMENDATION_ENTROPY = Gauge('recommendation_entropy', 'Entropy of Recommendat
 RECOMMENDATION_REPETITION_RATIO = Gauge('recommendation_repetition_ratio', 'Ratio of Repeated Products in Consecutive Recommendations', ['endpoint', 'strategy_version'])
 RECOMMENDATION_COLD_START_TOTAL = Counter('recommendation_cold_start_total', 'Total Cold Start Recommendations', ['endpoint', 'strategy_version'])
 RECOMMENDATION_CATALOG_COVERAGE = Gauge('recommendation_catalog_coverage_ratio', 'Ratio of Unique Products Recommended vs Total Catalog', ['endpoint', 'strategy_version'])
-
-# Redis client for repetition tracking and catalog coverage (ensure it's initialized correctly)
-try:
-    redis_client = redis.Redis(host=os.getenv('REDIS_HOST', 'redis'), port=int(os.getenv('REDIS_PORT', 6379)), db=0)
-    redis_client.ping()
-    print("Successfully connected to Redis.")
-except redis.exceptions.ConnectionError as e:
-    print(f"Could not connect to Redis: {e}. Some metrics might be affected.")
-    redis_client = None
-
-RECOMMENDED_PRODUCTS_SET_KEY_PREFIX = "all_recommended_products"
+RECOMMENDATION_METRICS_DROPPED_TOTAL = Counter('recommendation_metrics_dropped_total', 'Recommendation metric events dropped because the recording queue was full')
+
+# 重複率與目錄覆蓋率需要 Redis，在回應送出後由背景消費者以 async pipeline 批次寫入
+metrics_recorder = RecommendationMetricsRecorder(
+    RECOMMENDATION_REPETITION_RATIO,
+    RECOMMENDATION_CATALOG_COVERAGE,
+    RECOMMENDATION_METRICS_DROPPED_TOTAL,
+    lambda: recommender_instance.active_product_count,
+)
+
+# 批次推薦時每次以一個稀疏矩陣乘法評分的用戶數
+BATCH_CHUNK_SIZE = int(os.getenv('BATCH_CHUNK_SIZE', 2048))
+MAX_BATCH_USERS = int(os.getenv('MAX_BATCH_USERS', 1_000_000))
+# 每個用戶的推薦數上限 (類別代碼矩陣為 區塊用戶數×num_recommendations)
+MAX_NUM_RECOMMENDATIONS = int(os.getenv('MAX_NUM_RECOMMENDATIONS', 100))
+MODEL_REFRESH_SECONDS = int(os.getenv('MODEL_REFRESH_SECONDS', 30))
+INCREMENTAL_UPDATE_MINUTES = int(os.getenv('INCREMENTAL_UPDATE_MINUTES', 5))
+PRODUCT_DELTA_SYNC_SECONDS = int(os.getenv('PRODUCT_DELTA_SYNC_SECONDS', 10))
+POPULARITY_SYNC_SECONDS = int(os.getenv('POPULARITY_SYNC_SECONDS', 60))
 
 # APScheduler 設定
 scheduler = AsyncIOScheduler()
 
+# /debug/profile 使用的取樣分析器 (DEBUG_PROFILE_ENABLED 開啟時才提供端點)
+profiler = SamplingProfiler()
+
 @app.on_event("startup")
 async def startup_event():
+    # 先載入產品資料並映射最後一個可用模型，首次訓練在背景進行，服務可立即接收請求
+    await recommender_instance.update_product_data_async()
+    await asyncio.to_thread(recommender_instance.refresh_model)
+    await metrics_recorder.start()
+    await recommender_instance.recent_views.start()
+    await recommender_instance.result_cache.start()
+    app.state.initial_training_task = asyncio.create_task(recommender_instance.train_and_save_model_async())
+    # 首次讀取熱門度事件 (最近 POPULARITY_WINDOW_SECONDS) 在背景進行，完成前冷啟動退回隨機活躍商品
+    app.state.initial_popularity_task = asyncio.create_task(recommender_instance.sync_popularity_async())
+
     # 在應用啟動時啟動模型訓練/更新的定時任務
-    # 每 6 小時重新訓練模型
-    scheduler.add_job(recommender_instance.train_and_save_model, 'interval', hours=6, id='model_retrain_job')
-    # 每小時同步產品數據（包括上下架狀態）
-    scheduler.add_job(recommender_instance.update_product_data, 'interval', hours=1, id='product_data_sync_job')
+    # 每 6 小時完整重建模型 (在訓練程序中執行，不阻塞事件迴圈)
+    scheduler.add_job(recommender_instance.train_and_save_model_async, 'interval', hours=6, id='model_retrain_job')
+    # 每幾分鐘將新的互動事件增量併入模型
+    scheduler.add_job(recommender_instance.update_model_incremental_async, 'interval', minutes=INCREMENTAL_UPDATE_MINUTES, id='model_incremental_update_job')
+    # 每幾秒增量同步變更的產品 (上下架、售罄、新增)，以新的活躍遮罩替換
+    scheduler.add_job(recommender_instance.sync_product_changes_async, 'interval', seconds=PRODUCT_DELTA_SYNC_SECONDS, id='product_delta_sync_job')
+    # 每小時完整重新載入產品數據 (校正增量同步無法得知的變更，例如直接刪除的商品)
+    scheduler.add_job(recommender_instance.update_product_data_async, 'interval', hours=1, id='product_data_sync_job')
+    # 定期檢查 Redis 中的模型版本指標，載入其他 worker 發佈的新模型 (memmap，幾乎不耗時)
+    scheduler.add_job(recommender_instance.refresh_model, 'interval', seconds=MODEL_REFRESH_SECONDS, id='model_refresh_job')
+    # 每分鐘將新的互動事件併入時間衰減的熱門度計數，重建冷啟動用的熱門清單
+    scheduler.add_job(recommender_instance.sync_popularity_async, 'interval', seconds=POPULARITY_SYNC_SECONDS, id='popularity_sync_job')
     scheduler.start()
     print("Scheduler started for model retraining and data synchronization.")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     scheduler.shutdown()
+    await metrics_recorder.stop()
+    await recommender_instance.recent_views.stop()
+    await recommender_instance.result_cache.stop()
+    recommender_instance.shutdown()
     print("Scheduler shut down.")
 
 class RecommendationResponse(BaseModel):
     user_id: int
     recommended_product_ids: list[int]
 
+class PopularProductsResponse(BaseModel):
+    category_id: Optional[str] = None
+    recommended_product_ids: list[int]
+
+class BatchRecommendationRequest(BaseModel):
+    user_ids: list[int]
+    strategy_version: str = 'v1'
+    num_recommendations: int = 10
+
 @app.get("/health", summary="Health Check")
 async def health_check():
     REQUEST_COUNT.labels(endpoint='/health').inc()
-    return {"status": "ok"}
+    # 首次訓練完成前服務仍可用 (退回活躍商品補充)，model_ready 反映是否已有可用模型
+    return {"status": "ok", **recommender_instance.status()}
 
 @app.get("/recommend/{user_id}", response_model=RecommendationResponse, summary="Get Product Recommendations")
 async def get_recommendations(user_id: int, strategy_version: str = 'v1'):
@@ -81,53 +130,21 @@ async def get_recommendations(user_id: int, strategy_version: str = 'v1'):
     REQUEST_COUNT.labels(endpoint=endpoint).inc()
 
     try:
-        recommended_product_ids = recommender_instance.get_recommendations(user_id, strategy_version)
+        recommended_product_ids, cold_start = await recommender_instance.get_recommendations_cached(user_id, strategy_version)
 
         RECOMMENDATION_SUCCESS_TOTAL.labels(endpoint=endpoint, strategy_version=strategy_version).inc()
         RECOMMENDATION_PRODUCT_COUNT.labels(endpoint=endpoint, strategy_version=strategy_version).observe(len(recommended_product_ids))
 
         if recommended_product_ids and recommender_instance.products:
-            categories = {recommender_instance.products.get(pid, {}).get('category_id', 'unknown') for pid in recommended_product_ids if pid in recommender_instance.products}
-            RECOMMENDATION_CATEGORY_DIVERSITY.labels(endpoint=endpoint, strategy_version=strategy_version).observe(len(categories))
-
-            category_counts = PyCounter()
-            for pid in recommended_product_ids:
-                cat = recommender_instance.products.get(pid, {}).get('category_id', 'unknown')
-                category_counts[cat] += 1
-            
-            total_items = len(recommended_product_ids)
-            entropy = 0
-            if total_items > 0:
-                for count in category_counts.values():
-                    if count > 0:
-                        probability = count / total_items
-                        entropy -= probability * log2(probability)
-            RECOMMENDATION_ENTROPY.labels(endpoint=endpoint, strategy_version=strategy_version).set(entropy)
-
-            if redis_client:
-                last_recommendations_key = f"last_recommendations:{user_id}:{strategy_version}"
-                last_recommendations_json = redis_client.get(last_recommendations_key)
-                
-                last_recommendations = set(json.loads(last_recommendations_json) if last_recommendations_json else [])
-                current_set = set(recommended_product_ids)
-                
-                overlap = len(last_recommendations.intersection(current_set))
-                repetition_ratio = overlap / len(current_set) if current_set else 0
-
-                RECOMMENDATION_REPETITION_RATIO.labels(endpoint=endpoint, strategy_version=strategy_version).set(repetition_ratio)
-                redis_client.setex(last_recommendations_key, 3600, json.dumps(recommended_product_ids))
-
-                redis_client.sadd(f"{RECOMMENDED_PRODUCTS_SET_KEY_PREFIX}:{strategy_version}", *recommended_product_ids)
-                unique_recommended_count = redis_client.scard(f"{RECOMMENDED_PRODUCTS_SET_KEY_PREFIX}:{strategy_version}")
-                total_products_in_catalog = len([pid for pid, info in recommender_instance.products.items() if info.get('status') == 'active']) # 只計算活躍商品
-                if total_products_in_catalog > 0:
-                    coverage_ratio = unique_recommended_count / total_products_in_catalog
-                    RECOMMENDATION_CATALOG_COVERAGE.labels(endpoint=endpoint, strategy_version=strategy_version).set(coverage_ratio)
-            else:
-                print("Redis client not available, skipping repetition and catalog coverage metrics.")
-
-        if user_id == 0 or (user_id % 2 == 0 and strategy_version == 'v1'):
-             RECOMMENDATION_COLD_START_TOTAL.labels(endpoint=endpoint, strategy_version=strategy_version).inc()
+            unique_categories, entropy = category_stats(recommender_instance.category_codes_for([recommended_product_ids], len(recommended_product_ids)))
+            RECOMMENDATION_CATEGORY_DIVERSITY.labels(endpoint=endpoint, strategy_version=strategy_version).observe(int(unique_categories[0]))
+            RECOMMENDATION_ENTROPY.labels(endpoint=endpoint, strategy_version=strategy_version).set(float(entropy[0]))
+
+            metrics_recorder.record(user_id, strategy_version, recommended_product_ids)
+
+        # 冷啟動：用戶沒有任何最近瀏覽 (訪客與新用戶)，推薦來自熱門商品
+        if cold_start:
+            RECOMMENDATION_COLD_START_TOTAL.labels(endpoint=endpoint, strategy_version=strategy_version).inc()
 
         return RecommendationResponse(user_id=user_id, recommended_product_ids=recommended_product_ids)
     except Exception as e:
@@ -135,6 +152,76 @@ async def get_recommendations(user_id: int, strategy_version: str = 'v1'):
     finally:
         REQUEST_LATENCY.labels(endpoint=endpoint).observe(time.time() - start_time)
 
+@app.get("/popular", response_model=PopularProductsResponse, summary="Get Popular Products (Cold-Start Fallback)")
+async def get_popular_products(num_recommendations: int = 10, category_id: Optional[str] = None):
+    """時間衰減的熱門商品 (全站或指定類別)，直接讀取預先排好的清單，不查 MySQL；Laravel 在推薦 API 失敗時以此備援。"""
+    if num_recommendations <= 0 or num_recommendations > MAX_NUM_RECOMMENDATIONS:
+        raise HTTPException(status_code=400, detail=f"num_recommendations must be between 1 and {MAX_NUM_RECOMMENDATIONS}")
+    endpoint = "/popular"
+    REQUEST_COUNT.labels(endpoint=endpoint).inc()
+    with REQUEST_LATENCY.labels(endpoint=endpoint).time():
+        recommended_product_ids = recommender_instance.popular_products(num_recommendations, category_id)
+    return PopularProductsResponse(category_id=category_id, recommended_product_ids=recommended_product_ids)
+
+@app.post("/recommend/batch", summary="Get Product Recommendations for Many Users (NDJSON stream)")
+async def get_batch_recommendations(request: BatchRecommendationRequest):
+    if any(user_id < 0 for user_id in request.user_ids):
+        raise HTTPException(status_code=400, detail="Invalid user ID")
+    if len(request.user_ids) > MAX_BATCH_USERS:
+        raise HTTPException(status_code=400, detail=f"Too many user IDs (max {MAX_BATCH_USERS})")
+    if request.num_recommendations <= 0 or request.num_recommendations > MAX_NUM_RECOMMENDATIONS:
+        raise HTTPException(status_code=400, detail=f"num_recommendations must be between 1 and {MAX_NUM_RECOMMENDATIONS}")
+
+    endpoint = "/recommend/batch"
+    strategy_version = request.strategy_version
+    REQUEST_COUNT.labels(endpoint=endpoint).inc()
+
+    def recommend_chunk(user_ids):
+        recommendation_lists = recommender_instance.get_batch_recommendations(user_ids, strategy_version, request.num_recommendations)
+        unique_categories, entropy = category_stats(recommender_instance.category_codes_for(recommendation_lists, request.num_recommendations))
+        return recommendation_lists, unique_categories, entropy
+
+    async def stream_recommendations():
+        start_time = time.time()
+        try:
+            for start in range(0, len(request.user_ids), BATCH_CHUNK_SIZE):
+                user_ids = request.user_ids[start:start + BATCH_CHUNK_SIZE]
+                # 評分與類別指標的矩陣運算都放到執行緒池，避免長時間佔用事件迴圈
+                recommendation_lists, unique_categories, entropy = await run_in_threadpool(recommend_chunk, user_ids)
+                list_lengths = [len(recommended_product_ids) for recommended_product_ids in recommendation_lists]
+                RECOMMENDATION_SUCCESS_TOTAL.labels(endpoint=endpoint, strategy_version=strategy_version).inc(len(user_ids))
+                for length, diversity in zip(list_lengths, unique_categories.tolist()):
+                    RECOMMENDATION_PRODUCT_COUNT.labels(endpoint=endpoint, strategy_version=strategy_version).observe(length)
+                    if length:
+                        RECOMMENDATION_CATEGORY_DIVERSITY.labels(endpoint=endpoint, strategy_version=strategy_version).observe(diversity)
+                if any(list_lengths):
+                    RECOMMENDATION_ENTROPY.labels(endpoint=endpoint, strategy_version=strategy_version).set(float(entropy[np.asarray(list_lengths) > 0].mean()))
+
+                yield "".join(
+                    json.dumps({"user_id": user_id, "recommended_product_ids": recommended_product_ids}) + "\n"
+                    for user_id, recommended_product_ids in zip(user_ids, recommendation_lists)
+                )
+        finally:
+            REQUEST_LATENCY.labels(endpoint=endpoint).observe(time.time() - start_time)
+
+    return StreamingResponse(stream_recommendations(), media_type="application/x-ndjson")
+
+@app.get("/debug/profile", response_class=PlainTextResponse, summary="Sample Stack Profile of This Worker")
+async def debug_profile(seconds: float = 5.0, interval_ms: float = 5.0):
+    """
+    在執行緒池中對本 worker 的所有執行緒 (包含事件迴圈) 取樣 seconds 秒 (上限 DEBUG_PROFILE_MAX_SECONDS)，
+    以 collapsed 堆疊格式返回，可直接交給 flamegraph.pl 或 speedscope。
+    """
+    if not DEBUG_PROFILE_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if seconds <= 0 or interval_ms < 1:
+        raise HTTPException(status_code=400, detail="seconds must be positive and interval_ms at least 1")
+    result = await run_in_threadpool(profiler.profile, seconds, interval_ms / 1000)
+    if result is None:
+        raise HTTPException(status_code=409, detail="A profile is already being captured")
+    samples, stacks = result
+    return PlainTextResponse(profiler.format_collapsed(stacks), headers={"X-Profile-Samples": str(samples)})
+
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,178 @@
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from prometheus_client import Counter
+
+from model_store import ModelStore
+from result_cache import history_checksum
+
+
+# 每次完整重建後是否為活躍用戶預先計算推薦清單
+MATERIALIZE_ENABLED = os.getenv('MATERIALIZE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+MATERIALIZE_STRATEGIES = [s for s in os.getenv('MATERIALIZE_STRATEGIES', 'v1,v2,v3').split(',') if s]
+# 只預先計算這個數量的清單 (/recommend 的預設值)，其他數量的請求一律即時計算
+MATERIALIZE_NUM_RECOMMENDATIONS = int(os.getenv('MATERIALIZE_NUM_RECOMMENDATIONS', 10))
+# 最近瀏覽少於此數的用戶 (新用戶、偶爾造訪的用戶) 不預先計算
+MATERIALIZE_MIN_HISTORY = int(os.getenv('MATERIALIZE_MIN_HISTORY', 3))
+MATERIALIZE_MAX_USERS = int(os.getenv('MATERIALIZE_MAX_USERS', 2_000_000))
+MATERIALIZE_WORKERS = int(os.getenv('MATERIALIZE_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+MATERIALIZE_CHUNK_USERS = int(os.getenv('MATERIALIZE_CHUNK_USERS', 4096))
+# 超過此時間 (預設略長於完整重建的間隔) 的清單不再使用
+MATERIALIZED_MAX_AGE_SECONDS = float(os.getenv('MATERIALIZED_MAX_AGE_SECONDS', 7 * 3600))
+
+MATERIALIZED_REQUESTS = Counter('recommendation_materialized_requests_total', 'Lookups of precomputed recommendation lists', ['strategy_version', 'result'])
+
+
+class MaterializedRecommendations:
+    """
+    預先計算的推薦清單，以 ModelStore (memmap) 保存：
+    - user_ids: 依 ID 排序的用戶 (int64)；ID 夠密集時另存 user_rows[user_id] → 列索引 (int32，-1 表示沒有)，查詢為 O(1)
+    - history_checksums: 計算時該用戶最近瀏覽清單的 CRC32，與目前不同表示歷史已更新
+    - lists_<策略>: U×N 的商品 ID 矩陣 (int64，不足 N 個時以 -1 填補)
+    """
+
+    def __init__(self, user_ids, history_checksums, lists, num_recommendations, user_rows=None,
+                 version=None, materialized_at=None):
+        self.user_ids = user_ids
+        self.history_checksums = history_checksums
+        self.lists = lists
+        self.num_recommendations = num_recommendations
+        self.user_rows = user_rows
+        self.version = version
+        self.materialized_at = materialized_at
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint32), {}, MATERIALIZE_NUM_RECOMMENDATIONS)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    @classmethod
+    def build(cls, user_ids, history_checksums, lists, num_recommendations):
+        """由各區塊的結果組成 (依用戶 ID 排序；ID 範圍不超過用戶數的 4 倍時建立直接定址表)。"""
+        order = np.argsort(user_ids, kind='stable')
+        user_ids = np.asarray(user_ids, dtype=np.int64)[order]
+        user_rows = None
+        if len(user_ids) and user_ids[0] >= 0 and user_ids[-1] < 4 * len(user_ids) + 65536:
+            user_rows = np.full(int(user_ids[-1]) + 1, -1, dtype=np.int32)
+            user_rows[user_ids] = np.arange(len(user_ids), dtype=np.int32)
+        return cls(user_ids, np.asarray(history_checksums, dtype=np.uint32)[order],
+                   {strategy: matrix[order] for strategy, matrix in lists.items()}, num_recommendations, user_rows)
+
+    def to_arrays(self):
+        arrays = {'user_ids': self.user_ids, 'history_checksums': self.history_checksums}
+        if self.user_rows is not None:
+            arrays['user_rows'] = self.user_rows
+        arrays.update({f"lists_{strategy}": matrix for strategy, matrix in self.lists.items()})
+        return arrays, {'strategies': list(self.lists), 'num_recommendations': self.num_recommendations}
+
+    @classmethod
+    def from_arrays(cls, arrays, header):
+        metadata = header['metadata']
+        return cls(arrays['user_ids'], arrays['history_checksums'],
+                   {strategy: arrays[f"lists_{strategy}"] for strategy in metadata['strategies']},
+                   metadata['num_recommendations'], arrays.get('user_rows'), header['model_version'], header['trained_at'])
+
+    def _row(self, user_id):
+        if self.user_rows is not None:
+            return int(self.user_rows[user_id]) if 0 <= user_id < len(self.user_rows) else -1
+        position = int(np.searchsorted(self.user_ids, user_id))
+        return position if position < len(self.user_ids) and self.user_ids[position] == user_id else -1
+
+    def lookup(self, user_id, strategy_version, num_recommendations, viewed_product_ids, catalog):
+        """
+        返回 (結果, 推薦清單或 None)。結果為：
+        hit、miss (沒有該用戶/策略/數量的清單)、stale (最近瀏覽已改變或清單過期)、inactive (清單中有已下架商品)。
+        只有 hit 時返回清單，其餘情況由呼叫端即時計算。
+        """
+        matrix = self.lists.get(strategy_version)
+        if matrix is None or num_recommendations != self.num_recommendations:
+            return 'miss', None
+        row = self._row(user_id)
+        if row < 0:
+            return 'miss', None
+        if self.history_checksums[row] != history_checksum(viewed_product_ids) or time.time() - self.materialized_at > MATERIALIZED_MAX_AGE_SECONDS:
+            return 'stale', None
+        product_ids = np.asarray(matrix[row])
+        product_ids = product_ids[product_ids >= 0]
+        if not catalog.is_active(product_ids).all():
+            return 'inactive', None
+        return 'hit', product_ids.tolist()
+
+
+# ---- 預先計算 (在獨立的程序池中執行) ----
+
+_worker_recommender = None
+
+
+def _init_worker(model_dir, top_k, model_version, products, popularity=None):
+    """
+    每個 worker 程序建立一個 Recommender，載入同一份產品快照、熱門度計數與模型版本 (memmap，多個 worker 共用 page cache)。
+    popularity 為 PopularityCounts.snapshot()，沒有時補充的商品退回隨機活躍商品。
+    """
+    global _worker_recommender
+    from recommender import Recommender  # 避免循環匯入
+
+    recommender = Recommender(model_dir=model_dir, top_k=top_k)
+    recommender._apply_products(products)
+    if popularity is not None:
+        recommender.popularity.load_snapshot(popularity, recommender.catalog)
+    recommender._load_model_version(model_version)
+    # 同一區塊的最近瀏覽只向 Redis 讀取一次，校驗碼與推薦清單使用同一份歷史
+    recommender.recent_views.cache_ttl_seconds = math.inf
+    _worker_recommender = recommender
+
+
+def materialize_chunk(user_ids, strategies, num_recommendations, min_history):
+    """計算一個區塊的用戶，返回 (用戶 ID, 歷史校驗碼, {策略: U×N 矩陣})；歷史太短的用戶略過。"""
+    recommender = _worker_recommender
+    recent_views = recommender.recent_views.get_many(user_ids)
+    kept = [position for position, (viewed_products, _) in enumerate(recent_views) if len(viewed_products) >= min_history]
+    user_ids = [user_ids[position] for position in kept]
+    checksums = np.fromiter((history_checksum(recent_views[position][0]) for position in kept), dtype=np.uint32, count=len(kept))
+    lists = {}
+    for strategy_version in strategies:
+        matrix = np.full((len(user_ids), num_recommendations), -1, dtype=np.int64)
+        if user_ids:
+            for row, product_ids in enumerate(recommender.get_batch_recommendations(user_ids, strategy_version, num_recommendations)):
+                matrix[row, :len(product_ids)] = product_ids
+        lists[strategy_version] = matrix
+    recommender.recent_views.invalidate(user_ids)
+    return np.asarray(user_ids, dtype=np.int64), checksums, lists
+
+
+def run_materialization(model_dir, top_k, model_version, products, user_ids, popularity=None, strategies=None,
+                        num_recommendations=MATERIALIZE_NUM_RECOMMENDATIONS, min_history=MATERIALIZE_MIN_HISTORY,
+                        workers=MATERIALIZE_WORKERS, chunk_users=MATERIALIZE_CHUNK_USERS):
+    """
+    將用戶切成區塊，在 spawn 的程序池中平行計算推薦清單，合併後寫入 'materialized' ModelStore。
+    返回新版本；沒有可預先計算的用戶時返回 None。
+    """
+    strategies = strategies or MATERIALIZE_STRATEGIES
+    chunks = [user_ids[start:start + chunk_users] for start in range(0, len(user_ids), chunk_users)]
+    job = partial(materialize_chunk, strategies=strategies, num_recommendations=num_recommendations, min_history=min_history)
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(chunks))), mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(model_dir, top_k, model_version, products, popularity)) as executor:
+        results = list(executor.map(job, chunks))
+
+    materialized = MaterializedRecommendations.build(
+        np.concatenate([chunk_users for chunk_users, _, _ in results]) if results else np.empty(0, dtype=np.int64),
+        np.concatenate([checksums for _, checksums, _ in results]) if results else np.empty(0, dtype=np.uint32),
+        {strategy: np.concatenate([lists[strategy] for _, _, lists in results]) for strategy in strategies} if results else {},
+        num_recommendations,
+    )
+    if not len(materialized):
+        print("Materialization: No users with enough history. Skipping.")
+        return None
+    arrays, metadata = materialized.to_arrays()
+    metadata['model_version'] = model_version
+    store = ModelStore(model_dir, 'materialized')
+    version = store.save(arrays, metadata)
+    print(f"Materialization: Saved {len(materialized)} users × {len(strategies)} strategies as version {version}")
+    return version
@@ -0,0 +1,129 @@
+import asyncio
+import os
+
+import numpy as np
+from redis.exceptions import RedisError
+
+from instrumentation import timed_stage
+from redis_pool import close_async_redis, connect_async_redis
+
+
+# 上一次推薦清單的 key 前綴 (值為 int64 陣列的原始位元組，而非 JSON)
+LAST_RECOMMENDATIONS_KEY_PREFIX = "last_recommended_ids"
+# 已推薦商品的 HyperLogLog key 前綴，無論推薦過多少商品都只佔約 12KB
+RECOMMENDED_PRODUCTS_HLL_KEY_PREFIX = "recommended_products_hll"
+LAST_RECOMMENDATIONS_TTL_SECONDS = 3600
+
+
+def encode_product_ids(product_ids):
+    return np.asarray(product_ids, dtype='<i8').tobytes()
+
+
+def decode_product_ids(raw):
+    if not raw or len(raw) % 8:
+        return np.empty(0, dtype=np.int64)
+    return np.frombuffer(raw, dtype='<i8')
+
+
+class RecommendationMetricsRecorder:
+    """
+    在回應送出後記錄需要 Redis 的推薦指標 (重複率、目錄覆蓋率)：
+    - 請求路徑只把 (user_id, strategy_version, product_ids) 放入有上限的佇列，不等待 Redis
+    - 背景消費者一次取出多筆，以單一 pipeline (SET ... GET、PFADD、PFCOUNT) 一次往返寫入並取回結果
+    - 使用 redis.asyncio 連線池，不阻塞事件迴圈
+    佇列滿時直接丟棄該筆指標 (指標是取樣性質，不能拖慢推薦)。
+    """
+
+    def __init__(self, repetition_gauge, coverage_gauge, dropped_counter, active_product_count,
+                 queue_size=None, batch_size=None):
+        self.repetition_gauge = repetition_gauge
+        self.coverage_gauge = coverage_gauge
+        self.dropped_counter = dropped_counter
+        self.active_product_count = active_product_count  # 返回目前活躍商品數的函式
+        self.queue_size = queue_size or int(os.getenv('METRICS_QUEUE_SIZE', 10000))
+        self.batch_size = batch_size or int(os.getenv('METRICS_BATCH_SIZE', 256))
+        self.redis_client = None
+        self._queue = None
+        self._consumer_task = None
+
+    async def start(self):
+        """建立 Redis 連線池與背景消費者；Redis 不可用時停用這些指標。"""
+        client = await connect_async_redis(
+            "Metrics recorder", "Repetition and catalog coverage metrics are disabled.",
+            max_connections=int(os.getenv('METRICS_REDIS_MAX_CONNECTIONS', 4)),
+        )
+        if client is None:
+            return
+        self.redis_client = client
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._consumer_task = asyncio.create_task(self._consume())
+
+    async def stop(self, timeout=5.0):
+        """盡量送出佇列中剩餘的指標後關閉連線。"""
+        if self._consumer_task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print("Metrics recorder: Timed out flushing pending metrics.")
+        self._consumer_task.cancel()
+        try:
+            await self._consumer_task
+        except asyncio.CancelledError:
+            pass
+        self._consumer_task = None
+        await close_async_redis(self.redis_client)
+        self.redis_client = None
+
+    def record(self, user_id, strategy_version, product_ids):
+        """非阻塞：將一筆推薦結果排入佇列。"""
+        if self._queue is None or not product_ids:
+            return
+        try:
+            self._queue.put_nowait((user_id, strategy_version, product_ids))
+        except asyncio.QueueFull:
+            self.dropped_counter.inc()
+
+    async def _consume(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                with timed_stage('metrics_bookkeeping'):
+                    await self._flush(batch)
+            except (RedisError, OSError) as e:
+                print(f"Metrics recorder: Error writing metrics to Redis: {e}")
+            except Exception as e:
+                print(f"Metrics recorder: Unexpected error: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _flush(self, batch):
+        """整批指標在一次 pipeline 往返中完成。"""
+        pipe = self.redis_client.pipeline(transaction=False)
+        strategies = []
+        for user_id, strategy_version, product_ids in batch:
+            # SET ... GET 在寫入新清單的同時取回上一次的清單 (Redis >= 6.2)
+            pipe.set(f"{LAST_RECOMMENDATIONS_KEY_PREFIX}:{user_id}:{strategy_version}", encode_product_ids(product_ids),
+                     ex=LAST_RECOMMENDATIONS_TTL_SECONDS, get=True)
+            pipe.pfadd(f"{RECOMMENDED_PRODUCTS_HLL_KEY_PREFIX}:{strategy_version}", *product_ids)
+            if strategy_version not in strategies:
+                strategies.append(strategy_version)
+        for strategy_version in strategies:
+            pipe.pfcount(f"{RECOMMENDED_PRODUCTS_HLL_KEY_PREFIX}:{strategy_version}")
+        results = await pipe.execute()
+
+        endpoint = "/recommend/{user_id}"
+        for i, (_, strategy_version, product_ids) in enumerate(batch):
+            previous = decode_product_ids(results[2 * i])
+            overlap = np.isin(product_ids, previous).sum()
+            self.repetition_gauge.labels(endpoint=endpoint, strategy_version=strategy_version).set(overlap / len(product_ids))
+
+        total_products_in_catalog = self.active_product_count()
+        if total_products_in_catalog > 0:
+            for strategy_version, unique_recommended_count in zip(strategies, results[2 * len(batch):]):
+                self.coverage_gauge.labels(endpoint=endpoint, strategy_version=strategy_version).set(
+                    unique_recommended_count / total_products_in_catalog
+                )
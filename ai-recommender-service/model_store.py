@@ -0,0 +1,132 @@
+import json
+import os
+import shutil
+import time
+import uuid
+from typing import Optional
+
+import numpy as np
+
+
+# 模型目錄格式版本，header 結構不相容變更時遞增
+FORMAT_VERSION = 1
+HEADER_FILE = "header.json"
+CURRENT_POINTER_FILE = "CURRENT"
+
+
+class ModelStore:
+    """
+    版本化的模型儲存：每個版本是一個目錄，包含
+    - header.json: 格式版本、模型版本、訓練時間、各陣列的 dtype/shape 與自訂 metadata (例如 top_k、事件高水位)
+    - <name>.bin: 原始 C-order 陣列資料，由各 worker 以 np.memmap 唯讀映射
+    多個 uvicorn worker 映射同一份檔案時共用 page cache，不需各自反序列化一份副本。
+    Redis 只保存目前版本的指標，不再保存模型本體。
+    """
+
+    def __init__(self, root_dir, name, redis_client=None, keep_versions=3):
+        self.name = name
+        self.directory = os.path.join(root_dir, name)
+        self.redis_client = redis_client
+        self.keep_versions = keep_versions
+        self.redis_pointer_key = f"model:{name}:current_version"
+
+    def save(self, arrays: dict, metadata: Optional[dict] = None) -> str:
+        """寫入一個新版本並原子地切換 CURRENT 指標，返回版本字串。"""
+        version = time.strftime("%Y%m%dT%H%M%S") + "-" + uuid.uuid4().hex[:8]
+        os.makedirs(self.directory, exist_ok=True)
+        staging_dir = os.path.join(self.directory, f".{version}.tmp")
+        os.makedirs(staging_dir)
+
+        header = {
+            'format_version': FORMAT_VERSION,
+            'model_version': version,
+            'trained_at': time.time(),
+            'arrays': {},
+            'metadata': metadata or {},
+        }
+        for array_name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            file_name = f"{array_name}.bin"
+            array.tofile(os.path.join(staging_dir, file_name))
+            header['arrays'][array_name] = {'file': file_name, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        with open(os.path.join(staging_dir, HEADER_FILE), 'w') as f:
+            json.dump(header, f)
+
+        # 先完整寫好目錄再改名，讀取端永遠看不到寫到一半的版本
+        os.rename(staging_dir, os.path.join(self.directory, version))
+        self._write_pointer(version)
+        self._prune_old_versions(version)
+        return version
+
+    def current_version(self) -> Optional[str]:
+        """優先讀取 Redis 中的版本指標，其次是本機 CURRENT 檔案。"""
+        if self.redis_client:
+            try:
+                version = self.redis_client.get(self.redis_pointer_key)
+                if version:
+                    version = version.decode() if isinstance(version, bytes) else version
+                    if os.path.isdir(os.path.join(self.directory, version)):
+                        return version
+            except Exception as e:
+                print(f"ModelStore: Could not read model version pointer from Redis: {e}")
+        try:
+            with open(os.path.join(self.directory, CURRENT_POINTER_FILE)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def load(self, version: Optional[str] = None):
+        """
+        以唯讀 memmap 載入指定版本 (預設為目前版本)。
+        返回 (header, {array_name: np.memmap})；沒有可用版本時返回 (None, None)。
+        """
+        version = version or self.current_version()
+        if not version:
+            return None, None
+        version_dir = os.path.join(self.directory, version)
+        with open(os.path.join(version_dir, HEADER_FILE)) as f:
+            header = json.load(f)
+        if header.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported model format version {header.get('format_version')} in {version_dir}")
+
+        arrays = {}
+        for array_name, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            shape = tuple(spec['shape'])
+            if int(np.prod(shape)) == 0:
+                arrays[array_name] = np.empty(shape, dtype=dtype)  # 空檔案無法 mmap
+            else:
+                arrays[array_name] = np.memmap(os.path.join(version_dir, spec['file']), dtype=dtype, mode='r', shape=shape)
+        return header, arrays
+
+    def _write_pointer(self, version: str):
+        pointer_path = os.path.join(self.directory, CURRENT_POINTER_FILE)
+        tmp_path = f"{pointer_path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(version)
+        os.replace(tmp_path, pointer_path)
+        self.publish(version)
+
+    def publish(self, version: str):
+        """將版本指標發佈到 Redis，其他 worker 經由 current_version() 取得新模型。"""
+        if self.redis_client:
+            try:
+                self.redis_client.set(self.redis_pointer_key, version)
+            except Exception as e:
+                print(f"ModelStore: Could not publish model version pointer to Redis: {e}")
+
+    def versions(self) -> list:
+        """磁碟上所有完整寫入的版本，由舊到新 (版本字串以時間開頭)。"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            entry for entry in os.listdir(self.directory)
+            if not entry.startswith('.') and os.path.isdir(os.path.join(self.directory, entry))
+        )
+
+    def _prune_old_versions(self, current: str):
+        """只保留最近 keep_versions 個版本。已映射舊版本的 worker 在檔案刪除後仍可繼續讀取。"""
+        versions = self.versions()
+        for version in versions[:-self.keep_versions]:
+            if version != current:
+                shutil.rmtree(os.path.join(self.directory, version), ignore_errors=True)
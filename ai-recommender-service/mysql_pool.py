@@ -0,0 +1,36 @@
+import os
+import threading
+
+import mysql.connector
+from mysql.connector import pooling
+
+
+# 每個程序 (服務 worker、訓練程序) 各自持有一個連線池，同一程序內的產品同步與互動資料讀取共用
+MYSQL_POOL_SIZE = int(os.getenv('MYSQL_POOL_SIZE', 4))
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_mysql_connection(mysql_config: dict, owner: str = "Recommender"):
+    """
+    從連線池取得一個連線，使用完畢後呼叫 close() 即歸還連線池 (不會真正斷線)。
+    MySQL 不可用或連線池已滿時返回 None；連線池建立失敗時下次呼叫會重試。
+    """
+    key = tuple(sorted(mysql_config.items()))
+    try:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = pooling.MySQLConnectionPool(
+                    pool_name=f"recommender-{os.getpid()}-{len(_pools)}",
+                    pool_size=MYSQL_POOL_SIZE,
+                    pool_reset_session=True,
+                    **mysql_config
+                )
+                _pools[key] = pool
+                print(f"{owner}: Successfully connected to MySQL.")
+        return pool.get_connection()
+    except mysql.connector.Error as err:
+        print(f"{owner}: Error connecting to MySQL: {err}")
+        return None
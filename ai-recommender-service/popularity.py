@@ -0,0 +1,205 @@
+import os
+
+import numpy as np
+import mysql.connector
+
+from mysql_pool import get_mysql_connection
+
+
+# 熱門度的半衰期：一個事件的貢獻每經過這麼久減半
+POPULARITY_HALF_LIFE_SECONDS = float(os.getenv('POPULARITY_HALF_LIFE_SECONDS', 3 * 86400))
+# 首次同步只讀取這段時間內的事件 (更早的事件貢獻已可忽略)
+POPULARITY_WINDOW_SECONDS = int(os.getenv('POPULARITY_WINDOW_SECONDS', 14 * 86400))
+# 每份熱門清單 (全站與各類別) 保留的商品數
+POPULARITY_TOP_N = int(os.getenv('POPULARITY_TOP_N', 100))
+# 事件以分鐘為單位在資料庫端聚合
+POPULARITY_BUCKET_SECONDS = 60
+# 首次同步讀取整個時間窗，改以較粗的區間聚合以減少列數 (1 小時的時間誤差相對於半衰期可忽略)
+POPULARITY_BACKFILL_BUCKET_SECONDS = int(os.getenv('POPULARITY_BACKFILL_BUCKET_SECONDS', 3600))
+# 每次 fetchmany 的列數，聚合結果串流寫入陣列而不是一次 fetchall
+POPULARITY_FETCH_CHUNK_ROWS = int(os.getenv('POPULARITY_FETCH_CHUNK_ROWS', 100000))
+POPULARITY_ACTION_WEIGHTS = {'view': 1, 'click': 2, 'purchase': 5}
+# 參考時間與最新事件相差超過這麼多個半衰期時重新定基準，避免 2^x 溢位
+POPULARITY_REBASE_HALF_LIVES = 64
+
+
+class PopularityCounts:
+    """
+    每個商品的時間衰減事件計數：score = Σ weight · 2^(−(now − t) / half_life)。
+    分數以固定的參考時間保存 (每個事件加上 weight · 2^((t − reference) / half_life))，
+    所有商品同時衰減同一個倍數，排序不變，因此新增事件為 O(Δ)，不必每次衰減全部商品。
+    """
+
+    def __init__(self, half_life_seconds=POPULARITY_HALF_LIFE_SECONDS):
+        self.half_life_seconds = half_life_seconds
+        # (product_ids, scores, reference_time) 作為一個整體替換，其他執行緒讀到的三者總是一致
+        self._state = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), None)
+
+    def snapshot(self):
+        """返回目前的 (product_ids, scores, reference_time)；陣列發佈後不再修改。"""
+        return self._state
+
+    def restore(self, state):
+        """以另一份 snapshot() 取代目前的計數 (例如傳給預先計算程序池的快照)。"""
+        self._state = state
+
+    def __len__(self):
+        return len(self._state[0])
+
+    def add(self, product_ids, weights, timestamps):
+        """併入一批事件 (三個平行陣列)。合併結果先寫入新陣列，最後一次替換 _state。"""
+        if not len(product_ids):
+            return
+        known_ids, scores, reference_time = self._state
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        if reference_time is None:
+            reference_time = float(timestamps.min())
+        latest = float(timestamps.max())
+        if latest - reference_time > POPULARITY_REBASE_HALF_LIVES * self.half_life_seconds:
+            scores = scores * np.exp2((reference_time - latest) / self.half_life_seconds)
+            reference_time = latest
+        else:
+            scores = scores.copy()
+        contributions = np.asarray(weights, dtype=np.float64) * np.exp2((timestamps - reference_time) / self.half_life_seconds)
+
+        unique_ids, inverse = np.unique(np.asarray(product_ids, dtype=np.int64), return_inverse=True)
+        totals = np.bincount(inverse, weights=contributions, minlength=len(unique_ids))
+        positions = np.minimum(np.searchsorted(known_ids, unique_ids), max(len(known_ids) - 1, 0))
+        known = (known_ids[positions] == unique_ids) if len(known_ids) else np.zeros(len(unique_ids), dtype=bool)
+        scores[positions[known]] += totals[known]
+        if not known.all():
+            # 新商品一次向量化合併進排序陣列
+            merged_ids = np.concatenate([known_ids, unique_ids[~known]])
+            order = np.argsort(merged_ids, kind='stable')
+            known_ids = merged_ids[order]
+            scores = np.concatenate([scores, totals[~known]])[order]
+        self._state = (known_ids, scores, reference_time)
+
+
+class PopularityEngine:
+    """
+    冷啟動用的熱門商品：
+    - 從 recommendation_events 以事件 ID 高水位增量讀取新事件 (與訓練程序相同的做法)，併入 PopularityCounts
+    - 每次同步或產品變更後，依活躍遮罩與類別重建全站與各類別的 top-N 清單
+    請求路徑只讀取已排好的清單 (單一參考替換)，成本 O(k)，不查 MySQL。
+    """
+
+    def __init__(self, mysql_config, top_n=POPULARITY_TOP_N):
+        self.mysql_config = mysql_config
+        self.top_n = top_n
+        self.counts = PopularityCounts()
+        self.high_water_mark = None
+        self._ranked = ([], {})  # (全站清單, {類別 ID (字串): 清單})
+
+    @property
+    def is_empty(self):
+        return not self._ranked[0]
+
+    def _get_mysql_connection(self):
+        return get_mysql_connection(self.mysql_config, owner="Popularity")
+
+    def _load_events_from_mysql(self):
+        """
+        讀取高水位之後的事件，在資料庫端依 (商品, 行為, 時間區間) 聚合：
+        平常以分鐘為區間，首次同步以 POPULARITY_BACKFILL_BUCKET_SECONDS 為區間，並以 fetchmany 串流讀取。
+        返回 (product_ids, weights, timestamps)；無法連線時返回 None。
+        """
+        conn = self._get_mysql_connection()
+        if not conn:
+            return None
+        product_ids, weights, timestamps = [], [], []
+        try:
+            cursor = conn.cursor(buffered=False)
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM recommendation_events")
+            (high_water_mark,) = cursor.fetchone()
+            conditions = "id > %s AND id <= %s"
+            params = [self.high_water_mark or 0, high_water_mark]
+            bucket_seconds = POPULARITY_BUCKET_SECONDS
+            if self.high_water_mark is None:
+                # 首次同步只讀取最近一段時間的事件
+                conditions += " AND created_at >= NOW() - INTERVAL %s SECOND"
+                params.append(POPULARITY_WINDOW_SECONDS)
+                bucket_seconds = POPULARITY_BACKFILL_BUCKET_SECONDS
+            cursor.execute(f"""
+                SELECT product_id, action, FLOOR(UNIX_TIMESTAMP(created_at) / {bucket_seconds}) AS bucket, COUNT(*)
+                FROM recommendation_events
+                WHERE {conditions} AND product_id IS NOT NULL AND action IN ({', '.join(['%s'] * len(POPULARITY_ACTION_WEIGHTS))})
+                GROUP BY product_id, action, bucket
+            """, (*params, *POPULARITY_ACTION_WEIGHTS))
+            while True:
+                rows = cursor.fetchmany(POPULARITY_FETCH_CHUNK_ROWS)
+                if not rows:
+                    break
+                chunk_product_ids, actions, buckets, counts = zip(*rows)
+                chunk_weights = np.fromiter((POPULARITY_ACTION_WEIGHTS[action] for action in actions), dtype=np.float64, count=len(rows))
+                product_ids.append(np.asarray(chunk_product_ids, dtype=np.int64))
+                weights.append(chunk_weights * np.asarray(counts, dtype=np.float64))
+                timestamps.append((np.asarray(buckets, dtype=np.float64) + 0.5) * bucket_seconds)
+            cursor.close()
+            # 全部讀完才前進高水位，讀取中途失敗時下次會重新讀取同一範圍
+            self.high_water_mark = int(high_water_mark)
+        except mysql.connector.Error as err:
+            print(f"Error fetching popularity events from MySQL: {err}")
+            return None
+        finally:
+            conn.close()
+
+        if not product_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)
+        return np.concatenate(product_ids), np.concatenate(weights), np.concatenate(timestamps)
+
+    def sync(self):
+        """
+        併入高水位之後的新事件 (排程器在執行緒中調用)，返回新事件的聚合列數，無法讀取時返回 None。
+        熱門清單由呼叫端以當下的產品目錄重建 (見 Recommender.sync_popularity_async)。
+        """
+        events = self._load_events_from_mysql()
+        if events is None:
+            return None
+        self.counts.add(*events)
+        return len(events[0])
+
+    def load_snapshot(self, snapshot, catalog):
+        """載入其他程序的 PopularityCounts.snapshot() 並重建清單，不讀取 MySQL。"""
+        self.counts.restore(snapshot)
+        self.rebuild(catalog)
+
+    def rebuild(self, catalog):
+        """依目前的活躍遮罩與類別重建 top-N 清單 (產品同步或變更後也需調用)。"""
+        product_ids, scores, _ = self.counts.snapshot()
+        if not len(product_ids) or not len(catalog):
+            self._ranked = ([], {})
+            return
+        active = catalog.is_active(product_ids)
+        product_ids, scores = product_ids[active], scores[active]
+        codes = catalog.category_codes_for([product_ids], len(product_ids))[0]
+
+        top = np.argsort(-scores, kind='stable')[:self.top_n]
+        overall = product_ids[top].tolist()
+
+        # 各類別：依 (類別, 分數遞減) 排序後，每組取前 top_n 個
+        has_category = codes >= 0
+        product_ids, scores, codes = product_ids[has_category], scores[has_category], codes[has_category]
+        order = np.lexsort((-scores, codes))
+        sorted_codes = codes[order]
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+        keep = order[rank < self.top_n]
+        by_category = {}
+        for code, product_id in zip(codes[keep].tolist(), product_ids[keep].tolist()):
+            by_category.setdefault(str(catalog.category_names[code]), []).append(product_id)
+        self._ranked = (overall, by_category)
+
+    def top(self, k, category_id=None, exclude=None):
+        """返回最熱門的 k 個活躍商品 (可指定類別、排除指定商品)；尚無事件時返回空列表。"""
+        overall, by_category = self._ranked
+        ranked = overall if category_id is None else by_category.get(category_id, [])
+        if not exclude:
+            return ranked[:k]
+        selected = []
+        for product_id in ranked:
+            if product_id not in exclude:
+                selected.append(product_id)
+                if len(selected) == k:
+                    break
+        return selected
@@ -0,0 +1,285 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from redis.exceptions import RedisError, ResponseError
+
+from instrumentation import timed_stage
+from redis_pool import close_async_redis, connect_async_redis
+
+
+# Laravel 的 LogRecommendationInteraction 將瀏覽/點擊/購買事件 XADD 到此 stream
+RECENT_EVENTS_STREAM_KEY = "recommendation_events:stream"
+RECENT_VIEWS_CONSUMER_GROUP = "recent-views"
+# 每個用戶一個有上限的 Redis list (最新在前)，元素為 b"<product_id>:<unix 秒>"
+RECENT_VIEWS_KEY_PREFIX = "recent_views"
+HISTORY_ACTIONS = {b'view', b'click', b'purchase'}
+
+
+class RecentViewsStore:
+    """
+    用戶最近瀏覽紀錄，請求路徑上不查 MySQL：
+    - 背景消費者以 consumer group 讀取事件 stream (多個 worker 之間每個事件只處理一次)，
+      以 LPUSH + LTRIM 寫入每個用戶固定長度的環形緩衝區
+    - 啟動時與寫入失敗後先重新處理自己未確認的事件，並定期以 XAUTOCLAIM 接手已停止的 worker 未確認的事件
+    - 查詢時先查本機 LRU (短 TTL)，未命中時一次 LRANGE，成本 O(size)，與歷史總量無關
+    - 每筆瀏覽依經過時間指數衰減 (半衰期 half_life_seconds)，同一商品多次瀏覽的權重相加
+    Redis 不可用時返回空歷史 (視為冷啟動)。
+    """
+
+    def __init__(self, redis_client, size=None, half_life_seconds=None, ttl_seconds=None,
+                 cache_size=None, cache_ttl_seconds=None):
+        self.redis_client = redis_client
+        self.size = size or int(os.getenv('RECENT_VIEWS_SIZE', 20))
+        self.half_life_seconds = half_life_seconds or float(os.getenv('RECENT_VIEWS_HALF_LIFE_SECONDS', 86400))
+        self.ttl_seconds = ttl_seconds or int(os.getenv('RECENT_VIEWS_TTL_SECONDS', 30 * 86400))
+        self.cache_size = cache_size or int(os.getenv('RECENT_VIEWS_CACHE_SIZE', 100000))
+        # 其他 worker 消費的事件不會使本機快取失效，TTL 決定最長的延遲
+        self.cache_ttl_seconds = cache_ttl_seconds if cache_ttl_seconds is not None else float(os.getenv('RECENT_VIEWS_CACHE_SECONDS', 5))
+        # 其他 consumer 未確認的事件閒置超過這麼久才接手 (視為該 worker 已停止)，以及檢查的間隔
+        self.claim_idle_ms = int(os.getenv('RECENT_VIEWS_CLAIM_IDLE_MS', 60000))
+        self.claim_interval_seconds = float(os.getenv('RECENT_VIEWS_CLAIM_INTERVAL_SECONDS', 60))
+        self._cache = OrderedDict()  # user_id -> (expires_at, product_ids, timestamps)
+        self._cache_lock = threading.Lock()  # 批次推薦在執行緒池中查詢
+        self._async_client = None
+        self._consumer_task = None
+        self._consumer_name = f"{socket.gethostname()}-{os.getpid()}"
+
+    # ---- 查詢 ----
+
+    def get(self, user_id: int):
+        """返回 (商品 ID 列表 (最新在前), 對應的時間衰減權重)。"""
+        entries = self._cache_get(user_id)
+        if entries is None:
+            raw = []
+            if self.redis_client:
+                try:
+                    raw = self.redis_client.lrange(self._key(user_id), 0, self.size - 1)
+                except RedisError as e:
+                    print(f"RecentViews: Could not read recent views from Redis: {e}")
+            entries = self._cache_put(user_id, raw)
+        return self._weighted(*entries)
+
+    def get_many(self, user_ids):
+        """批次版本：未命中快取的用戶以一次 pipeline 往返查詢。"""
+        results = [self._cache_get(user_id) for user_id in user_ids]
+        missing = [position for position, entries in enumerate(results) if entries is None]
+        if missing:
+            raw_lists = [[] for _ in missing]
+            if self.redis_client:
+                try:
+                    pipe = self.redis_client.pipeline(transaction=False)
+                    for position in missing:
+                        pipe.lrange(self._key(user_ids[position]), 0, self.size - 1)
+                    raw_lists = pipe.execute()
+                except RedisError as e:
+                    print(f"RecentViews: Could not read recent views from Redis: {e}")
+            for position, raw in zip(missing, raw_lists):
+                results[position] = self._cache_put(user_ids[position], raw)
+        now = time.time()
+        return [self._weighted(*entries, now=now) for entries in results]
+
+    async def get_async(self, user_id: int):
+        """事件迴圈中使用的非阻塞版本 (單一推薦端點)。"""
+        if self._async_client is None:
+            return self.get(user_id)
+        entries = self._cache_get(user_id)
+        if entries is None:
+            raw = []
+            try:
+                raw = await self._async_client.lrange(self._key(user_id), 0, self.size - 1)
+            except RedisError as e:
+                print(f"RecentViews: Could not read recent views from Redis: {e}")
+            entries = self._cache_put(user_id, raw)
+        return self._weighted(*entries)
+
+    def _weighted(self, product_ids, timestamps, now=None):
+        if not len(product_ids):
+            return [], np.empty(0, dtype=np.float32)
+        now = now or time.time()
+        decay = np.exp2(-np.maximum(now - timestamps, 0) / self.half_life_seconds)
+        # 依第一次出現的位置 (即最近一次瀏覽) 去重，同一商品的權重相加
+        unique_ids, first, inverse = np.unique(product_ids, return_index=True, return_inverse=True)
+        weights = np.bincount(inverse, weights=decay, minlength=len(unique_ids))
+        order = np.argsort(first)
+        return unique_ids[order].tolist(), weights[order].astype(np.float32)
+
+    @staticmethod
+    def _decode(raw):
+        product_ids = np.empty(len(raw), dtype=np.int64)
+        timestamps = np.empty(len(raw), dtype=np.float64)
+        count = 0
+        for entry in raw:
+            product_id, _, timestamp = entry.partition(b':')
+            try:
+                product_ids[count] = int(product_id)
+                timestamps[count] = float(timestamp)
+                count += 1
+            except ValueError:
+                continue
+        return product_ids[:count], timestamps[:count]
+
+    def _key(self, user_id):
+        return f"{RECENT_VIEWS_KEY_PREFIX}:{user_id}"
+
+    def _cache_get(self, user_id):
+        with self._cache_lock:
+            cached = self._cache.get(user_id)
+            if cached is None:
+                return None
+            if cached[0] < time.monotonic():
+                del self._cache[user_id]
+                return None
+            self._cache.move_to_end(user_id)
+            return cached[1], cached[2]
+
+    def _cache_put(self, user_id, raw):
+        entries = self._decode(raw)
+        with self._cache_lock:
+            self._cache[user_id] = (time.monotonic() + self.cache_ttl_seconds, *entries)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return entries
+
+    def preload(self, recent_views_by_user):
+        """以 {user_id: [b"<product_id>:<unix 秒>", ...] (最新在前，與 Redis 中相同的格式)} 填入本機快取，供暖機與壓測使用。"""
+        for user_id, raw in recent_views_by_user.items():
+            self._cache_put(user_id, raw[:self.size])
+
+    def active_user_ids(self, limit=None):
+        """以 SCAN 列出仍有最近瀏覽緩衝區 (TTL 內有互動) 的用戶，最多 limit 個；Redis 不可用時返回空列表。"""
+        user_ids = {}  # SCAN 可能重複返回同一個 key
+        if not self.redis_client:
+            return []
+        try:
+            for key in self.redis_client.scan_iter(match=f"{RECENT_VIEWS_KEY_PREFIX}:*", count=10000):
+                try:
+                    user_ids[int(key.rpartition(b':')[2])] = None
+                except ValueError:
+                    continue
+                if limit and len(user_ids) >= limit:
+                    break
+        except RedisError as e:
+            print(f"RecentViews: Could not list active users from Redis: {e}")
+        return list(user_ids)
+
+    def invalidate(self, user_ids):
+        with self._cache_lock:
+            for user_id in user_ids:
+                self._cache.pop(user_id, None)
+
+    # ---- 事件消費 ----
+
+    async def start(self):
+        """建立 async Redis 連線與 consumer group，啟動背景消費者；Redis 不可用時只提供 (空的) 查詢。"""
+        client = await connect_async_redis("RecentViews", "Recent views are unavailable.")
+        if client is None:
+            return
+        try:
+            await client.xgroup_create(RECENT_EVENTS_STREAM_KEY, RECENT_VIEWS_CONSUMER_GROUP, id='$', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):  # group 已存在 (其他 worker 建立) 是正常情況
+                print(f"RecentViews: Could not create consumer group: {e}")
+        except (RedisError, OSError) as e:
+            print(f"RecentViews: Could not create consumer group: {e}. Recent views are unavailable.")
+            await close_async_redis(client)
+            return
+        self._async_client = client
+        self._consumer_task = asyncio.create_task(self._consume())
+
+    async def stop(self):
+        if self._consumer_task is not None:
+            self._consumer_task.cancel()
+            try:
+                await self._consumer_task
+            except asyncio.CancelledError:
+                pass
+            self._consumer_task = None
+        if self._async_client is not None:
+            await close_async_redis(self._async_client)
+            self._async_client = None
+
+    async def _consume(self):
+        # 啟動與錯誤後先處理待確認的事件，再以 '>' 讀取新事件
+        recover = True
+        next_claim = 0.0
+        while True:
+            try:
+                if recover:
+                    await self._process_own_pending()
+                    recover = False
+                if time.monotonic() >= next_claim:
+                    await self._claim_stale_pending()
+                    next_claim = time.monotonic() + self.claim_interval_seconds
+                response = await self._async_client.xreadgroup(
+                    RECENT_VIEWS_CONSUMER_GROUP, self._consumer_name, {RECENT_EVENTS_STREAM_KEY: '>'}, count=500, block=1000
+                )
+                for _, messages in response or []:
+                    with timed_stage('recent_views_ingest'):
+                        await self._apply(messages)
+            except asyncio.CancelledError:
+                raise
+            except (RedisError, OSError) as e:
+                print(f"RecentViews: Error consuming interaction events: {e}")
+                recover = True
+                await asyncio.sleep(1)
+
+    async def _process_own_pending(self):
+        """以 XREADGROUP id '0' 重新讀取此 consumer 已讀取但尚未 XACK 的事件 (例如上次寫入失敗)。"""
+        last_id = '0'
+        while True:
+            response = await self._async_client.xreadgroup(
+                RECENT_VIEWS_CONSUMER_GROUP, self._consumer_name, {RECENT_EVENTS_STREAM_KEY: last_id}, count=500
+            )
+            messages = response[0][1] if response else []
+            if not messages:
+                return
+            with timed_stage('recent_views_ingest'):
+                await self._apply(messages)
+            last_id = messages[-1][0]
+
+    async def _claim_stale_pending(self):
+        """以 XAUTOCLAIM 接手其他 consumer (已停止的 worker) 閒置超過 claim_idle_ms 的待確認事件並套用。"""
+        start_id = '0-0'
+        while True:
+            response = await self._async_client.xautoclaim(
+                RECENT_EVENTS_STREAM_KEY, RECENT_VIEWS_CONSUMER_GROUP, self._consumer_name,
+                min_idle_time=self.claim_idle_ms, start_id=start_id, count=500,
+            )
+            start_id, messages = response[0], response[1]
+            # Redis 6.2 對已被 MAXLEN 截掉的事件返回 nil
+            messages = [(message_id, fields) for message_id, fields in messages if message_id is not None]
+            if messages:
+                with timed_stage('recent_views_ingest'):
+                    await self._apply(messages)
+            if start_id in (b'0-0', '0-0'):
+                return
+
+    async def _apply(self, messages):
+        """將一批事件寫入各用戶的環形緩衝區並確認 (XACK)，全部在一次 pipeline 往返中完成。"""
+        per_user = {}
+        for _, fields in messages:
+            try:
+                user_id = int(fields[b'user_id'])
+                product_id = int(fields[b'product_id'])
+            except (KeyError, ValueError):
+                continue
+            if user_id <= 0 or fields.get(b'action') not in HISTORY_ACTIONS:
+                continue  # 訪客 (user_id 0) 共用同一 ID，不記錄
+            timestamp = fields.get(b'ts', b'0').decode()
+            per_user.setdefault(user_id, []).append(f"{product_id}:{timestamp}")
+
+        pipe = self._async_client.pipeline(transaction=False)
+        for user_id, entries in per_user.items():
+            key = self._key(user_id)
+            pipe.lpush(key, *entries)  # 依序 LPUSH 後最新的事件在最前面
+            pipe.ltrim(key, 0, self.size - 1)
+            pipe.expire(key, self.ttl_seconds)
+        pipe.xack(RECENT_EVENTS_STREAM_KEY, RECENT_VIEWS_CONSUMER_GROUP, *[message_id for message_id, _ in messages])
+        await pipe.execute()
+        self.invalidate(per_user.keys())
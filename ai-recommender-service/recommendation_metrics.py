@@ -0,0 +1,30 @@
+import numpy as np
+
+
+def category_stats(category_codes):
+    """
+    向量化計算每份推薦清單的類別多樣性與熵值。
+    category_codes: U×k 的類別代碼矩陣，-1 表示填補位置。
+    返回 (每列不重複類別數, 每列類別分佈的 Shannon 熵 (以 2 為底))。
+    """
+    codes = np.sort(np.atleast_2d(np.asarray(category_codes, dtype=np.int64)), axis=1)
+    n_rows, width = codes.shape
+    if width == 0:
+        return np.zeros(n_rows, dtype=np.int64), np.zeros(n_rows, dtype=np.float64)
+
+    valid = codes >= 0
+    # 每列排序後，與前一個值不同即為新類別的開始
+    run_start = valid.copy()
+    run_start[:, 1:] &= codes[:, 1:] != codes[:, :-1]
+    unique_counts = run_start.sum(axis=1)
+
+    # 每段連續相同類別的長度即為該類別的出現次數
+    run_ids = np.cumsum(run_start.ravel()) - 1
+    valid_flat = valid.ravel()
+    run_lengths = np.bincount(run_ids[valid_flat], minlength=int(unique_counts.sum()))
+    run_rows = np.repeat(np.arange(n_rows), unique_counts)
+    totals = valid.sum(axis=1)
+
+    probabilities = run_lengths / np.maximum(totals[run_rows], 1)
+    entropy = -np.bincount(run_rows, weights=probabilities * np.log2(probabilities), minlength=n_rows)
+    return unique_counts, entropy + 0.0  # 將 -0.0 正規化為 0.0
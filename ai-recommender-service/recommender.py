@@ -1,16 +1,46 @@
-import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
 import os
-import pickle
 import redis
-import random
-import time
 import mysql.connector
 import asyncio # 新增
+from datetime import timedelta
+import threading
+import time
+import logging
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from item_similarity import NeighborIndex, DEFAULT_TOP_K
+from scoring import ScoringEngine
+from als import ALSModel, ALSEngine
+from diversity import MMR_CANDIDATES, maximal_marginal_relevance, neighbor_similarity_lookup
+from catalog import CatalogIndex
+from popularity import PopularityEngine
+from recent_views import RecentViewsStore
+from result_cache import RecommendationResultCache
+from model_store import ModelStore
+from trainer import run_training_job, run_incremental_job
+from mysql_pool import get_mysql_connection
+from materialization import (
+    MATERIALIZE_ENABLED, MATERIALIZE_MAX_USERS, MATERIALIZED_REQUESTS, MaterializedRecommendations, run_materialization,
+)
+from instrumentation import MODEL_TRAINING_DURATION, STRATEGY_LABELS, log_sampled, observe_stage, record_model_swap, timed_stage
+
+# 增量同步商品時與上次水位重疊的秒數 (涵蓋同一秒內稍晚提交的更新)
+PRODUCT_SYNC_OVERLAP_SECONDS = int(os.getenv('PRODUCT_SYNC_OVERLAP_SECONDS', 2))
+# 多個 uvicorn worker 之間只由持有此 Redis 鎖的 worker 訓練與預先計算，其他 worker 經由版本指標載入結果
+TRAINING_LEADER_KEY = "model:training_leader"
+# 鎖的租期；leader 每次排程訓練 (預設每 5 分鐘) 時延長，程序結束後最多這麼久由其他 worker 接手
+TRAINING_LEADER_LOCK_SECONDS = int(os.getenv('TRAINING_LEADER_LOCK_SECONDS', 900))
+# 只在鎖仍屬於自己時延長 / 釋放，不會動到其他 worker 取得的鎖
+_RENEW_LEADER_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end return 0"
+_RELEASE_LEADER_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
 
 class Recommender:
-    def __init__(self, model_path="model/item_similarity_model.pkl"):
-        self.model_path = model_path
+    def __init__(self, model_dir=None, top_k=None):
+        self.model_dir = model_dir or os.getenv('MODEL_DIR', 'model')
+        self.top_k = top_k or int(os.getenv('MODEL_TOP_K', DEFAULT_TOP_K))
         
         try:
             self.redis_client = redis.Redis(host=os.getenv('REDIS_HOST', 'redis'), port=int(os.getenv('REDIS_PORT', 6379)), db=0)
@@ -20,6 +50,22 @@ class Recommender:
             print(f"Recommender: Could not connect to Redis: {e}. Model caching might be affected.")
             self.redis_client = None
             
+        # 模型以版本化的 memmap 格式存放在 model_dir，Redis 只保存版本指標
+        self.model_store = ModelStore(self.model_dir, 'item_similarity', redis_client=self.redis_client)
+        # v3 策略的 ALS 模型，版本由相似度模型的 header 指定，兩者一起換上
+        self.als_store = ModelStore(self.model_dir, 'als')
+        # 完整重建後為活躍用戶預先計算的推薦清單 (版本指標經由 Redis 發佈給其他 worker)
+        self.materialized_store = ModelStore(self.model_dir, 'materialized', redis_client=self.redis_client)
+        self.materialized = MaterializedRecommendations.empty()
+        self.training_in_progress = False
+        self.materialization_in_progress = False
+        self._training_executor = None
+        # 序列化訓練工作的 asyncio.Lock，於第一次訓練時在事件迴圈中建立
+        self._training_lock = None
+        self._leader_token = f"{os.getpid()}:{uuid.uuid4().hex}"
+        # 保護評分引擎的替換 (產品同步與模型載入可能在不同執行緒中發生)
+        self._swap_lock = threading.Lock()
+
         self.mysql_config = {
             'host': os.getenv('MYSQL_HOST', 'mysql'),
             'port': int(os.getenv('MYSQL_PORT', 3306)),
@@ -27,31 +73,37 @@ class Recommender:
             'password': os.getenv('MYSQL_PASSWORD', 'laravel_password'),
             'database': os.getenv('MYSQL_DB', 'laravel')
         }
-        self._mysql_conn = None # 使用單下劃線表示為內部屬性
 
-        # 初始化時加載數據和模型
+        # 產品資料與模型由 load_initial_state / 排程器載入，建構時不連線 MySQL、不訓練
         self.products = {} # 初始化為空字典
-        self.item_similarity_df = pd.DataFrame() # 初始化為空 DataFrame
+        self._product_sync_watermark = None # 增量同步的 products.updated_at 水位
+        # 用戶最近瀏覽 (Redis 環形緩衝區 + 本機 LRU)，事件由 start 後的背景消費者寫入
+        self.recent_views = RecentViewsStore(self.redis_client)
+        # 推薦結果快取 (本機 LRU + Redis)，key 含模型版本與產品快照指紋
+        self.result_cache = RecommendationResultCache()
+        # 活躍商品、類別分桶等緊湊陣列，每次產品同步時重建一次
+        self.catalog = CatalogIndex(self.products)
+        # 設定 RECOMMENDATION_SEED 時補充與探索取樣可重現 (測試、基準測試)
+        seed = os.getenv('RECOMMENDATION_SEED')
+        self._rng = np.random.default_rng(int(seed) if seed else None)
+        self.scoring_engine = ScoringEngine(NeighborIndex.empty(self.top_k), self.catalog)
+        self.als_engine = ALSEngine(ALSModel.empty(), self.catalog)
+        # 冷啟動用的時間衰減熱門商品，由排程器增量同步 recommendation_events
+        self.popularity = PopularityEngine(self.mysql_config)
 
-        # 首次加載
+    def load_initial_state(self):
+        """同步載入產品資料，並映射磁碟上最後一個可用的模型 (memmap，幾乎不耗時)。"""
         self.update_product_data()
-        self.train_and_save_model() # 首次啟動時訓練或加載模型
-
+        self.refresh_model()
 
     def _get_mysql_connection(self):
-        """獲取 MySQL 連接"""
-        if self._mysql_conn is None or not self._mysql_conn.is_connected():
-            try:
-                self._mysql_conn = mysql.connector.connect(**self.mysql_config)
-                print("Recommender: Successfully connected to MySQL.")
-            except mysql.connector.Error as err:
-                print(f"Recommender: Error connecting to MySQL: {err}")
-                self._mysql_conn = None
-        return self._mysql_conn
+        """從本程序的連線池獲取 MySQL 連接 (與互動資料讀取共用，close() 即歸還連線池)"""
+        return get_mysql_connection(self.mysql_config, owner="Recommender")
 
     def _load_products_from_mysql(self):
         """
         從 MySQL 資料庫加載產品數據，只獲取 status = 'active' 的商品。
+        同時記錄 products.updated_at 的最大值，作為之後增量同步的水位。
         """
         print("Recommender: Loading active products from MySQL.")
         products_data = {}
@@ -59,66 +111,68 @@ class Recommender:
         if conn:
             try:
                 cursor = conn.cursor(dictionary=True)
+                # 先取水位再讀資料：讀取期間的變更會在下一次增量同步中被重新讀到
+                cursor.execute("SELECT MAX(updated_at) AS watermark FROM products")
+                watermark = cursor.fetchone()['watermark']
                 cursor.execute("SELECT id, name, category_id, price, image_url, status FROM products WHERE status = 'active'")
                 for row in cursor:
-                    products_data[row['id']] = {
-                        'name': row['name'],
-                        'category_id': row['category_id'],
-                        'price': float(row['price']), # Ensure price is float
-                        'image_url': row['image_url'],
-                        'status': row['status']
-                    }
+                    products_data[row['id']] = self._product_info(row)
                 cursor.close()
+                if products_data:
+                    self._product_sync_watermark = watermark
             except mysql.connector.Error as err:
                 print(f"Error fetching products from MySQL: {err}")
             finally:
-                if conn.is_connected():
-                    conn.close() # 每次查詢後關閉連接
+                conn.close() # 歸還連線池
         
         if not products_data:
             print("No active products loaded from MySQL. Falling back to dummy active products for testing.")
             return self._load_dummy_products(active_only=True) # 如果資料庫無數據，仍使用模擬數據
         return products_data
 
-    def _load_user_interactions_from_mysql(self):
+    def _load_product_changes_from_mysql(self):
         """
-        從 MySQL 資料庫加載用戶互動數據 (例如 recommendation_events)。
+        增量同步：只讀取 updated_at 在水位之後 (含 PRODUCT_SYNC_OVERLAP_SECONDS 的重疊區間) 變更的商品，
+        包含被下架或售罄的商品。返回 {product_id: info}；尚未有水位或無法連線時返回 None。
         """
-        print("Recommender: Loading user interactions from MySQL for model training...")
-        interactions_data = []
+        if self._product_sync_watermark is None:
+            return None
         conn = self._get_mysql_connection()
-        if conn:
-            try:
-                cursor = conn.cursor(dictionary=True)
-                # 假設 'action' 為 'click' 或 'purchase' 視為有效互動
-                # 您可能需要定義一個 rating_value 映射，例如 click=1, purchase=5
-                cursor.execute("""
-                    SELECT user_id, product_id, action, COUNT(*) as interaction_count
-                    FROM recommendation_events
-                    WHERE product_id IS NOT NULL AND user_id IS NOT NULL
-                    GROUP BY user_id, product_id, action
-                    ORDER BY user_id, product_id, action
-                """)
-                for row in cursor:
-                    # 簡單地將點擊和購買轉化為評分，購買權重更高
-                    rating = 1 if row['action'] == 'click' else (5 if row['action'] == 'purchase' else 0)
-                    if rating > 0:
-                        interactions_data.append({
-                            'user_id': row['user_id'],
-                            'product_id': row['product_id'],
-                            'rating': rating * row['interaction_count'] # 可以根據互動次數加權
-                        })
-                cursor.close()
-            except mysql.connector.Error as err:
-                print(f"Error fetching user interactions from MySQL: {err}")
-            finally:
-                if conn.is_connected():
-                    conn.close()
-        
-        if not interactions_data:
-            print("No real user interaction data from MySQL. Using dummy interaction data for training.")
-            return self._load_dummy_interactions() # 如果資料庫無數據，仍使用模擬數據
-        return pd.DataFrame(interactions_data)
+        if not conn:
+            return None
+        changes = {}
+        try:
+            cursor = conn.cursor(dictionary=True)
+            # 重疊區間涵蓋同一秒內稍晚提交的更新；重複讀到的商品在套用時會被略過
+            since = self._product_sync_watermark - timedelta(seconds=PRODUCT_SYNC_OVERLAP_SECONDS)
+            cursor.execute("""
+                SELECT id, name, category_id, price, image_url, status, updated_at
+                FROM products
+                WHERE updated_at >= %s
+                ORDER BY updated_at
+            """, (since,))
+            watermark = self._product_sync_watermark
+            for row in cursor:
+                changes[row['id']] = self._product_info(row)
+                watermark = max(watermark, row['updated_at'])
+            cursor.close()
+            self._product_sync_watermark = watermark
+        except mysql.connector.Error as err:
+            print(f"Error fetching product changes from MySQL: {err}")
+            return None
+        finally:
+            conn.close() # 歸還連線池
+        return changes
+
+    @staticmethod
+    def _product_info(row):
+        return {
+            'name': row['name'],
+            'category_id': row['category_id'],
+            'price': float(row['price']), # Ensure price is float
+            'image_url': row['image_url'],
+            'status': row['status']
+        }
 
     def _load_dummy_products(self, active_only=False):
         """
@@ -148,18 +202,6 @@ class Recommender:
             return {pid: info for pid, info in all_products.items() if info['status'] == 'active'}
         return all_products
 
-    def _load_dummy_interactions(self):
-        """
-        硬編碼的假數據用於訓練。
-        """
-        dummy_data = {
-            'user_id': [1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 1, 2, 3, 4, 5, 1, 2, 3, 4, 5],
-            'product_id': [1, 2, 3, 4, 1, 5, 2, 6, 3, 7, 8, 9, 10, 11, 12, 13, 14, 15, 1, 2],
-            'rating': [5, 4, 5, 3, 4, 5, 3, 4, 5, 3, 2, 1, 5, 4, 3, 5, 4, 3, 2, 1]
-        }
-        return pd.DataFrame(dummy_data)
-
-
     # 新增：用於排程器定時調用以更新產品數據
     def update_product_data(self):
         """
@@ -169,176 +211,486 @@ class Recommender:
         """
         print("Recommender: Starting product data synchronization...")
         try:
-            new_products = self._load_products_from_mysql()
-            if new_products:
-                self.products = new_products
-                print(f"Product data updated successfully. Total active products: {len(self.products)}")
-            else:
-                print("No new product data to update or MySQL connection failed.")
+            self._apply_products(self._load_products_from_mysql())
         except Exception as e:
             print(f"Error during product data update: {e}")
 
-    # 新增：用於排程器定時調用以訓練和保存模型
-    def train_and_save_model(self):
+    async def update_product_data_async(self):
+        """排程器使用的非阻塞版本：MySQL 查詢在執行緒中進行，完成後在事件迴圈中替換產品資料。"""
+        print("Recommender: Starting product data synchronization...")
+        try:
+            new_products = await asyncio.to_thread(self._load_products_from_mysql)
+            self._apply_products(new_products)
+        except Exception as e:
+            print(f"Error during product data update: {e}")
+
+    def _apply_products(self, new_products):
+        if new_products:
+            catalog = CatalogIndex(new_products)
+            with self._swap_lock:
+                changed = catalog.fingerprint != self.catalog.fingerprint
+                self.products = new_products
+                self.catalog = catalog
+                # 活躍狀態變動後需重建評分引擎的活躍遮罩
+                engine = self.scoring_engine
+                self.scoring_engine = ScoringEngine(engine.index, self.catalog, engine.model_version, engine.trained_at)
+                als_engine = self.als_engine
+                self.als_engine = ALSEngine(als_engine.model, self.catalog, als_engine.model_version, als_engine.trained_at)
+            if changed:
+                self.popularity.rebuild(self.catalog)
+                self.result_cache.invalidate()
+            print(f"Product data updated successfully. Total active products: {self.catalog.active_count}")
+        else:
+            print("No new product data to update or MySQL connection failed.")
+
+    async def sync_product_changes_async(self):
         """
-        這個方法將會被排程器調用，負責：
-        1. 從 MySQL 獲取最新的用戶互動數據
-        2. 重新訓練推薦模型
-        3. 將新模型保存到文件和 Redis
-        4. 熱更新當前 Recommender 實例中的模型
+        排程器每幾秒調用：MySQL 查詢在執行緒中進行，變更在事件迴圈中套用到新的產品目錄與評分引擎活躍遮罩，
+        下架的商品在下一個請求就不會再被推薦，不需要重建模型。
         """
-        print("Recommender: Starting model retraining process...")
         try:
-            df = self._load_user_interactions_from_mysql()
-            if df.empty:
-                print("No user interaction data for retraining. Skipping model retraining.")
-                return
-
-            # 過濾掉那些不在當前活躍產品列表中的互動數據，確保模型只考慮活躍產品
-            active_product_ids = set(self.products.keys())
-            df = df[df['product_id'].isin(active_product_ids)]
-            
-            if df.empty:
-                print("No relevant interaction data for active products after filtering. Skipping model retraining.")
-                return
+            changes = await asyncio.to_thread(self._load_product_changes_from_mysql)
+            if changes:
+                self._apply_product_changes(changes)
+        except Exception as e:
+            print(f"Error during product delta sync: {e}")
 
-            user_product_matrix = df.pivot_table(index='user_id', columns='product_id', values='rating').fillna(0)
-            
-            # 確保矩陣中至少有兩個產品才進行相似度計算，避免錯誤
-            if user_product_matrix.shape[1] < 2:
-                print("Not enough unique products in interactions to train similarity model. Skipping.")
-                return
-
-            new_item_similarity_df = pd.DataFrame(cosine_similarity(user_product_matrix.T),
-                                                  index=user_product_matrix.columns,
-                                                  columns=user_product_matrix.columns)
-            
-            # 保存新模型到文件
-            os.makedirs(os.path.dirname(self.model_path), exist_ok=True)
-            with open(self.model_path, 'wb') as f:
-                pickle.dump(new_item_similarity_df, f)
-            print(f"Model saved to file: {self.model_path}")
-
-            # 保存新模型到 Redis
-            if self.redis_client:
-                cache_key = 'item_similarity_model_cache'
-                self.redis_client.setex(cache_key, 86400, pickle.dumps(new_item_similarity_df)) # Cache for 1 day
-                print("Model saved to Redis cache.")
-            else:
-                print("Redis client not available, skipping model caching to Redis.")
-            
-            # 熱更新當前實例的模型
-            self.item_similarity_df = new_item_similarity_df
-            print("Model retraining and hot-swapping completed successfully.")
+    async def sync_popularity_async(self):
+        """排程器定期調用：在執行緒中讀取新的互動事件，更新熱門商品計數並以目前的產品目錄重建熱門清單。"""
+        try:
+            await asyncio.to_thread(self._sync_popularity)
+        except Exception as e:
+            print(f"Error during popularity sync: {e}")
+
+    def _sync_popularity(self):
+        if self.popularity.sync() is None:
+            return
+        while True:
+            catalog = self.catalog
+            self.popularity.rebuild(catalog)
+            # 重建期間產品目錄被替換時，事件迴圈上以新目錄的重建可能先發佈，
+            # 以新目錄再重建一次，避免舊目錄的清單 (含已下架商品) 覆蓋它
+            if self.catalog is catalog:
+                break
+
+    def popular_products(self, num_recommendations: int = 10, category_id=None) -> list[int]:
+        """/popular 端點使用：返回預先排好的熱門商品 (可指定類別)；尚無事件資料時隨機取活躍商品。"""
+        if category_id is not None:
+            return self.popularity.top(num_recommendations, category_id=category_id)
+        return self._fallback_recommendations(num_recommendations, [])
+
+    def _apply_product_changes(self, changes):
+        # 重疊區間會重複讀到已套用的商品，只保留內容真的改變的
+        changes = {pid: info for pid, info in changes.items() if self.products.get(pid) != info}
+        if not changes:
+            return
+        with self._swap_lock:
+            # 複製後套用再以單一參考替換 (與模型熱更新相同)；批次推薦、熱門同步與預先計算仍可安全讀取舊的快照
+            catalog, changed_ids, active = self.catalog.with_changes(changes)
+            changed_ids = changed_ids.tolist()
+            self.products = {**self.products, **changes}
+            self.catalog = catalog
+            self.scoring_engine = self.scoring_engine.with_active_changes(changed_ids, active)
+            self.als_engine = self.als_engine.with_active_changes(changed_ids, active)
+        self.popularity.rebuild(self.catalog)
+        self.result_cache.invalidate()
+        print(f"Applied {len(changes)} product changes. Total active products: {self.catalog.active_count}")
+
+    async def train_and_save_model_async(self):
+        """
+        這個方法將會被排程器調用，負責：
+        1. 在獨立的訓練程序中從 MySQL 獲取互動數據、完整重建並保存模型，不阻塞事件迴圈
+        2. 訓練完成後以 memmap 載入新版本，並以單一參考替換原子地熱更新
+        3. 將新版本指標發佈到 Redis
+        訓練期間持續以上一個可用模型提供服務。
+        """
+        # 完整重建不能因增量更新正在執行而略過 (否則要再等 6 小時)，排在它之後執行
+        version = await self._run_training_job_async(run_training_job, wait=True)
+        if version:
+            await self.materialize_recommendations_async()
+
+    async def update_model_incremental_async(self):
+        """排程器每幾分鐘調用：只將高水位之後的新事件併入模型，重算受影響商品的鄰居列表。"""
+        await self._run_training_job_async(run_incremental_job)
+
+    async def _run_training_job_async(self, job, wait=False):
+        """
+        在訓練程序中執行 job 並熱更新，返回新模型版本 (沒有新版本或失敗時返回 None)。
+        同一時間只執行一個訓練工作：wait=True 時等待正在執行的工作結束後再執行，否則直接略過。
+        """
+        if not await asyncio.to_thread(self._hold_training_leadership):
+            print(f"Another worker holds the training lock. Skipping {job.__name__}.")
+            return None
+        if self._training_lock is None:
+            self._training_lock = asyncio.Lock()
+        if self._training_lock.locked():
+            if not wait:
+                print(f"Model training already in progress. Skipping {job.__name__}.")
+                return None
+            print(f"Model training already in progress. Queuing {job.__name__} until it finishes.")
+        async with self._training_lock:
+            self.training_in_progress = True
+            try:
+                return await self._run_training_job_locked(job)
+            finally:
+                self.training_in_progress = False
+
+    async def _run_training_job_locked(self, job):
+        version = None
+        try:
+            loop = asyncio.get_running_loop()
+            start = time.perf_counter()
+            version = await loop.run_in_executor(self._get_training_executor(), job, *self._training_job_args())
+            MODEL_TRAINING_DURATION.labels(job=job.__name__).set(time.perf_counter() - start)
+            if version:
+                # 讀取 header、建立引擎等在執行緒中進行，事件迴圈只會在參考替換時短暫等待 _swap_lock
+                await asyncio.to_thread(self._activate_model_version, version)
+        except BrokenProcessPool as e:
+            # 訓練程序異常終止 (例如 OOM)，丟棄執行器，下次訓練時重建
+            print(f"Training process terminated abruptly: {e}")
+            self._training_executor = None
         except Exception as e:
             print(f"Error during model retraining: {e}")
             import traceback
             traceback.print_exc() # 打印完整的錯誤堆棧
+        return version
 
-    def _get_user_recent_views(self, user_id: int):
+    async def materialize_recommendations_async(self):
         """
-        從 MySQL 或 Redis 獲取用戶最近的瀏覽產品。
-        這裡為了示例仍用隨機數據，但會過濾掉非活躍產品。
+        完整重建後調用：在程序池中為最近有瀏覽的活躍用戶預先計算各策略的推薦清單，
+        寫入 'materialized' ModelStore 後載入並發佈版本，/recommend 之後可直接讀取。
         """
-        print(f"Fetching recent views for user {user_id} (placeholder).")
-        
-        active_product_ids = list(self.products.keys())
-        if not active_product_ids:
-            return [] # 如果沒有活躍產品，則沒有最近瀏覽
+        if not MATERIALIZE_ENABLED or self.materialization_in_progress or not self.is_ready:
+            return
+        if not await asyncio.to_thread(self._hold_training_leadership):
+            return
+        self.materialization_in_progress = True
+        try:
+            loop = asyncio.get_running_loop()
+            start = time.perf_counter()
+            version = await loop.run_in_executor(None, self._materialize)
+            MODEL_TRAINING_DURATION.labels(job='materialize').set(time.perf_counter() - start)
+            if version:
+                await asyncio.to_thread(self._load_materialized_version, version)
+                self.materialized_store.publish(version)
+        except Exception as e:
+            print(f"Error during recommendation materialization: {e}")
+            import traceback
+            traceback.print_exc()
+        finally:
+            self.materialization_in_progress = False
 
-        random.seed(user_id + int(time.time() / 3600))
-        # 確保只從活躍產品中選擇
-        viewed_products = random.sample(active_product_ids, k=min(len(active_product_ids), random.randint(2, 5)))
-        return viewed_products
+    def _materialize(self):
+        user_ids = self.recent_views.active_user_ids(MATERIALIZE_MAX_USERS)
+        if not user_ids:
+            print("Materialization: No active users found. Skipping.")
+            return None
+        print(f"Materialization: Computing recommendations for {len(user_ids)} active users.")
+        # 熱門度計數一併傳給程序池，補充的熱門商品與線上服務一致
+        return run_materialization(self.model_dir, self.top_k, self.model_version, self.products, user_ids,
+                                   popularity=self.popularity.counts.snapshot())
 
-    def get_recommendations(self, user_id: int, strategy_version: str = 'v1', num_recommendations: int = 10) -> list[int]:
+    def _hold_training_leadership(self):
         """
-        根據用戶 ID 和策略版本獲取推薦產品 ID 列表。
-        會過濾掉非活躍商品。
+        以 Redis SET NX EX 取得 (或延長自己持有的) 訓練鎖，返回此 worker 是否為 leader (應在執行緒中調用)。
+        沒有 Redis 時視為單一 worker；Redis 暫時無法使用時本輪略過，下一輪再嘗試。
+        """
+        if self.redis_client is None:
+            return True
+        try:
+            if self.redis_client.set(TRAINING_LEADER_KEY, self._leader_token, nx=True, ex=TRAINING_LEADER_LOCK_SECONDS):
+                print("Recommender: Acquired the training lock; this worker runs training and materialization.")
+                return True
+            return bool(self.redis_client.eval(_RENEW_LEADER_SCRIPT, 1, TRAINING_LEADER_KEY, self._leader_token,
+                                               TRAINING_LEADER_LOCK_SECONDS))
+        except redis.exceptions.RedisError as e:
+            print(f"Recommender: Could not check the training lock: {e}")
+            return False
+
+    def _release_training_leadership(self):
+        if self.redis_client is None:
+            return
+        try:
+            self.redis_client.eval(_RELEASE_LEADER_SCRIPT, 1, TRAINING_LEADER_KEY, self._leader_token)
+        except redis.exceptions.RedisError as e:
+            print(f"Recommender: Could not release the training lock: {e}")
+
+    def _get_training_executor(self):
+        # 模型訓練在獨立程序中執行；使用 spawn 避免 fork 帶有事件迴圈與連線的服務程序
+        if self._training_executor is None:
+            self._training_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        return self._training_executor
+
+    def shutdown(self):
+        if self._training_executor is not None:
+            self._training_executor.shutdown(wait=False, cancel_futures=True)
+            self._training_executor = None
+        # 讓其他 worker 不必等租期到期即可接手訓練
+        self._release_training_leadership()
+
+    def _training_job_args(self):
+        return (self.mysql_config, self.model_dir, self.top_k)
+
+    def _activate_model_version(self, version):
+        self._load_model_version(version)
+        self.model_store.publish(version)
+        print(f"Model version {version} hot-swapped successfully.")
+
+    @property
+    def neighbor_index(self):
+        return self.scoring_engine.index
+
+    @property
+    def model_version(self):
+        return self.scoring_engine.model_version
+
+    @property
+    def is_ready(self):
+        """是否已有可用的模型；尚未就緒時推薦會退回到活躍商品補充。"""
+        return not self.scoring_engine.is_empty
+
+    def status(self):
+        return {
+            'model_ready': self.is_ready,
+            'model_version': self.model_version,
+            'model_trained_at': self.scoring_engine.trained_at,
+            'als_model_version': self.als_engine.model_version,
+            'training_in_progress': self.training_in_progress,
+            'active_products': self.catalog.active_count,
+            'materialized_version': self.materialized.version,
+            'materialized_users': len(self.materialized),
+        }
+
+    def refresh_model(self):
         """
-        print(f"Generating recommendations for user {user_id} using strategy {strategy_version}")
+        檢查目前發佈的模型版本 (Redis 指標或 CURRENT 檔案)，有新版本時以 memmap 載入並熱更新。
+        其他 worker 訓練出的新模型也會經由此方法被載入 (排程器在執行緒中調用，不在事件迴圈上載入)。
+        """
+        try:
+            version = self.model_store.current_version()
+            if version and version != self.model_version:
+                self._load_model_version(version)
+                print(f"Model version {version} loaded from {self.model_store.directory}")
+            materialized_version = self.materialized_store.current_version()
+            if materialized_version and materialized_version != self.materialized.version:
+                self._load_materialized_version(materialized_version)
+        except Exception as e:
+            print(f"Error loading model from store: {e}")
+
+    def _load_materialized_version(self, version):
+        header, arrays = self.materialized_store.load(version)
+        if header is None:
+            return
+        record_model_swap('materialized', arrays)
+        self.materialized = MaterializedRecommendations.from_arrays(arrays, header)
+        print(f"Materialized recommendations version {version} loaded ({len(self.materialized)} users).")
+
+    def _load_model_version(self, version):
+        """
+        載入指定版本並熱更新 (應在執行緒中調用)：讀取與建立引擎都在鎖外進行，
+        _swap_lock 內只做參考替換；準備期間產品目錄已被替換時，才在鎖內以新目錄重建活躍遮罩。
+        """
+        header, arrays = self.model_store.load(version)
+        if header is None:
+            return
+        neighbor_index = NeighborIndex.from_arrays(arrays, header['metadata'])
+        record_model_swap('item_similarity', arrays)
+        als_version = header['metadata'].get('als_version')
+        als_model, als_header = None, None
+        if als_version and als_version != self.als_engine.model_version:
+            als_header, als_arrays = self.als_store.load(als_version)
+            if als_header is not None:
+                als_model = ALSModel.from_arrays(als_arrays, als_header['metadata'])
+                record_model_swap('als', als_arrays)
+
+        def build_engines(catalog):
+            scoring_engine = ScoringEngine(neighbor_index, catalog, header['model_version'], header['trained_at'])
+            als_engine = None
+            if als_model is not None:
+                als_engine = ALSEngine(als_model, catalog, als_header['model_version'], als_header['trained_at'])
+            return scoring_engine, als_engine
 
-        viewed_products = self._get_user_recent_views(user_id)
-        print(f"User {user_id} viewed products: {viewed_products}")
+        catalog = self.catalog
+        scoring_engine, als_engine = build_engines(catalog)
+        with self._swap_lock:
+            if self.catalog is not catalog:
+                scoring_engine, als_engine = build_engines(self.catalog)
+            # 以單一參考替換完成熱更新，進行中的請求仍使用舊引擎
+            self.scoring_engine = scoring_engine
+            if als_engine is not None:
+                self.als_engine = als_engine
+        self.result_cache.invalidate()
 
-        all_active_product_ids = list(self.products.keys())
-        if not all_active_product_ids:
-            print("No active products available in catalog. Returning empty recommendations.")
+    def _get_user_recent_views(self, user_id: int):
+        """
+        從最近瀏覽存儲 (本機 LRU → Redis 環形緩衝區) 獲取用戶最近的瀏覽產品。
+        返回 (商品 ID 列表 (最新在前), 時間衰減權重)。
+        """
+        return self.recent_views.get(user_id)
+
+    def get_recommendations(self, user_id: int, strategy_version: str = 'v1', num_recommendations: int = 10, recent_views=None) -> list[int]:
+        """
+        根據用戶 ID 和策略版本獲取推薦產品 ID 列表。
+        會過濾掉非活躍商品。recent_views 為呼叫端已取得的 (商品 ID, 權重)，未提供時同步查詢。
+        """
+        if recent_views is None:
+            with timed_stage('history_fetch', strategy_version):
+                recent_views = self._get_user_recent_views(user_id)
+        viewed_products, view_weights = recent_views
+        # 每個請求都會經過這裡，改為抽樣的結構化日誌 (完整的瀏覽清單只在 DEBUG 等級輸出)
+        log_sampled(logging.INFO, 'recommendation_request', user_id=user_id, strategy_version=strategy_version, viewed_count=len(viewed_products))
+        log_sampled(logging.DEBUG, 'recommendation_history', user_id=user_id, viewed_products=viewed_products)
+
+        if not self.catalog.active_count:
+            log_sampled(logging.WARNING, 'no_active_products', user_id=user_id)
             return []
 
-        generated_recommendations = []
+        start = time.perf_counter()
+        base_recommendations, base_scores = [], None
+        if strategy_version == 'v1' and viewed_products:
+            # 向量化評分：越近期的瀏覽權重越高，已排除已看過與非活躍的商品
+            base_recommendations = self.scoring_engine.recommend(viewed_products, num_recommendations, view_weights)
+        elif strategy_version == 'v2' and viewed_products:
+            # MMR 重排的候選：相似度最高的 C 個商品與其分數
+            engine = self.scoring_engine
+            rows, base_scores = engine.top_candidates(viewed_products, self._mmr_candidate_count(num_recommendations), view_weights)
+            base_recommendations = engine.product_ids[rows].tolist()
+        elif strategy_version == 'v3':
+            # 矩陣分解：一次矩陣-向量乘積 + top-k；不在訓練資料中的用戶以最近瀏覽 fold-in
+            base_recommendations = self.als_engine.recommend(user_id, viewed_products, num_recommendations, view_weights)
+        elif strategy_version not in ('v1', 'v2'):
+            log_sampled(logging.WARNING, 'unknown_strategy', user_id=user_id, strategy_version=strategy_version)
+        observe_stage('scoring', strategy_version, time.perf_counter() - start)
+
+        return self._finalize_recommendations(strategy_version, base_recommendations, viewed_products, num_recommendations, base_scores)
+
+    async def get_recommendations_cached(self, user_id: int, strategy_version: str = 'v1', num_recommendations: int = 10) -> tuple[list[int], bool]:
+        """
+        單一推薦端點使用：先查預先計算的清單，再查結果快取，都未命中時計算並寫回結果快取。
+        最近瀏覽改變、換上新模型或新產品快照後 key 隨之改變，不會返回過期的結果。
+        返回 (推薦商品 ID, 是否為冷啟動 (沒有任何最近瀏覽，推薦來自熱門商品))。
+        """
+        with timed_stage('history_fetch', strategy_version):
+            recent_views = await self.recent_views.get_async(user_id)
+        cold_start = not recent_views[0]
+        # 快速路徑：預先計算的清單 (O(1) 查詢)，最近瀏覽已改變或含下架商品時即時計算
+        with timed_stage('materialized_lookup', strategy_version):
+            result, recommended_product_ids = self.materialized.lookup(user_id, strategy_version, num_recommendations, recent_views[0], self.catalog)
+        MATERIALIZED_REQUESTS.labels(strategy_version=strategy_version if strategy_version in STRATEGY_LABELS else 'other', result=result).inc()
+        if recommended_product_ids is not None:
+            return recommended_product_ids, cold_start
+        engine, catalog = self.scoring_engine, self.catalog
+        cache_key = self.result_cache.key(
+            user_id, strategy_version, num_recommendations, recent_views[0], engine.model_version, catalog.fingerprint
+        )
+        with timed_stage('result_cache_lookup', strategy_version):
+            recommended_product_ids = await self.result_cache.get(cache_key)
+        if recommended_product_ids is None:
+            recommended_product_ids = self.get_recommendations(user_id, strategy_version, num_recommendations, recent_views=recent_views)
+            self.result_cache.put(cache_key, recommended_product_ids)
+        return recommended_product_ids, cold_start
 
+    def get_batch_recommendations(self, user_ids: list[int], strategy_version: str = 'v1', num_recommendations: int = 10) -> list[list[int]]:
+        """
+        批次為多個用戶生成推薦，相似度評分以一次稀疏矩陣乘法完成。
+        返回與 user_ids 順序一致的推薦商品 ID 列表。
+        """
+        if not self.catalog.active_count:
+            return [[] for _ in user_ids]
+
+        with timed_stage('batch_history_fetch', strategy_version):
+            recent_views = self.recent_views.get_many(user_ids)
+        histories = [viewed_products for viewed_products, _ in recent_views]
+        start = time.perf_counter()
+        base_scores = [None for _ in user_ids]
         if strategy_version == 'v1':
-            if viewed_products and not self.item_similarity_df.empty:
-                available_viewed_products = [p for p in viewed_products if p in self.item_similarity_df.columns and p in self.products and self.products[p]['status'] == 'active']
-                
-                if available_viewed_products:
-                    seen_products_df = self.item_similarity_df[available_viewed_products]
-                    sum_similarities = seen_products_df.sum(axis=1)
-
-                    # 篩選掉非活躍產品和已看過的產品
-                    candidate_recommendations = sum_similarities.drop(viewed_products, errors='ignore').sort_values(ascending=False).index.tolist()
-                    
-                    for pid in candidate_recommendations:
-                        if pid in self.products and self.products[pid]['status'] == 'active':
-                            generated_recommendations.append(pid)
-                        if len(generated_recommendations) >= num_recommendations:
-                            break
-                
-            if len(generated_recommendations) < num_recommendations:
-                # 從所有活躍產品中隨機補充
-                remaining_active_products = [p for p in all_active_product_ids if p not in generated_recommendations and p not in viewed_products]
-                random.shuffle(remaining_active_products)
-                generated_recommendations.extend(remaining_active_products[:num_recommendations - len(generated_recommendations)])
-                
+            base_lists = self.scoring_engine.recommend_batch(histories, num_recommendations, [weights for _, weights in recent_views])
         elif strategy_version == 'v2':
-            print(f"Applying v2 strategy for user {user_id} (more diverse recommendation).")
-            base_recommendations = []
-            if viewed_products and not self.item_similarity_df.empty:
-                available_viewed_products = [p for p in viewed_products if p in self.item_similarity_df.columns and p in self.products and self.products[p]['status'] == 'active']
-                if available_viewed_products:
-                    seen_products_df = self.item_similarity_df[available_viewed_products]
-                    sum_similarities = seen_products_df.sum(axis=1)
-                    # 先生成所有可能的相似推薦，稍後再過濾活躍和未看過
-                    base_candidate_pids = sum_similarities.drop(viewed_products, errors='ignore').sort_values(ascending=False).index.tolist()
-                    for pid in base_candidate_pids:
-                        if pid in self.products and self.products[pid]['status'] == 'active':
-                            base_recommendations.append(pid)
-                        if len(base_recommendations) >= num_recommendations * 2: # 獲取多一點作為基礎
-                            break
-
-            diverse_products = []
-            shuffled_active_product_ids = all_active_product_ids[:]
-            random.shuffle(shuffled_active_product_ids)
-
-            selected_categories = set()
-            for pid in shuffled_active_product_ids:
-                if pid not in viewed_products and pid not in base_recommendations: # 確保不重複
-                    product_info = self.products.get(pid)
-                    if product_info and product_info['status'] == 'active':
-                        category = product_info.get('category_id')
-                        if category and category not in selected_categories:
-                            diverse_products.append(pid)
-                            selected_categories.add(category)
-                            if len(diverse_products) >= num_recommendations // 2:
-                                break
-            
-            # 合併基礎推薦和多樣性推薦，並確保唯一性
-            combined_recommendations = list(set(base_recommendations[:num_recommendations // 2] + diverse_products))
-            random.shuffle(combined_recommendations)
-
-            # 最終填充到足夠數量 (從所有活躍產品中隨機補充)
-            if len(combined_recommendations) < num_recommendations:
-                remaining_active_products = [p for p in all_active_product_ids if p not in combined_recommendations and p not in viewed_products]
-                random.shuffle(remaining_active_products)
-                combined_recommendations.extend(remaining_active_products[:num_recommendations - len(combined_recommendations)])
-            
-            generated_recommendations = combined_recommendations
-
+            engine = self.scoring_engine
+            candidates = engine.top_candidates_batch(
+                histories, self._mmr_candidate_count(num_recommendations), [weights for _, weights in recent_views]
+            )
+            base_lists = [engine.product_ids[rows].tolist() for rows, _ in candidates]
+            base_scores = [scores for _, scores in candidates]
+        elif strategy_version == 'v3':
+            als_engine = self.als_engine
+            base_lists = [
+                als_engine.recommend(user_id, viewed_products, num_recommendations, weights)
+                for user_id, (viewed_products, weights) in zip(user_ids, recent_views)
+            ]
         else:
-            print(f"Unknown strategy version: {strategy_version}. Falling back to random active items.")
-            random.shuffle(all_active_product_ids)
-            generated_recommendations = all_active_product_ids
+            base_lists = [[] for _ in user_ids]
+        observe_stage('batch_scoring', strategy_version, time.perf_counter() - start)
+
+        return [
+            self._finalize_recommendations(strategy_version, base, viewed_products, num_recommendations, scores)
+            for base, viewed_products, scores in zip(base_lists, histories, base_scores)
+        ]
+
+    @property
+    def active_product_count(self):
+        return self.catalog.active_count
+
+    def category_codes_for(self, recommendation_lists, width: int):
+        """將多份推薦清單轉為 U×width 的類別代碼矩陣，未知商品與填補位置為 -1。"""
+        return self.catalog.category_codes_for(recommendation_lists, width)
+
+    @staticmethod
+    def _mmr_candidate_count(num_recommendations: int) -> int:
+        # v2 的 MMR 在比推薦數多的相似度候選上重排
+        return max(MMR_CANDIDATES, num_recommendations * 2)
+
+    def _finalize_recommendations(self, strategy_version: str, base_recommendations: list[int], viewed_products: list[int], num_recommendations: int,
+                                  base_scores=None) -> list[int]:
+        """
+        依策略將相似度推薦 (已排除已看過與非活躍商品) 整理成最終推薦清單，
+        不足的部分以熱門商品補充。v2 的 base_scores 為各候選的相似度分數。
+        """
+        generated_recommendations = []
+
+        if strategy_version == 'v2':
+            # 相似度候選與跨類別探索商品一起以 MMR 重排，兼顧相關性順序與類別多樣性
+            with timed_stage('diversification', strategy_version):
+                base_recommendations = self._diversify(base_recommendations, base_scores, viewed_products, num_recommendations)
+
+        with timed_stage('filtering', strategy_version):
+            if strategy_version in ('v1', 'v2', 'v3'):
+                generated_recommendations = base_recommendations[:num_recommendations]
+
+            if len(generated_recommendations) < num_recommendations:
+                # 冷啟動或推薦不足：以熱門商品補充
+                generated_recommendations.extend(self._fallback_recommendations(
+                    num_recommendations - len(generated_recommendations), generated_recommendations + viewed_products
+                ))
 
         return generated_recommendations[:num_recommendations]
 
+    def _fallback_recommendations(self, k: int, exclude: list[int]) -> list[int]:
+        """時間衰減的熱門商品 (預先排好的清單)；尚無事件資料或仍不足時從活躍商品中隨機補充。"""
+        exclude = set(exclude)
+        recommendations = self.popularity.top(k, exclude=exclude)
+        if len(recommendations) < k:
+            recommendations.extend(self.catalog.sample_active(k - len(recommendations), exclude.union(recommendations), self._rng))
+        return recommendations
+
+    def _diversify(self, candidate_ids: list[int], candidate_scores, viewed_products: list[int], num_recommendations: int) -> list[int]:
+        """
+        v2 的多樣化重排：候選為相似度最高的商品 (相關性為其分數) 加上從不同類別各取一個的探索商品 (相關性 0)，
+        以 MMR 依序選出 num_recommendations 個；冗餘度使用模型中預先計算的鄰居相似度與類別代碼。
+        每個請求的成本為 O(C·k)，與目錄大小無關。
+        """
+        engine, catalog = self.scoring_engine, self.catalog
+        explore = catalog.sample_diverse(num_recommendations // 2, viewed_products + candidate_ids, self._rng)
+        candidates = candidate_ids + explore
+        if not candidates:
+            return []
+        relevance = np.zeros(len(candidates), dtype=np.float64)
+        if candidate_scores is not None:
+            relevance[:len(candidate_ids)] = candidate_scores
+        rows, positions = engine.rows_for(candidates)
+        candidate_rows = np.full(len(candidates), -1, dtype=np.int64)
+        candidate_rows[positions] = rows
+        codes = catalog.category_codes_for([candidates], len(candidates))[0]
+        similarity = neighbor_similarity_lookup(engine.index.neighbor_indices, engine.index.neighbor_scores, candidate_rows)
+        selected = maximal_marginal_relevance(relevance, codes, num_recommendations, similarity=similarity)
+        return [candidates[position] for position in selected.tolist()]
@@ -0,0 +1,32 @@
+import os
+
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+
+
+async def connect_async_redis(owner: str, unavailable_message: str, max_connections: int = None):
+    """
+    建立 redis.asyncio 連線池與客戶端並 PING 確認可用，返回客戶端。
+    Redis 不可用時記錄 (附上停用了什麼功能的 unavailable_message)、關閉連線池並返回 None。
+    """
+    pool = aioredis.ConnectionPool(
+        host=os.getenv('REDIS_HOST', 'redis'),
+        port=int(os.getenv('REDIS_PORT', 6379)),
+        db=0,
+        max_connections=max_connections,
+    )
+    client = aioredis.Redis(connection_pool=pool)
+    try:
+        await client.ping()
+        print(f"{owner}: Successfully connected to Redis.")
+    except (RedisError, OSError) as e:
+        print(f"{owner}: Could not connect to Redis: {e}. {unavailable_message}")
+        await close_async_redis(client)
+        return None
+    return client
+
+
+async def close_async_redis(client):
+    """關閉客戶端與其連線池中的所有連線。"""
+    await client.aclose()
+    await client.connection_pool.disconnect()
@@ -0,0 +1,129 @@
+import asyncio
+import os
+import time
+import zlib
+from collections import OrderedDict
+
+from prometheus_client import Counter
+from redis.exceptions import RedisError
+
+from instrumentation import timed_stage
+from metrics_recorder import encode_product_ids, decode_product_ids
+from redis_pool import close_async_redis, connect_async_redis
+
+
+RESULT_CACHE_KEY_PREFIX = "recommendation_result"
+
+RESULT_CACHE_REQUESTS = Counter('recommendation_result_cache_requests_total', 'Recommendation result cache lookups', ['tier', 'result'])
+RESULT_CACHE_EVICTIONS = Counter('recommendation_result_cache_evictions_total', 'Recommendation result cache evictions from the in-process tier', ['reason'])
+
+
+def history_checksum(viewed_product_ids):
+    """最近瀏覽清單的 CRC32 (跨程序一致的 32 位元整數)。"""
+    return zlib.crc32(encode_product_ids(viewed_product_ids))
+
+
+def history_fingerprint(viewed_product_ids):
+    """最近瀏覽清單的穩定指紋 (跨程序一致，可作為 Redis key 的一部分)。"""
+    return f"{history_checksum(viewed_product_ids):08x}"
+
+
+class RecommendationResultCache:
+    """
+    推薦結果的兩層快取：
+    - 本機 LRU (有容量上限與 TTL)，命中時完全不經過網路
+    - 共用的 Redis 層 (GET/SET EX)，讓同一用戶被不同 worker 服務時也能命中
+    key 包含 (user_id, 策略, 數量, 最近瀏覽指紋, 模型版本, 產品快照指紋)，
+    因此新模型或新產品快照換上後舊結果自然不再被命中；本機層同時清空以釋放記憶體，Redis 層由 TTL 回收。
+    """
+
+    def __init__(self, size=None, ttl_seconds=None, redis_ttl_seconds=None):
+        self.size = size or int(os.getenv('RESULT_CACHE_SIZE', 50000))
+        self.ttl_seconds = ttl_seconds or float(os.getenv('RESULT_CACHE_TTL_SECONDS', 60))
+        self.redis_ttl_seconds = redis_ttl_seconds or int(os.getenv('RESULT_CACHE_REDIS_TTL_SECONDS', 300))
+        self._entries = OrderedDict()  # key -> (expires_at, product_ids)
+        self._redis_client = None
+        self._pending_writes = set()
+
+    @staticmethod
+    def key(user_id, strategy_version, num_recommendations, viewed_product_ids, model_version, catalog_fingerprint):
+        return (f"{RESULT_CACHE_KEY_PREFIX}:{model_version or 'none'}:{catalog_fingerprint}:"
+                f"{strategy_version}:{num_recommendations}:{user_id}:{history_fingerprint(viewed_product_ids)}")
+
+    async def start(self):
+        client = await connect_async_redis(
+            "Result cache", "Only the in-process tier is used.",
+            max_connections=int(os.getenv('RESULT_CACHE_REDIS_MAX_CONNECTIONS', 8)),
+        )
+        if client is None:
+            return
+        self._redis_client = client
+
+    async def stop(self):
+        if self._pending_writes:
+            await asyncio.gather(*self._pending_writes, return_exceptions=True)
+        if self._redis_client is not None:
+            await close_async_redis(self._redis_client)
+            self._redis_client = None
+
+    async def get(self, key):
+        """依序查詢本機層與 Redis 層，返回推薦商品 ID 列表；兩層皆未命中時返回 None。"""
+        product_ids = self._get_local(key)
+        if product_ids is not None:
+            RESULT_CACHE_REQUESTS.labels(tier='local', result='hit').inc()
+            return product_ids
+        RESULT_CACHE_REQUESTS.labels(tier='local', result='miss').inc()
+
+        if self._redis_client is None:
+            return None
+        try:
+            raw = await self._redis_client.get(key)
+        except (RedisError, OSError) as e:
+            print(f"Result cache: Error reading from Redis: {e}")
+            return None
+        if raw is None:
+            RESULT_CACHE_REQUESTS.labels(tier='redis', result='miss').inc()
+            return None
+        RESULT_CACHE_REQUESTS.labels(tier='redis', result='hit').inc()
+        product_ids = decode_product_ids(raw).tolist()
+        self._put_local(key, product_ids)
+        return product_ids
+
+    def put(self, key, product_ids):
+        """寫入本機層，Redis 層在背景寫入，不延遲回應。"""
+        self._put_local(key, product_ids)
+        if self._redis_client is not None:
+            task = asyncio.create_task(self._put_redis(key, product_ids))
+            self._pending_writes.add(task)
+            task.add_done_callback(self._pending_writes.discard)
+
+    async def _put_redis(self, key, product_ids):
+        try:
+            with timed_stage('result_cache_write'):
+                await self._redis_client.set(key, encode_product_ids(product_ids), ex=self.redis_ttl_seconds)
+        except (RedisError, OSError) as e:
+            print(f"Result cache: Error writing to Redis: {e}")
+
+    def invalidate(self):
+        """模型或產品快照換上時調用：清空本機層。"""
+        if self._entries:
+            RESULT_CACHE_EVICTIONS.labels(reason='invalidated').inc(len(self._entries))
+            self._entries = OrderedDict()
+
+    def _get_local(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            RESULT_CACHE_EVICTIONS.labels(reason='expired').inc()
+            return None
+        self._entries.move_to_end(key)
+        return list(entry[1])
+
+    def _put_local(self, key, product_ids):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, tuple(product_ids))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            RESULT_CACHE_EVICTIONS.labels(reason='capacity').inc()
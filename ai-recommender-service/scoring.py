@@ -0,0 +1,166 @@
+import copy
+
+import numpy as np
+import scipy.sparse as sp
+from item_similarity import top_k_per_row
+
+
+class ActiveMaskMixin:
+    """
+    以 active_mask (每個模型列是否為活躍商品) 過濾推薦的引擎共用：商品增量同步時只替換遮罩。
+    子類別需提供 active_mask 與 rows_for(product_ids) → (rows, 對應的原始位置)。
+    """
+
+    def with_active_changes(self, product_ids, active):
+        """返回套用商品活躍狀態變更後的新引擎：共用模型陣列，只複製活躍遮罩，原引擎不變。"""
+        engine = copy.copy(self)
+        rows, positions = self.rows_for(product_ids)
+        engine.active_mask = self.active_mask.copy()
+        engine.active_mask[rows] = active[positions]
+        return engine
+
+
+class ScoringEngine(ActiveMaskMixin):
+    """
+    基於 NeighborIndex 的向量化評分引擎。
+    - active_mask: 每個模型列是否為活躍商品 (預先計算，請求路徑上不再查 dict)
+    單次評分只觸及已看商品的 K 個鄰居，成本為 O(V·K)，與目錄大小 N 無關。
+    模型或完整產品同步時建立新引擎並以單一參考替換 (原子熱更新)；
+    商品增量同步以 with_active_changes 產生只換了 active_mask 的新引擎，同樣以單一參考替換。
+    """
+
+    def __init__(self, neighbor_index, catalog, model_version=None, trained_at=None):
+        self.index = neighbor_index
+        self.model_version = model_version
+        self.trained_at = trained_at
+        self.product_ids = neighbor_index.product_ids
+        self.active_mask = catalog.is_active(self.product_ids)
+        self._similarity_matrix = None
+
+    @property
+    def is_empty(self):
+        return self.index.is_empty
+
+    def rows_for(self, product_ids):
+        """將商品 ID 轉為模型列索引，不在模型中的商品會被略過。返回 (rows, 對應的原始位置)。"""
+        return self.index.rows_for(product_ids)
+
+    def score(self, rows, weights=None):
+        """
+        對給定的已看商品列，加權累加其鄰居列的相似度。
+        返回 (candidate_rows, scores)，只包含至少出現在一個鄰居列表中的商品。
+        """
+        neighbor_rows = self.index.neighbor_indices[rows]
+        neighbor_scores = self.index.neighbor_scores[rows]
+        if weights is not None:
+            neighbor_scores = neighbor_scores * np.asarray(weights, dtype=np.float32)[:, None]
+
+        neighbor_rows = neighbor_rows.ravel()
+        neighbor_scores = neighbor_scores.ravel()
+        valid = neighbor_rows >= 0
+        candidates, inverse = np.unique(neighbor_rows[valid], return_inverse=True)
+        scores = np.bincount(inverse, weights=neighbor_scores[valid], minlength=len(candidates))
+        return candidates, scores.astype(np.float32)
+
+    def top_k(self, candidates, scores, k, exclude_rows=None):
+        """過濾非活躍與需排除的商品後，以部分排序取分數最高的 k 個，返回 (依分數遞減的列索引, 對應分數)。"""
+        keep = self.active_mask[candidates]
+        if exclude_rows is not None and len(exclude_rows):
+            keep &= ~np.isin(candidates, exclude_rows)
+        candidates = candidates[keep]
+        scores = scores[keep]
+        if len(candidates) > k:
+            # 取第 k 高的分數為門檻，保留所有同分者，確保同分時的選擇是確定的
+            threshold = -np.partition(-scores, k - 1)[k - 1]
+            top = np.flatnonzero(scores >= threshold)
+        else:
+            top = np.arange(len(candidates))
+        # 分數遞減，同分時列索引小者優先 (與批次評分一致)
+        order = top[np.lexsort((candidates[top], -scores[top]))][:k]
+        return candidates[order], scores[order]
+
+    def top_candidates(self, viewed_product_ids, k, weights=None):
+        """
+        根據已看商品返回 (top-k 候選的列索引, 分數)，依分數遞減 (已排除已看與非活躍商品)。
+        只有活躍的已看商品會參與評分，但所有已看商品都會被排除。
+        """
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+        if self.is_empty or not viewed_product_ids or k <= 0:
+            return empty
+        viewed_rows, positions = self.rows_for(viewed_product_ids)
+        if len(viewed_rows) == 0:
+            return empty
+        seed = self.active_mask[viewed_rows]
+        if not seed.any():
+            return empty
+        seed_weights = None if weights is None else np.asarray(weights, dtype=np.float32)[positions][seed]
+        candidates, scores = self.score(viewed_rows[seed], seed_weights)
+        return self.top_k(candidates, scores, k, exclude_rows=viewed_rows)
+
+    def recommend(self, viewed_product_ids, k, weights=None):
+        """根據已看商品返回 top-k 推薦商品 ID (已排除已看與非活躍商品)。"""
+        top, _ = self.top_candidates(viewed_product_ids, k, weights)
+        return self.product_ids[top].tolist()
+
+    def similarity_matrix(self):
+        """將 top-K 鄰居索引展開為 N×N 的 CSR 稀疏相似度矩陣 (每列最多 K 個非零值)，首次使用時建立。"""
+        if self._similarity_matrix is None:
+            n_items = len(self.product_ids)
+            rows = np.repeat(np.arange(n_items, dtype=np.int32), self.index.top_k)
+            cols = self.index.neighbor_indices.ravel()
+            valid = cols >= 0
+            self._similarity_matrix = sp.csr_matrix(
+                (self.index.neighbor_scores.ravel()[valid], (rows[valid], cols[valid])),
+                shape=(n_items, n_items), dtype=np.float32
+            )
+        return self._similarity_matrix
+
+    def history_matrices(self, histories, weights=None):
+        """
+        將多個用戶的已看商品列表轉為兩個 U×N 稀疏矩陣：
+        - seed: 只含活躍的已看商品，用於評分 (有 weights 時為各商品的權重，否則為 1)
+        - viewed: 所有已看商品，用於排除
+        """
+        user_rows = [np.empty(0, dtype=np.int64)]
+        item_rows = [np.empty(0, dtype=np.int64)]
+        item_weights = [np.empty(0, dtype=np.float32)]
+        for user_position, viewed_product_ids in enumerate(histories):
+            rows, positions = self.rows_for(viewed_product_ids)
+            user_rows.append(np.full(len(rows), user_position, dtype=np.int64))
+            item_rows.append(rows)
+            if weights is not None:
+                item_weights.append(np.asarray(weights[user_position], dtype=np.float32)[positions])
+        shape = (len(histories), len(self.product_ids))
+        user_rows = np.concatenate(user_rows)
+        item_rows = np.concatenate(item_rows)
+        viewed = sp.csr_matrix((np.ones(len(item_rows), dtype=np.float32), (user_rows, item_rows)), shape=shape)
+        viewed.data[:] = 1  # 重複的已看商品只計一次
+        active = self.active_mask[item_rows]
+        seed_data = np.concatenate(item_weights)[active] if weights is not None else np.ones(int(active.sum()), dtype=np.float32)
+        seed = sp.csr_matrix((seed_data, (user_rows[active], item_rows[active])), shape=shape)
+        if weights is None:
+            seed.data[:] = 1
+        return seed, viewed
+
+    def top_candidates_batch(self, histories, k, weights=None):
+        """
+        以一次稀疏矩陣乘法 (U×N 歷史矩陣 × N×N 相似度矩陣) 為多個用戶評分，
+        返回每個用戶的 (依分數遞減的 top-k 候選列索引, 分數)。
+        """
+        if self.is_empty or k <= 0 or not histories:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in histories]
+        seed, viewed = self.history_matrices(histories, weights)
+        scores = (seed @ self.similarity_matrix()).tocsr()
+        # 排除非活躍商品與已看過的商品
+        scores.data[~self.active_mask[scores.indices]] = 0
+        scores = (scores - scores.multiply(viewed)).tocsr()
+        scores.eliminate_zeros()
+
+        top_rows, top_scores, counts = top_k_per_row(scores, k)
+        boundaries = np.cumsum(counts)[:-1]
+        return list(zip(np.split(top_rows.astype(np.int64), boundaries), np.split(top_scores.astype(np.float32), boundaries)))
+
+    def recommend_batch(self, histories, k, weights=None):
+        """批次版本的 recommend：返回每個用戶依分數遞減的 top-k 推薦商品 ID 列表。"""
+        return [self.product_ids[rows].tolist() for rows, _ in self.top_candidates_batch(histories, k, weights)]
+
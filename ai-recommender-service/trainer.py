@@ -0,0 +1,299 @@
+import os
+import numpy as np
+import mysql.connector
+from item_similarity import NeighborIndex, CooccurrenceState, build_neighbor_index, update_neighbor_index
+from als import train_als
+from model_store import ModelStore
+from mysql_pool import get_mysql_connection
+
+
+# 串流讀取互動資料時每次 fetchmany 的列數
+INTERACTION_FETCH_CHUNK_ROWS = int(os.getenv('INTERACTION_FETCH_CHUNK_ROWS', 100000))
+# 將互動行為轉為評分：點擊 1 分、購買 5 分，其他行為 (例如曝光) 不計
+ACTION_RATINGS = {'click': 1, 'purchase': 5}
+# 完整重建時是否同時訓練 v3 策略的 ALS 模型
+ALS_ENABLED = os.getenv('ALS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# 同一個基底上累積超過這麼多批增量時改為完整重建 (重寫基底、清掉增量)
+INCREMENTAL_MAX_DELTAS = int(os.getenv('INCREMENTAL_MAX_DELTAS', 144))
+
+
+class InteractionArrays:
+    """
+    以預先配置、按需倍增的緊湊陣列累積互動資料 (user_id/product_id 為 int32，超出範圍時升為 int64；rating 為 float32)，
+    取代每列一個 Python dict 再轉 DataFrame 的做法，峰值記憶體約為資料本身大小。
+    """
+
+    def __init__(self, capacity=1024):
+        self.user_ids = np.empty(capacity, dtype=np.int32)
+        self.product_ids = np.empty(capacity, dtype=np.int32)
+        self.ratings = np.empty(capacity, dtype=np.float32)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, user_ids, product_ids, ratings):
+        count = len(ratings)
+        if self.size + count > len(self.ratings):
+            capacity = max(2 * len(self.ratings), self.size + count)
+            self.user_ids = self._grow(self.user_ids, capacity)
+            self.product_ids = self._grow(self.product_ids, capacity)
+            self.ratings = self._grow(self.ratings, capacity)
+        self.user_ids = self._widen_if_needed(self.user_ids, user_ids)
+        self.product_ids = self._widen_if_needed(self.product_ids, product_ids)
+        self.user_ids[self.size:self.size + count] = user_ids
+        self.product_ids[self.size:self.size + count] = product_ids
+        self.ratings[self.size:self.size + count] = ratings
+        self.size += count
+
+    def _grow(self, array, capacity):
+        grown = np.empty(capacity, dtype=array.dtype)
+        grown[:self.size] = array[:self.size]
+        return grown
+
+    @staticmethod
+    def _widen_if_needed(array, values):
+        if array.dtype == np.int32 and len(values) and values.max() > np.iinfo(np.int32).max:
+            return array.astype(np.int64)
+        return array
+
+    def arrays(self):
+        """返回 (user_ids, product_ids, ratings)，為內部緩衝區的視圖，不複製。"""
+        return self.user_ids[:self.size], self.product_ids[:self.size], self.ratings[:self.size]
+
+
+class ModelTrainer:
+    """
+    負責從 MySQL 讀取互動資料、訓練 (完整重建或增量更新) top-K 鄰居模型並寫入 ModelStore。
+    只依賴可序列化的設定，因此可以在獨立的訓練程序 (ProcessPoolExecutor) 中執行，
+    不會阻塞服務 /recommend 的事件迴圈。
+    """
+
+    def __init__(self, mysql_config, model_dir, top_k):
+        self.mysql_config = mysql_config
+        self.top_k = top_k
+        # 訓練程序只寫檔案與 CURRENT 指標，Redis 指標由服務程序在熱更新時發佈
+        self.model_store = ModelStore(model_dir, 'item_similarity')
+        self.als_store = ModelStore(model_dir, 'als')
+        # 增量訓練的累加器只有訓練程序會讀取，存放在服務載入的模型目錄之外：
+        # 基底只在完整重建時寫入 (只保留最新一份)，之後每次增量更新只追加該批事件
+        self.state_store = ModelStore(model_dir, 'training_state', keep_versions=1)
+        self.delta_store = ModelStore(model_dir, 'training_state_deltas', keep_versions=INCREMENTAL_MAX_DELTAS)
+
+    def _get_mysql_connection(self):
+        """從本程序的連線池獲取 MySQL 連接 (close() 即歸還連線池)"""
+        return get_mysql_connection(self.mysql_config, owner="Trainer")
+
+    def _get_event_high_water_mark(self):
+        """返回 recommendation_events 目前最大的 id；無法連線時返回 None。"""
+        conn = self._get_mysql_connection()
+        if not conn:
+            return None
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM recommendation_events")
+            (high_water_mark,) = cursor.fetchone()
+            cursor.close()
+            return int(high_water_mark)
+        except mysql.connector.Error as err:
+            print(f"Error fetching event high-water mark from MySQL: {err}")
+            return None
+        finally:
+            conn.close()
+
+    def _load_user_interactions_from_mysql(self, after_event_id=0, up_to_event_id=None, allow_dummy=True):
+        """
+        從 MySQL 資料庫串流加載用戶互動數據 (例如 recommendation_events)。
+        只讀取 after_event_id < id <= up_to_event_id 範圍內的事件，供完整重建與增量更新共用。
+        以非緩衝 (伺服器端) cursor 每次 fetchmany 固定列數，直接寫入緊湊陣列，
+        返回 (user_ids, product_ids, ratings) 三個平行陣列。
+        """
+        print(f"Trainer: Loading user interactions from MySQL (events {after_event_id} < id <= {up_to_event_id})...")
+        interactions = InteractionArrays()
+        conn = self._get_mysql_connection()
+        if conn:
+            try:
+                cursor = conn.cursor(buffered=False)
+                # 只有 'click' 與 'purchase' 視為有效互動，先在資料庫端過濾
+                cursor.execute("""
+                    SELECT user_id, product_id, action, COUNT(*) as interaction_count
+                    FROM recommendation_events
+                    WHERE product_id IS NOT NULL AND user_id IS NOT NULL
+                      AND action IN ('click', 'purchase')
+                      AND id > %s AND id <= %s
+                    GROUP BY user_id, product_id, action
+                """, (after_event_id, up_to_event_id if up_to_event_id is not None else 2**63 - 1))
+                while True:
+                    rows = cursor.fetchmany(INTERACTION_FETCH_CHUNK_ROWS)
+                    if not rows:
+                        break
+                    user_ids, product_ids, actions, counts = zip(*rows)
+                    # 向量化地將行為對應為評分，並依互動次數加權
+                    actions = np.asarray(actions, dtype=object)
+                    ratings = np.zeros(len(rows), dtype=np.float32)
+                    for action, rating in ACTION_RATINGS.items():
+                        ratings[actions == action] = rating
+                    ratings *= np.asarray(counts, dtype=np.float32)
+                    valid = ratings > 0
+                    interactions.extend(
+                        np.asarray(user_ids, dtype=np.int64)[valid],
+                        np.asarray(product_ids, dtype=np.int64)[valid],
+                        ratings[valid]
+                    )
+                cursor.close()
+            except mysql.connector.Error as err:
+                print(f"Error fetching user interactions from MySQL: {err}")
+            finally:
+                conn.close()
+
+        if not len(interactions):
+            if not allow_dummy:
+                return interactions.arrays()
+            print("No real user interaction data from MySQL. Using dummy interaction data for training.")
+            return self._load_dummy_interactions() # 如果資料庫無數據，仍使用模擬數據
+        print(f"Trainer: Loaded {len(interactions)} grouped interactions.")
+        return interactions.arrays()
+
+    def _load_dummy_interactions(self):
+        """
+        硬編碼的假數據用於訓練。返回 (user_ids, product_ids, ratings)。
+        """
+        user_ids = np.array([1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 1, 2, 3, 4, 5, 1, 2, 3, 4, 5], dtype=np.int32)
+        product_ids = np.array([1, 2, 3, 4, 1, 5, 2, 6, 3, 7, 8, 9, 10, 11, 12, 13, 14, 15, 1, 2], dtype=np.int32)
+        ratings = np.array([5, 4, 5, 3, 4, 5, 3, 4, 5, 3, 2, 1, 5, 4, 3, 5, 4, 3, 2, 1], dtype=np.float32)
+        return user_ids, product_ids, ratings
+
+    def train(self):
+        """
+        完整重建：
+        1. 記錄目前的事件高水位，從 MySQL 獲取此前的全部用戶互動數據
+        2. 建立共現累加器並計算每個商品的 top-K 鄰居
+        3. 在同一份互動資料上訓練 v3 策略的 ALS 模型 (寫入獨立的 ModelStore)
+        4. 將累加器基底寫入 training_state，模型連同高水位、基底版本與對應的 ALS 版本寫入 ModelStore
+        返回新模型版本；沒有可訓練的資料時返回 None。
+        """
+        print("Trainer: Starting full model retraining process...")
+        high_water_mark = self._get_event_high_water_mark()
+        user_ids, product_ids, ratings = self._load_user_interactions_from_mysql(up_to_event_id=high_water_mark)
+        if not len(ratings):
+            print("No user interaction data for retraining. Skipping model retraining.")
+            return None
+
+        # 模型包含所有有互動的商品 (非活躍商品在服務時由活躍遮罩過濾)，增量更新才能與完整重建一致
+        state = CooccurrenceState.from_interactions(user_ids, product_ids, ratings)
+        new_neighbor_index = build_neighbor_index(state, top_k=self.top_k)
+
+        # 確保模型中至少有兩個產品才有相似度可言
+        if len(new_neighbor_index) < 2:
+            print("Not enough unique products in interactions to train similarity model. Skipping.")
+            return None
+        als_version = self._train_als(user_ids, product_ids, ratings)
+        state_version = self.state_store.save(state.to_arrays(), {'high_water_mark': high_water_mark or 0})
+        return self._save(new_neighbor_index, state_version, high_water_mark or 0, als_version)
+
+    def update_incremental(self):
+        """
+        增量更新：只讀取高水位之後的新事件併入累加器，重算被觸及商品的鄰居列表，並將新的相似度併入與其共現的商品列表。
+        以 memmap 映射基底並重放之前的增量事件，本批事件只追加為一個新的增量，不重寫基底。
+        目前模型沒有對應的累加器 (例如舊格式，或上次寫入中斷) 時改為完整重建。返回新模型版本；沒有新事件時返回 None。
+        """
+        header, arrays = self.model_store.load()
+        state_version = self.state_store.current_version()
+        if header is None or not state_version or header['metadata'].get('state_version') != state_version:
+            print("Trainer: No incremental state found. Falling back to full retraining.")
+            return self.train()
+
+        last_high_water_mark = header['metadata'].get('high_water_mark', 0)
+        high_water_mark = self._get_event_high_water_mark()
+        if high_water_mark is None or high_water_mark <= last_high_water_mark:
+            print("Trainer: No new interaction events since last update.")
+            return None
+        if last_high_water_mark == 0:
+            # 目前模型是在沒有真實事件時以模擬數據訓練的，不能在其上累加真實事件
+            return self.train()
+
+        state_header, state_arrays = self.state_store.load(state_version)
+        deltas = self._load_deltas(state_version, state_header['metadata']['high_water_mark'], last_high_water_mark)
+        if deltas is None:
+            print("Trainer: Incremental state deltas are incomplete. Falling back to full retraining.")
+            return self.train()
+        if len(deltas) >= INCREMENTAL_MAX_DELTAS:
+            print(f"Trainer: {len(deltas)} incremental deltas accumulated. Compacting with a full retraining.")
+            return self.train()
+
+        user_ids, product_ids, ratings = self._load_user_interactions_from_mysql(after_event_id=last_high_water_mark, up_to_event_id=high_water_mark, allow_dummy=False)
+        if not len(ratings):
+            # 新事件都不是有效互動 (例如曝光)，仍推進高水位
+            print("Trainer: No new rated interactions. Advancing high-water mark only.")
+
+        state = CooccurrenceState.from_arrays(state_arrays)
+        for delta in deltas:
+            state.apply_events(delta['user_ids'], delta['product_ids'], delta['ratings'])
+        previous_index = NeighborIndex.from_arrays(arrays, header['metadata'])
+        touched_rows = state.apply_events(user_ids, product_ids, ratings) if len(ratings) else np.empty(0, dtype=np.int64)
+        new_neighbor_index, updated = update_neighbor_index(previous_index, state, touched_rows, top_k=self.top_k)
+        print(f"Trainer: Folded {len(ratings)} new interactions into {len(touched_rows)} items; "
+              f"updated {updated} of {len(new_neighbor_index)} neighbor lists.")
+
+        # 先追加增量再寫入模型：模型寫入失敗時，多出的增量高水位超過模型的高水位，下次載入時會被略過
+        self.delta_store.save({'user_ids': np.asarray(user_ids, dtype=np.int64), 'product_ids': np.asarray(product_ids, dtype=np.int64),
+                               'ratings': np.asarray(ratings, dtype=np.float32)},
+                              {'state_version': state_version, 'after': last_high_water_mark, 'high_water_mark': high_water_mark})
+        # ALS 模型只在完整重建時更新，增量版本沿用目前的 ALS 版本 (新用戶由服務端以最近瀏覽 fold-in)
+        return self._save(new_neighbor_index, state_version, high_water_mark, header['metadata'].get('als_version'))
+
+    def _load_deltas(self, state_version, base_high_water_mark, high_water_mark):
+        """
+        返回基底之後、直到模型高水位為止的各批增量事件 (依序)；事件範圍不連續 (例如被清理或寫入中斷) 時返回 None。
+        """
+        candidates = []
+        for version in self.delta_store.versions():
+            header, arrays = self.delta_store.load(version)
+            metadata = header['metadata']
+            if metadata['state_version'] == state_version and metadata['high_water_mark'] <= high_water_mark:
+                candidates.append((metadata['after'], metadata['high_water_mark'], arrays))
+        deltas = []
+        expected = base_high_water_mark
+        for after, delta_high_water_mark, arrays in sorted(candidates, key=lambda candidate: candidate[:2]):
+            if after != expected:
+                return None
+            deltas.append(arrays)
+            expected = delta_high_water_mark
+        return deltas if expected == high_water_mark else None
+
+    def _train_als(self, user_ids, product_ids, ratings):
+        """訓練 ALS 模型並寫入 'als' ModelStore，返回其版本；停用或失敗時返回 None (不影響相似度模型)。"""
+        if not ALS_ENABLED:
+            return None
+        try:
+            model = train_als(user_ids, product_ids, ratings)
+            arrays, metadata = model.to_arrays()
+            version = self.als_store.save(arrays, metadata)
+            print(f"ALS model version {version} saved to {self.als_store.directory}")
+            return version
+        except Exception as e:
+            print(f"Error training ALS model: {e}")
+            return None
+
+    def _save(self, neighbor_index, state_version, high_water_mark, als_version=None):
+        """
+        寫入模型版本，記錄對應的累加器基底版本與事件高水位 (基底與增量需先寫好；兩者不符時下次增量更新會改為完整重建)。
+        ALS 版本記錄在 header 中，服務端載入相似度模型時一併載入對應的 ALS 模型，兩者總是同時換上。
+        """
+        arrays, metadata = neighbor_index.to_arrays()
+        metadata['state_version'] = state_version
+        metadata['high_water_mark'] = high_water_mark
+        metadata['als_version'] = als_version
+        version = self.model_store.save(arrays, metadata)
+        print(f"Model version {version} saved to {self.model_store.directory}")
+        return version
+
+
+def run_training_job(mysql_config, model_dir, top_k):
+    """完整重建的進入點 (需為模組層級函式才能被 ProcessPoolExecutor 序列化)。"""
+    return ModelTrainer(mysql_config, model_dir, top_k).train()
+
+
+def run_incremental_job(mysql_config, model_dir, top_k):
+    """增量更新的進入點。"""
+    return ModelTrainer(mysql_config, model_dir, top_k).update_incremental()
@@ -7,11 +7,17 @@ use Illuminate\Contracts\Queue\ShouldQueue;
 use Illuminate\Queue\InteractsWithQueue;
 use Illuminate\Support\Facades\DB;
 use Illuminate\Support\Facades\Log;
+use Illuminate\Support\Facades\Redis;
 
 class LogRecommendationInteraction implements ShouldQueue
 {
     use InteractsWithQueue;
 
+    // FastAPI 推薦服務從此 stream 消費瀏覽/點擊/購買事件，維護每個用戶的最近瀏覽紀錄
+    private const RECENT_EVENTS_STREAM = 'recommendation_events:stream';
+    private const RECENT_EVENTS_STREAM_MAXLEN = 100000;
+    private const HISTORY_ACTIONS = ['view', 'click', 'purchase'];
+
     public function __construct()
     {
         //
@@ -44,5 +50,32 @@ class LogRecommendationInteraction implements ShouldQueue
                 'error' => $e->getTraceAsString()
             ]);
         }
+
+        $this->publishRecentView($event);
+    }
+
+    /**
+     * 將帶有商品的互動事件發佈到 Redis stream (近似長度上限，O(1))。
+     * 失敗不影響事件寫入 MySQL，只會讓該筆瀏覽不出現在最近瀏覽中。
+     */
+    private function publishRecentView(RecommendationInteraction $event): void
+    {
+        if (!$event->userId || !$event->productId || !in_array($event->action, self::HISTORY_ACTIONS, true)) {
+            return;
+        }
+
+        try {
+            Redis::xadd(self::RECENT_EVENTS_STREAM, '*', [
+                'user_id' => $event->userId,
+                'product_id' => $event->productId,
+                'action' => $event->action,
+                'ts' => now()->timestamp,
+            ], self::RECENT_EVENTS_STREAM_MAXLEN, true);
+        } catch (\Exception $e) {
+            Log::warning("Failed to publish recent view to Redis stream: " . $e->getMessage(), [
+                'user_id' => $event->userId,
+                'product_id' => $event->productId,
+            ]);
+        }
     }
 }
@@ -4,11 +4,20 @@ namespace App\Services;
 
 use GuzzleHttp\Client;
 use GuzzleHttp\Exception\RequestException;
+use Illuminate\Support\Facades\Cache;
 use Illuminate\Support\Facades\Log;
 use App\Models\Product; // 引入 Product 模型
 
 class RecommendationService
 {
+    // 推薦商品詳細資訊 (名稱、價格、圖片等) 的快取秒數；上架狀態不快取，每次請求都重新篩選
+    private const PRODUCT_DETAILS_CACHE_SECONDS = 60;
+    // 備援用的熱門商品清單快取秒數，推薦服務異常期間不會每個請求都再呼叫一次
+    private const POPULAR_PRODUCTS_CACHE_SECONDS = 60;
+    // /popular 只讀取記憶體中的清單，逾時設短，避免在推薦服務已逾時的情況下再等待
+    private const POPULAR_PRODUCTS_TIMEOUT_SECONDS = 0.5;
+    private const FALLBACK_LIMIT = 10;
+
     protected Client $httpClient;
     protected string $recommendationApiUrl;
 
@@ -32,23 +41,7 @@ class RecommendationService
             $data = json_decode($response->getBody()->getContents(), true);
 
             $recommendedProductIds = $data['recommended_product_ids'] ?? [];
-            
-            // 從 Laravel 的資料庫讀取真實的產品詳細資訊，並篩選出上架狀態的商品
-            $recommendations = Product::whereIn('id', $recommendedProductIds)
-                                     ->active() // 只獲取上架的商品
-                                     ->get(['id', 'name', 'price', 'category_id', 'image_url'])
-                                     ->toArray();
-
-            // 確保推薦順序與 FastAPI 返回的順序一致 (可選，但通常有用)
-            $orderedRecommendations = [];
-            foreach ($recommendedProductIds as $id) {
-                foreach ($recommendations as $product) {
-                    if ($product['id'] == $id) {
-                        $orderedRecommendations[] = $product;
-                        break;
-                    }
-                }
-            }
+            $orderedRecommendations = $this->activeProductsInOrder($recommendedProductIds);
 
             Log::info("Received and filtered recommendations for user $userId.", ['recommendations' => $orderedRecommendations]);
 
@@ -60,15 +53,113 @@ class RecommendationService
                 'exception' => $e->getTraceAsString(),
                 'response' => $e->hasResponse() ? $e->getResponse()->getBody()->getContents() : 'No response'
             ]);
-            // Fallback to popular active items or empty array
-            // TODO: 在這裡可以實作從資料庫獲取熱門商品作為備用
-            return Product::active()->inRandomOrder()->limit(10)->get(['id', 'name', 'price', 'category_id', 'image_url'])->toArray();
+            return $this->getPopularProducts();
         } catch (\Exception $e) {
             Log::error("An unexpected error occurred while getting recommendations: " . $e->getMessage(), [
                 'user_id' => $userId,
                 'exception' => $e->getTraceAsString()
             ]);
-            return Product::active()->inRandomOrder()->limit(10)->get(['id', 'name', 'price', 'category_id', 'image_url'])->toArray();
+            return $this->getPopularProducts();
+        }
+    }
+
+    /**
+     * 備援：FastAPI 預先排好的時間衰減熱門商品 (/popular，不查 MySQL)。
+     * 清單短暫快取；連 /popular 也失敗時，以主鍵索引取最新的上架商品，不使用 ORDER BY RAND() 的全表掃描。
+     */
+    public function getPopularProducts(int $limit = self::FALLBACK_LIMIT): array
+    {
+        try {
+            // 閉包拋出例外時不會寫入快取，服務恢復後下一個請求即可取得清單
+            $popularProductIds = Cache::remember('recommendation_popular_ids:' . $limit, self::POPULAR_PRODUCTS_CACHE_SECONDS, function () use ($limit) {
+                $response = $this->httpClient->get('/popular', [
+                    'query' => ['num_recommendations' => $limit],
+                    'timeout' => self::POPULAR_PRODUCTS_TIMEOUT_SECONDS,
+                ]);
+                $data = json_decode($response->getBody()->getContents(), true);
+                return $data['recommended_product_ids'] ?? [];
+            });
+            if (!empty($popularProductIds)) {
+                return $this->activeProductsInOrder($popularProductIds);
+            }
+        } catch (\Exception $e) {
+            Log::warning("Failed to get popular products from FastAPI service: " . $e->getMessage());
         }
+
+        return Product::active()->orderByDesc('id')->limit($limit)->get(['id', 'name', 'price', 'category_id', 'image_url'])->toArray();
+    }
+
+    /**
+     * 從 Laravel 的資料庫讀取真實的產品詳細資訊，並篩選出上架狀態的商品，順序與給定的 ID 一致。
+     * FastAPI 對同一用戶會返回快取的清單，相同清單的商品詳細資訊短暫快取；
+     * 上下架 / 售完狀態每次都以主鍵查詢篩選，下架的商品不會因快取而繼續被推薦。
+     */
+    private function activeProductsInOrder(array $productIds): array
+    {
+        if (empty($productIds)) {
+            return [];
+        }
+
+        $cacheKey = 'recommendation_product_details:' . md5(implode(',', $productIds));
+        $details = Cache::remember($cacheKey, self::PRODUCT_DETAILS_CACHE_SECONDS, function () use ($productIds) {
+            return Product::whereIn('id', $productIds)
+                          ->get(['id', 'name', 'price', 'category_id', 'image_url'])
+                          ->keyBy('id')
+                          ->toArray();
+        });
+
+        // 只獲取上架的商品 (只讀主鍵，不受詳細資訊快取影響)
+        $activeIds = array_flip(Product::whereIn('id', $productIds)->active()->pluck('id')->all());
+
+        // 確保推薦順序與 FastAPI 返回的順序一致 (以 id 為鍵查找，O(n))
+        $ordered = [];
+        foreach ($productIds as $id) {
+            if (isset($activeIds[$id], $details[$id])) {
+                $ordered[] = $details[$id];
+            }
+        }
+        return $ordered;
+    }
+
+    /**
+     * 批次取得多個用戶的推薦商品 ID（供 Email / 推播等離線任務使用）。
+     * FastAPI 以 NDJSON 串流回傳，每行一個用戶，返回 [user_id => [product_id, ...]]。
+     */
+    public function getBatchRecommendations(array $userIds, string $strategyVersion = 'v1', int $numRecommendations = 10): array
+    {
+        $results = [];
+        try {
+            $response = $this->httpClient->post('/recommend/batch', [
+                'json' => [
+                    'user_ids' => array_values($userIds),
+                    'strategy_version' => $strategyVersion,
+                    'num_recommendations' => $numRecommendations,
+                ],
+                'stream' => true,
+                'timeout' => 0, // 大批次串流回應不設總超時
+            ]);
+
+            $body = $response->getBody();
+            $buffer = '';
+            while (!$body->eof()) {
+                $buffer .= $body->read(65536);
+                while (($newline = strpos($buffer, "\n")) !== false) {
+                    $line = substr($buffer, 0, $newline);
+                    $buffer = substr($buffer, $newline + 1);
+                    if ($line === '') {
+                        continue;
+                    }
+                    $row = json_decode($line, true);
+                    $results[$row['user_id']] = $row['recommended_product_ids'] ?? [];
+                }
+            }
+        } catch (RequestException $e) {
+            Log::error("Failed to get batch recommendations from FastAPI service: " . $e->getMessage(), [
+                'user_count' => count($userIds),
+                'strategy_version' => $strategyVersion,
+            ]);
+        }
+
+        return $results;
     }
 }